@@ -419,6 +419,154 @@ def create_app(config_name=None):
         db.create_all()
         print('Nutrition and workout tables created.')
 
+    # CLI: create async ingest job tables
+    @app.cli.command('migrate-ingest-jobs')
+    def migrate_ingest_jobs_cmd():
+        """Create ingest_jobs and ingest_job_chunks tables."""
+        db.create_all()
+        print('Ingest job tables created.')
+
+    # CLI: create ingest idempotency key table
+    @app.cli.command('migrate-ingest-idempotency')
+    def migrate_ingest_idempotency_cmd():
+        """Create ingest_idempotency_keys table (replayed /ingest retries)."""
+        from sqlalchemy import text as sa_text
+        db.create_all()
+        # Tables created before replayed headers were stored
+        with db.engine.connect() as conn:
+            conn.execute(sa_text(
+                'ALTER TABLE ingest_idempotency_keys ADD COLUMN IF NOT EXISTS response_headers JSON'
+            ))
+            conn.commit()
+        print('Ingest idempotency table created.')
+
+    # CLI: create and fill the delta-sync cursor table
+    @app.cli.command('migrate-sync-state')
+    def migrate_sync_state_cmd():
+        """Create health_sync_state and fill it from existing data."""
+        from .services.health_sync_state import rebuild_sync_state
+        db.create_all()
+        rebuild_sync_state()
+        db.session.commit()
+        print('health_sync_state created and filled.')
+
+    # CLI: recompute delta-sync cursors
+    @app.cli.command('rebuild-sync-state')
+    @click.option('--user-id', default=None, type=int, help='Only this user (default: all)')
+    def rebuild_sync_state_cmd(user_id):
+        """Recompute health_sync_state from health_metrics and workouts."""
+        from .services.health_sync_state import rebuild_sync_state
+        rebuild_sync_state(user_id)
+        db.session.commit()
+        print('health_sync_state rebuilt.')
+
+    # CLI: create ingest fingerprint table
+    @app.cli.command('migrate-ingest-fingerprints')
+    def migrate_ingest_fingerprints_cmd():
+        """Create health_metric_fingerprints table (unchanged-day skipping on ingest)."""
+        db.create_all()
+        print('Ingest fingerprint table created.')
+
+    # CLI: async ingest worker
+    @app.cli.command('ingest-worker')
+    @click.option('--once', is_flag=True, help='Exit once the queue is empty')
+    @click.option('--poll-interval', default=2.0, type=float, help='Seconds between polls when idle')
+    def ingest_worker(once, poll_interval):
+        """Process queued async health ingest jobs and flush due ingest buffers.
+
+        Usage: flask ingest-worker
+        """
+        from .services.ingest_buffer import flush_due_buffers
+        from .services.ingest_jobs import run_ingest_worker
+
+        def flush_buffers():
+            flushed = flush_due_buffers(app.config['HEALTH_INGEST_BUFFER_MAX_POINTS'],
+                                        app.config['HEALTH_INGEST_BUFFER_MAX_AGE'])
+            if flushed:
+                print(f'Flushed ingest buffers of {flushed} users.')
+
+        processed = run_ingest_worker(poll_interval=poll_interval, once=once,
+                                      on_idle=flush_buffers)
+        print(f'Processed {processed} ingest jobs.')
+
+    # CLI: flush buffered ingest pushes
+    @app.cli.command('flush-ingest-buffer')
+    @click.option('--user-id', default=None, type=int, help='Flush this user now (default: all due buffers)')
+    def flush_ingest_buffer_cmd(user_id):
+        """Flush health_ingest_buffer into health_metrics."""
+        from .services.ingest_buffer import flush_due_buffers, flush_ingest_buffer
+        if user_id is not None:
+            result = flush_ingest_buffer(user_id)
+            print(f'Flushed user {user_id}: {result}' if result else 'Nothing to flush.')
+            return
+        flushed = flush_due_buffers(app.config['HEALTH_INGEST_BUFFER_MAX_POINTS'],
+                                    app.config['HEALTH_INGEST_BUFFER_MAX_AGE'])
+        print(f'Flushed ingest buffers of {flushed} users.')
+
+    # CLI: create ingest buffer table
+    @app.cli.command('migrate-ingest-buffer')
+    def migrate_ingest_buffer_cmd():
+        """Create health_ingest_buffer table (buffered ingest mode)."""
+        db.create_all()
+        print('Ingest buffer table created.')
+
+    # CLI: create ingest telemetry table
+    @app.cli.command('migrate-ingest-runs')
+    def migrate_ingest_runs_cmd():
+        """Create ingest_runs table (ingest telemetry)."""
+        db.create_all()
+        print('Ingest runs table created.')
+
+    # CLI: ingest latency and size percentiles per user
+    @app.cli.command('ingest-stats')
+    @click.option('--days', default=7, type=int, help='Look back this many days')
+    def ingest_stats_cmd(days):
+        """Show p50/p95/p99 ingest timings per user, heaviest users first."""
+        from datetime import timedelta, timezone
+        from .services.ingest_telemetry import ingest_stats
+        since = datetime.now(timezone.utc) - timedelta(days=days)
+        print(f"{'user':>6} {'runs':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'p99 ms':>9} {'p95 upsert':>10} {'p95 pts':>9}")
+        for s in ingest_stats(since):
+            total = s['totalMs'] or {}
+            print(f"{s['userId']:>6} {s['runs']:>6} {s['errors']:>6} "
+                  f"{total.get('p50', 0):>9.0f} {total.get('p95', 0):>9.0f} {total.get('p99', 0):>9.0f} "
+                  f"{(s['upsertMs'] or {}).get('p95', 0):>10.0f} "
+                  f"{(s['pointsPerRun'] or {}).get('p95', 0):>9.0f}")
+
+    # CLI: micro-benchmark for ingest timestamp parsing
+    @app.cli.command('bench-ingest-parse')
+    @click.option('--points', default=100000, type=int, help='Number of synthetic samples')
+    def bench_ingest_parse(points):
+        """Compare parse_date with the compiled ingest normalizer (no DB access)."""
+        import time
+        from datetime import timedelta
+        from .services.ingest_normalizer import (
+            parse_date, compile_date_parser, normalize_point,
+        )
+        start = datetime(2026, 1, 1)
+        samples = [{
+            'date': (start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S -0300'),
+            'Avg': 72, 'Min': 60, 'Max': 90, 'source': 'Apple Watch',
+        } for i in range(points)]
+        dates = [s['date'] for s in samples]
+        parse = compile_date_parser(dates[0])
+
+        def run(label, fn):
+            t0 = time.perf_counter()
+            out = fn()
+            elapsed = time.perf_counter() - t0
+            print(f'  {label:<18} {elapsed:7.3f}s  {points / elapsed:>12,.0f} points/s')
+            return out, elapsed
+
+        print(f'Parsing {points} exporter samples:')
+        expected, base = run('parse_date', lambda: [parse_date(d) for d in dates])
+        parsed, fast = run('compiled parser', lambda: [parse(d) for d in dates])
+        run('normalize_point', lambda: [normalize_point(s, parse) for s in samples])
+        if parsed != expected:
+            print('  MISMATCH between parse_date and compiled parser!')
+        print(f'  compiled parser speedup: {base / fast:.1f}x')
+
     # CLI: seed exercises
     @app.cli.command('seed-exercises')
     def seed_exercises_command():
@@ -446,6 +594,252 @@ def create_app(config_name=None):
             conn.commit()
         print('Added altura column to users table.')
 
+    # CLI: add unique (user_id, metric_name, date) constraint to health_metrics
+    @app.cli.command('add-health-metrics-unique')
+    def add_health_metrics_unique():
+        """Deduplicate health_metrics and add the constraint used by the ingest upsert."""
+        from sqlalchemy import text as sa_text
+        with db.engine.connect() as conn:
+            result = conn.execute(sa_text(
+                "SELECT constraint_name FROM information_schema.table_constraints "
+                "WHERE table_name='health_metrics' AND constraint_name='uq_health_metric_point'"
+            ))
+            if result.fetchone():
+                print('Constraint uq_health_metric_point already exists.')
+                return
+            # Keep the newest row of each duplicated point
+            deleted = conn.execute(sa_text("""
+                DELETE FROM health_metrics a
+                USING health_metrics b
+                WHERE a.user_id = b.user_id AND a.metric_name = b.metric_name
+                  AND a.date = b.date AND a.id < b.id
+            """)).rowcount
+            conn.execute(sa_text(
+                'ALTER TABLE health_metrics ADD CONSTRAINT uq_health_metric_point '
+                'UNIQUE (user_id, metric_name, date)'
+            ))
+            conn.commit()
+        print(f'Removed {deleted} duplicate rows. Added uq_health_metric_point to health_metrics.')
+
+    # CLI: add typed value columns to health_metrics and fill them from data
+    @app.cli.command('add-health-metric-values')
+    @click.option('--batch-size', default=50000, type=int, help='Rows updated per transaction')
+    def add_health_metric_values(batch_size):
+        """Add qty/avg_val/min_val/max_val columns to health_metrics and backfill them."""
+        from sqlalchemy import text as sa_text
+        from .services.ingest_normalizer import value_columns_sql
+        with db.engine.connect() as conn:
+            for column in ('qty', 'avg_val', 'min_val', 'max_val'):
+                conn.execute(sa_text(
+                    f'ALTER TABLE health_metrics ADD COLUMN IF NOT EXISTS {column} FLOAT'
+                ))
+            conn.commit()
+            last_id = conn.execute(sa_text('SELECT MAX(id) FROM health_metrics')).scalar() or 0
+            filled = 0
+            # Walk the id range so each batch is a short transaction
+            for start in range(0, last_id, batch_size):
+                filled += conn.execute(sa_text(f"""
+                    UPDATE health_metrics hm
+                    SET qty = v.qty, avg_val = v.avg_val, min_val = v.min_val, max_val = v.max_val
+                    FROM (
+                        SELECT id, {value_columns_sql('data')} FROM health_metrics
+                        WHERE id > :start AND id <= :end
+                    ) v
+                    WHERE hm.id = v.id
+                """), {'start': start, 'end': start + batch_size}).rowcount
+                conn.commit()
+                print(f'  {filled:,} rows filled')
+        print(f'Filled typed value columns for {filled:,} health_metrics rows.')
+
+    # CLI: add the per-user covering index to health_metrics
+    @app.cli.command('add-health-metrics-user-index')
+    def add_health_metrics_user_index():
+        """Add idx_health_metrics_user_name_date and drop the user_id-only index it replaces."""
+        from sqlalchemy import text as sa_text
+        from .services.health_partitions import is_partitioned
+        with db.engine.connect() as conn:
+            partitioned = is_partitioned(conn)
+        # CONCURRENTLY avoids blocking ingest, but isn't supported on a partitioned parent
+        concurrently = '' if partitioned else 'CONCURRENTLY'
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(sa_text(
+                f'CREATE INDEX {concurrently} IF NOT EXISTS idx_health_metrics_user_name_date '
+                'ON health_metrics (user_id, metric_name, date) '
+                'INCLUDE (qty, avg_val, min_val, max_val, sample_count)'
+            ))
+            conn.execute(sa_text(f'DROP INDEX {concurrently} IF EXISTS idx_health_metrics_user'))
+        print('Added idx_health_metrics_user_name_date to health_metrics.')
+
+    # CLI: add the rollup sample_count column to health_metrics
+    @app.cli.command('add-health-metric-sample-count')
+    def add_health_metric_sample_count():
+        """Add the sample_count column used by retention rollups.
+
+        Run before add-health-metrics-user-index, whose index includes it.
+        """
+        from sqlalchemy import text as sa_text
+        with db.engine.connect() as conn:
+            conn.execute(sa_text(
+                'ALTER TABLE health_metrics ADD COLUMN IF NOT EXISTS sample_count INTEGER'
+            ))
+            conn.commit()
+        print('Added sample_count column to health_metrics.')
+
+    # CLI: retention - compact old raw samples into rollups (run from cron)
+    @app.cli.command('compact-health-metrics')
+    @click.option('--user-id', default=None, type=int, help='Only this user (default: all)')
+    @click.option('--days', default=None, type=int, help='Keep raw samples this many days (default: config)')
+    @click.option('--bucket', default=None, type=click.Choice(['minute', 'hour']),
+                  help='Rollup size (default: config)')
+    def compact_health_metrics(user_id, days, bucket):
+        """Replace raw samples older than the retention window with rollups."""
+        from .services.health_retention import apply_retention
+        removed = apply_retention(
+            raw_days=days if days is not None else app.config['HEALTH_RETENTION_RAW_DAYS'],
+            metric_names=app.config['HEALTH_RETENTION_METRICS'],
+            bucket=bucket or app.config['HEALTH_RETENTION_BUCKET'],
+            user_id=user_id, log=print,
+        )
+        if removed:
+            # Make the freed space reusable and refresh planner stats
+            from sqlalchemy import text as sa_text
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(sa_text('VACUUM (ANALYZE) health_metrics'))
+        print(f'Compacted away {removed:,} health_metrics rows.')
+
+    # CLI: create cold archive bookkeeping table
+    @app.cli.command('migrate-health-archive')
+    def migrate_health_archive_cmd():
+        """Create health_archive_months table (cold archive of old months)."""
+        db.create_all()
+        print('Health archive table created.')
+
+    # CLI: move old months of health_metrics to Arrow archive files (run from cron)
+    @app.cli.command('archive-health-metrics')
+    @click.option('--user-id', default=None, type=int, help='Only this user (default: all)')
+    @click.option('--days', default=None, type=int, help='Archive months older than this (default: config)')
+    def archive_health_metrics(user_id, days):
+        """Move closed months older than the archive age into per-user Arrow files."""
+        from .services.health_archive import archive_old_months
+        moved = archive_old_months(
+            app.config['HEALTH_ARCHIVE_DIR'],
+            older_than_days=days if days is not None else app.config['HEALTH_ARCHIVE_AFTER_DAYS'],
+            user_id=user_id, log=print,
+        )
+        print(f'Archived {moved:,} health_metrics rows to {app.config["HEALTH_ARCHIVE_DIR"]}.')
+
+    # CLI: create array-packed day rows table
+    @app.cli.command('migrate-packed-metrics')
+    def migrate_packed_metrics_cmd():
+        """Create health_metric_days table (array-packed dense metrics)."""
+        db.create_all()
+        print('Packed metrics table created.')
+
+    # CLI: move raw samples of packed metrics into their day rows
+    @app.cli.command('pack-health-metrics')
+    @click.option('--metric', 'metrics', multiple=True,
+                  help='Metric name, repeatable (default: HEALTH_PACKED_METRICS)')
+    @click.option('--user-id', default=None, type=int, help='Only this user (default: all)')
+    def pack_health_metrics_cmd(metrics, user_id):
+        """Rewrite health_metrics rows of packed metrics as health_metric_days rows."""
+        from .services.health_packed import pack_health_metrics
+        metric_names = metrics or app.config['HEALTH_PACKED_METRICS']
+        if not metric_names:
+            print('No metrics to pack: pass --metric or set HEALTH_PACKED_METRICS.')
+            return
+        moved = pack_health_metrics(metric_names, user_id=user_id, log=print)
+        if moved:
+            from sqlalchemy import text as sa_text
+            with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(sa_text('VACUUM (ANALYZE) health_metrics'))
+        print(f'Packed {moved:,} health_metrics rows into health_metric_days.')
+
+    # CLI: create daily rollups table
+    @app.cli.command('migrate-health-rollups')
+    def migrate_health_rollups_cmd():
+        """Create health_daily_rollups table (per-day dashboard aggregates)."""
+        db.create_all()
+        print('Daily rollups table created. Run flask rebuild-health-rollups to fill it.')
+
+    # CLI: recompute daily rollups from the stored samples (backfill)
+    @app.cli.command('rebuild-health-rollups')
+    @click.option('--user-id', default=None, type=int, help='Only this user (default: all)')
+    def rebuild_health_rollups_cmd(user_id):
+        """Recompute health_daily_rollups from health_metrics and the packed day rows."""
+        from .services.health_rollups import rebuild_daily_rollups
+        written = rebuild_daily_rollups(user_id=user_id, log=print)
+        print(f'Rebuilt {written:,} daily rollups.')
+
+    # CLI: add and backfill health_metrics.local_day (per-user timezone days)
+    @app.cli.command('add-health-metric-local-day')
+    @click.option('--batch-size', default=50000, type=int, help='Rows updated per transaction')
+    @click.option('--user-id', default=None, type=int,
+                  help='Only this user, e.g. after a timezone change (default: all)')
+    def add_health_metric_local_day(batch_size, user_id):
+        """Add local_day and its index, fill it in each user's timezone and rebuild the rollups."""
+        from sqlalchemy import text as sa_text
+        from .services.health_partitions import is_partitioned
+        from .services.health_rollups import rebuild_daily_rollups, restamp_local_days
+        from .services.user_timezone import timezone_name
+        with db.engine.connect() as conn:
+            conn.execute(sa_text('ALTER TABLE health_metrics ADD COLUMN IF NOT EXISTS local_day DATE'))
+            conn.commit()
+            partitioned = is_partitioned(conn)
+        concurrently = '' if partitioned else 'CONCURRENTLY'
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+            conn.execute(sa_text(
+                f'CREATE INDEX {concurrently} IF NOT EXISTS idx_health_metrics_user_name_local_day '
+                'ON health_metrics (user_id, metric_name, local_day)'
+            ))
+
+        user_ids = [user_id] if user_id else [
+            r.id for r in db.session.execute(sa_text('SELECT id FROM users ORDER BY id'))]
+        changed_users = []
+        for uid in user_ids:
+            updated = restamp_local_days(uid, batch_size)
+            print(f'  user {uid} ({timezone_name(uid)}): {updated:,} rows updated')
+            if updated:
+                changed_users.append(uid)
+        for uid in changed_users:
+            rebuild_daily_rollups(user_id=uid, log=print)
+        print(f'local_day filled; rollups rebuilt for {len(changed_users)} users.')
+
+    # CLI: convert health_metrics to monthly partitions
+    @app.cli.command('partition-health-metrics')
+    @click.option('--batch-size', default=50000, type=int, help='Rows copied per transaction')
+    def partition_health_metrics_cmd(batch_size):
+        """Partition health_metrics by month, copying existing rows in batches."""
+        from .services.health_partitions import LEGACY_TABLE, partition_health_metrics
+        copied = partition_health_metrics(batch_size=batch_size)
+        print(f'Copied {copied:,} rows. Check counts, then DROP TABLE {LEGACY_TABLE}.')
+
+    # CLI: pre-create upcoming monthly partitions (run from cron)
+    @app.cli.command('ensure-health-partitions')
+    @click.option('--months-ahead', default=3, type=int, help='Months to create past the current one')
+    def ensure_health_partitions_cmd(months_ahead):
+        """Create missing health_metrics partitions through the coming months."""
+        from .services.health_partitions import ensure_partitions
+        with db.engine.connect() as conn:
+            created = ensure_partitions(conn, months_ahead=months_ahead)
+        print(f'Created {len(created)} partitions: {", ".join(created) or "none"}.')
+
+    # CLI: retention by dropping whole months of health_metrics
+    @app.cli.command('drop-health-partitions')
+    @click.option('--before', required=True, help='First month to keep (YYYY-MM)')
+    def drop_health_partitions_cmd(before):
+        """Drop every health_metrics month before the given one."""
+        from .services.health_partitions import drop_partitions_before
+        from .services.health_rollups import forget_rollups_before
+        from .services.health_sync_state import rebuild_sync_state
+        cutoff = datetime.strptime(before, '%Y-%m').date()
+        with db.engine.connect() as conn:
+            dropped = drop_partitions_before(conn, cutoff)
+        if dropped:
+            rebuild_sync_state()
+            forget_rollups_before(cutoff)
+            db.session.commit()
+        print(f'Dropped {len(dropped)} monthly partitions before {before}.')
+
     # CLI: migrate data from one user to another
     @app.cli.command('migrate-user-data')
     @click.argument('from_id', type=int)
@@ -465,14 +859,28 @@ def create_app(config_name=None):
             print(f'User {to_id} not found.')
             return
 
-        # Migrate health metrics
-        metrics = HealthMetric.query.filter_by(user_id=from_id).count()
-        HealthMetric.query.filter_by(user_id=from_id).update({'user_id': to_id})
-        print(f'Migrated {metrics} health metrics.')
+        # Migrate health metrics; a point both users hold keeps to_id's copy
+        from sqlalchemy import text as sa_text
+        from .services.health_packed import move_packed_days
+        duplicates = db.session.execute(sa_text("""
+            DELETE FROM health_metrics s
+            USING health_metrics d
+            WHERE s.user_id = :from_id AND d.user_id = :to_id
+              AND d.metric_name = s.metric_name AND d.date = s.date
+        """), {'from_id': from_id, 'to_id': to_id}).rowcount
+        metrics = HealthMetric.query.filter_by(user_id=from_id).update({'user_id': to_id})
+        move_packed_days(from_id, to_id)
+        from .services.ingest_fingerprints import invalidate_fingerprints
+        invalidate_fingerprints(from_id)
+        invalidate_fingerprints(to_id)
+        print(f'Migrated {metrics} health metrics ({duplicates} already held by user {to_id}).')
 
         # Migrate workouts
         workouts = Workout.query.filter_by(user_id=from_id).count()
         Workout.query.filter_by(user_id=from_id).update({'user_id': to_id})
+        from .services.health_sync_state import rebuild_sync_state
+        rebuild_sync_state(from_id)
+        rebuild_sync_state(to_id)
         print(f'Migrated {workouts} workouts.')
 
         # Migrate events
@@ -501,8 +909,69 @@ def create_app(config_name=None):
         print(f'Transferred XP: {src.experience}, Level: {src.level}')
 
         db.session.commit()
+
+        # Recomputed after the commit: it works through its own transactions
+        from .services.health_rollups import rebuild_daily_rollups
+        rebuild_daily_rollups(from_id)
+        rebuild_daily_rollups(to_id)
         print(f'Done! All data migrated from user {from_id} ({src.nome}) to user {to_id} ({dst.nome}).')
 
+    # CLI: bulk historical backfill from a Health Auto Export file
+    @app.cli.command('backfill-health')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--user-id', default=1, type=int)
+    @click.option('--batch-size', default=50000, type=int, help='Points per COPY + merge round')
+    def backfill_health(path, user_id, batch_size):
+        """Load a Health Auto Export JSON file (or .json.gz) through COPY.
+
+        Usage: flask backfill-health export.json --user-id 1
+        """
+        from .services.health_backfill import backfill_health_file
+        print(f'Backfilling {path} for user {user_id}...')
+        result = backfill_health_file(path, user_id, batch_size=batch_size)
+        print(f"Done in {result['seconds']}s ({result['rowsPerSecond']:,} rows/s): "
+              f"{result['metricsInserted']} inserted, {result['metricsUpdated']} updated, "
+              f"{result['workoutsStored']} workouts, {result['eventsCreated']} events.")
+        for error in result['errors'] or []:
+            print(f'  ! {error}')
+
+    # CLI: import the Apple Health app's own export (export.xml / export.zip)
+    @app.cli.command('import-apple-health')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--user-id', default=1, type=int)
+    @click.option('--batch-size', default=50000, type=int, help='Points per COPY + merge round')
+    @click.option('--no-events', is_flag=True, help='Do not create gamification events')
+    def import_apple_health(path, user_id, batch_size, no_events):
+        """Stream an Apple Health export.xml into health_metrics and workouts.
+
+        Usage: flask import-apple-health export.zip --user-id 1
+        """
+        from .services.apple_health_import import import_apple_health_xml
+        print(f'Importing {path} for user {user_id}...')
+        result = import_apple_health_xml(path, user_id, batch_size=batch_size,
+                                         create_events=not no_events)
+        print(f"Done in {result['seconds']}s: {result['records']:,} records, "
+              f"{result['metricsInserted']} inserted, {result['metricsUpdated']} updated, "
+              f"{result['workoutsStored']} workouts, {result['eventsCreated']} events.")
+        if result['skippedTypes']:
+            print(f"  Skipped types: {', '.join(result['skippedTypes'])}")
+        for error in result['errors'] or []:
+            print(f'  ! {error}')
+
+    # CLI: merge overlapping device samples already stored
+    @app.cli.command('merge-health-sources')
+    @click.option('--user-id', default=1, type=int)
+    @click.option('--metric', 'metrics', multiple=True, help='Metric name (default: all cumulative metrics)')
+    def merge_health_sources(user_id, metrics):
+        """Re-run the source-priority merge over stored samples.
+
+        Usage: flask merge-health-sources --user-id 1 --metric step_count
+        """
+        from .services.source_merge import merge_stored_sources
+        print(f'Merging overlapping sources for user {user_id}...')
+        merged = merge_stored_sources(user_id, metrics or None, log=print)
+        print(f'Done! {merged} overlapping samples merged away.')
+
     # CLI: inspect raw metric data for a specific day (diagnostic)
     @app.cli.command('inspect-metric')
     @click.argument('metric_name')
@@ -514,14 +983,17 @@ def create_app(config_name=None):
         Usage: flask inspect-metric step_count --date 2026-02-20 --user-id 1
         """
         from sqlalchemy import text as sa_text
+        from datetime import timedelta
         target = date or datetime.now().strftime('%Y-%m-%d')
+        day_start = datetime.strptime(target, '%Y-%m-%d')
 
         rows = db.session.execute(sa_text("""
             SELECT id, date, data, metric_units
             FROM health_metrics
-            WHERE user_id = :uid AND metric_name = :name AND date::date = :d
+            WHERE user_id = :uid AND metric_name = :name AND date >= :start AND date < :end
             ORDER BY date ASC
-        """), {'uid': user_id, 'name': metric_name, 'd': target}).fetchall()
+        """), {'uid': user_id, 'name': metric_name,
+               'start': day_start, 'end': day_start + timedelta(days=1)}).fetchall()
 
         print(f'\n{metric_name} on {target} for user {user_id}: {len(rows)} records\n')
 
@@ -26,6 +26,43 @@ class Config:
     JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'life-manager-jwt-secret')
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(days=30)
 
+    # Health ingest: parse /api/health/ingest bodies incrementally (?stream=1 per request)
+    HEALTH_INGEST_STREAMING = os.environ.get('HEALTH_INGEST_STREAMING', 'false').lower() == 'true'
+    # Health ingest: queue bodies for `flask ingest-worker` and answer 202 (?async=1 per request)
+    HEALTH_INGEST_ASYNC = os.environ.get('HEALTH_INGEST_ASYNC', 'false').lower() == 'true'
+    # Health ingest: write a buffered payload's metrics from a thread pool (?parallel=1 per request)
+    HEALTH_INGEST_PARALLEL = os.environ.get('HEALTH_INGEST_PARALLEL', 'false').lower() == 'true'
+    # Health ingest: threads (and so DB connections) used by parallel ingest
+    HEALTH_INGEST_WORKERS = int(os.environ.get('HEALTH_INGEST_WORKERS', 4))
+    # Health ingest: device priority for merging overlapping samples (users may override
+    # with the 'sourcePriority' preference); names match by substring, highest first
+    HEALTH_SOURCE_PRIORITY = [s.strip() for s in os.environ.get(
+        'HEALTH_SOURCE_PRIORITY', 'Apple Watch,iPhone').split(',') if s.strip()]
+    # Health ingest: append small pushes to a per-user buffer, flushed in one pass (?buffer=1 per request)
+    HEALTH_INGEST_BUFFERED = os.environ.get('HEALTH_INGEST_BUFFERED', 'false').lower() == 'true'
+    # Health ingest: flush a user's buffer at this many records or this age (seconds)
+    HEALTH_INGEST_BUFFER_MAX_POINTS = int(os.environ.get('HEALTH_INGEST_BUFFER_MAX_POINTS', 20000))
+    HEALTH_INGEST_BUFFER_MAX_AGE = int(os.environ.get('HEALTH_INGEST_BUFFER_MAX_AGE', 900))
+    # Health ingest: cap on a body's size after gzip/zstd decoding (zip-bomb guard)
+    HEALTH_INGEST_MAX_DECODED_BYTES = int(os.environ.get('HEALTH_INGEST_MAX_DECODED_BYTES', 256 * 1024 * 1024))
+    # Health retention: keep raw samples of these metrics this many days, then compact
+    # them into per-'hour' or per-'minute' rollups (`flask compact-health-metrics`)
+    HEALTH_RETENTION_RAW_DAYS = int(os.environ.get('HEALTH_RETENTION_RAW_DAYS', 30))
+    HEALTH_RETENTION_METRICS = [s.strip() for s in os.environ.get(
+        'HEALTH_RETENTION_METRICS', 'heart_rate').split(',') if s.strip()]
+    HEALTH_RETENTION_BUCKET = os.environ.get('HEALTH_RETENTION_BUCKET', 'hour')
+    # Health archive: months older than this many days move to Arrow files under
+    # HEALTH_ARCHIVE_DIR (`flask archive-health-metrics`)
+    HEALTH_ARCHIVE_AFTER_DAYS = int(os.environ.get('HEALTH_ARCHIVE_AFTER_DAYS', 365))
+    HEALTH_ARCHIVE_DIR = os.path.abspath(os.environ.get('HEALTH_ARCHIVE_DIR', 'data/health-archive'))
+    # Dense metrics stored as one array-packed row per user, metric and day
+    # (health_metric_days), e.g. heart_rate,blood_oxygen_saturation; empty keeps every metric
+    # row-per-sample. Source-merged metrics (step_count, active_energy...) are never packed
+    HEALTH_PACKED_METRICS = [s.strip() for s in os.environ.get(
+        'HEALTH_PACKED_METRICS', '').split(',') if s.strip()]
+    # IANA timezone of users without a 'timezone' preference (daily buckets, "today")
+    DEFAULT_TIMEZONE = os.environ.get('DEFAULT_TIMEZONE', 'America/Sao_Paulo')
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
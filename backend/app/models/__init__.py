@@ -1,12 +1,19 @@
 from .user import User
-from .health import HealthMetric, Workout
+from .health import (
+    HealthMetric, HealthMetricFingerprint, Workout, IngestJob, IngestJobChunk, IngestIdempotencyKey,
+    HealthSyncState, HealthIngestBuffer, IngestRun, HealthArchiveMonth, HealthMetricDay,
+    HealthDailyRollup,
+)
 from .gamification import Action, Event, Trophy, UserTrophy
 from .goals import Goal, GoalCheck
 from .nutrition import Food, NutritionProfile, MealPlan, MealPlanItem, FoodLog
 from .workout_tracking import Exercise, WorkoutPlan, WorkoutPlanExercise, WorkoutSession, WorkoutSet
 
 __all__ = [
-    'User', 'HealthMetric', 'Workout', 'Action', 'Event', 'Trophy', 'UserTrophy',
+    'User', 'HealthMetric', 'HealthMetricFingerprint', 'Workout', 'IngestJob', 'IngestJobChunk',
+    'IngestIdempotencyKey', 'HealthSyncState', 'HealthIngestBuffer',
+    'IngestRun', 'HealthArchiveMonth', 'HealthMetricDay', 'HealthDailyRollup',
+    'Action', 'Event', 'Trophy', 'UserTrophy',
     'Goal', 'GoalCheck',
     'Food', 'NutritionProfile', 'MealPlan', 'MealPlanItem', 'FoodLog',
     'Exercise', 'WorkoutPlan', 'WorkoutPlanExercise', 'WorkoutSession', 'WorkoutSet',
@@ -31,7 +31,7 @@ class Goal(db.Model):
 
     def to_dict(self, include_children=False):
         from ..services.metrics import get_user_today
-        today = get_user_today()
+        today = get_user_today(self.user_id)
 
         d = {
             'id': self.id,
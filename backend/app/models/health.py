@@ -1,21 +1,40 @@
 from datetime import datetime, timezone
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY
 from ..extensions import db
 
 
 class HealthMetric(db.Model):
+    """One metric sample. Partitioned by month on date (see health_partitions)."""
     __tablename__ = 'health_metrics'
 
-    id = db.Column(db.Integer, primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     metric_name = db.Column(db.String(100), nullable=False)
     metric_units = db.Column(db.String(50), nullable=True)
-    date = db.Column(db.DateTime, nullable=False)
+    # Part of the primary key because it is the partition key
+    date = db.Column(db.DateTime, primary_key=True, nullable=False)
+    # date's calendar day in the user's timezone, set at ingest (see user_timezone)
+    local_day = db.Column(db.Date, nullable=True)
     data = db.Column(db.JSON, nullable=False)
+    # Numeric values lifted out of data (qty, Avg, Min, Max) for aggregates
+    qty = db.Column(db.Float, nullable=True)
+    avg_val = db.Column(db.Float, nullable=True)
+    min_val = db.Column(db.Float, nullable=True)
+    max_val = db.Column(db.Float, nullable=True)
+    # Samples summarised by a retention rollup row (see health_retention); NULL for raw samples
+    sample_count = db.Column(db.Integer, nullable=True)
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
 
     __table_args__ = (
+        db.UniqueConstraint('user_id', 'metric_name', 'date', name='uq_health_metric_point'),
         db.Index('idx_health_metrics_name_date', 'metric_name', 'date'),
-        db.Index('idx_health_metrics_user', 'user_id'),
+        # Per-user range scans; INCLUDE lets aggregates over the typed values skip the heap
+        db.Index('idx_health_metrics_user_name_date', 'user_id', 'metric_name', 'date',
+                 postgresql_include=['qty', 'avg_val', 'min_val', 'max_val', 'sample_count']),
+        # Daily buckets without per-row timezone conversion
+        db.Index('idx_health_metrics_user_name_local_day', 'user_id', 'metric_name', 'local_day'),
+        {'postgresql_partition_by': 'RANGE (date)'},
     )
 
     def to_dict(self):
@@ -28,6 +47,59 @@ class HealthMetric(db.Model):
         }
 
 
+# Rows outside every monthly partition land here until their month is created
+event.listen(HealthMetric.__table__, 'after_create', DDL(
+    'CREATE TABLE IF NOT EXISTS health_metrics_default PARTITION OF health_metrics DEFAULT'
+))
+
+
+class HealthMetricFingerprint(db.Model):
+    """Content hash of the points last written for one metric-day (see ingest_fingerprints)."""
+    __tablename__ = 'health_metric_fingerprints'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    metric_name = db.Column(db.String(100), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    digest = db.Column(db.String(32), nullable=False)
+    point_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+class HealthMetricDay(db.Model):
+    """One UTC day of a dense metric as parallel arrays, one slot per sample (see health_packed)."""
+    __tablename__ = 'health_metric_days'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    metric_name = db.Column(db.String(100), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    metric_units = db.Column(db.String(50), nullable=True)
+    # Seconds since UTC midnight, ascending; the value arrays follow the same order
+    offsets = db.Column(ARRAY(db.Integer), nullable=False)
+    qty = db.Column(ARRAY(db.Float), nullable=False)
+    avg = db.Column(ARRAY(db.Float), nullable=False)
+    min = db.Column(ARRAY(db.Float), nullable=False)
+    max = db.Column(ARRAY(db.Float), nullable=False)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
+class HealthDailyRollup(db.Model):
+    """One local day of a metric summarised for the dashboard charts (see health_rollups)."""
+    __tablename__ = 'health_daily_rollups'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    metric_name = db.Column(db.String(100), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)  # in the user's timezone
+    total = db.Column(db.Float, nullable=True)  # SUM(qty)
+    # Samples behind avg_val, rollup rows counting their sample_count
+    sample_count = db.Column(db.Integer, nullable=True)
+    avg_val = db.Column(db.Float, nullable=True)
+    min_val = db.Column(db.Float, nullable=True)
+    max_val = db.Column(db.Float, nullable=True)
+    latest_value = db.Column(db.Float, nullable=True)  # qty of the day's last sample
+    latest_ts = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+
 class Workout(db.Model):
     __tablename__ = 'workouts'
 
@@ -51,3 +123,135 @@ class Workout(db.Model):
             'data': self.data,
             'eventCreated': self.event_created,
         }
+
+
+class IngestJob(db.Model):
+    """Queued /api/health/ingest request processed by `flask ingest-worker`."""
+    __tablename__ = 'ingest_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending | running | done | failed
+    payload_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    points_processed = db.Column(db.Integer, nullable=False, default=0)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.JSON, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    started_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.Index('idx_ingest_jobs_status', 'status', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'jobId': self.id,
+            'status': self.status,
+            'payloadBytes': self.payload_bytes,
+            'pointsProcessed': self.points_processed,
+            'attempts': self.attempts,
+            'result': self.result,
+            'error': self.error,
+            'createdAt': self.created_at.isoformat() if self.created_at else None,
+            'startedAt': self.started_at.isoformat() if self.started_at else None,
+            'finishedAt': self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class IngestJobChunk(db.Model):
+    """Raw request body of an IngestJob, spooled in fixed-size pieces."""
+    __tablename__ = 'ingest_job_chunks'
+
+    job_id = db.Column(db.Integer, db.ForeignKey('ingest_jobs.id', ondelete='CASCADE'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class IngestIdempotencyKey(db.Model):
+    """Outcome of an /api/health/ingest request, keyed by Idempotency-Key (or body digest)."""
+    __tablename__ = 'ingest_idempotency_keys'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    key = db.Column(db.String(128), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='in_progress')  # in_progress | done
+    response_status = db.Column(db.Integer, nullable=True)
+    response = db.Column(db.JSON, nullable=True)
+    # Replayed headers of the first response (REPLAYED_HEADERS, e.g. Location)
+    response_headers = db.Column(db.JSON, nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+
+class HealthSyncState(db.Model):
+    """Latest stored timestamp and row count per (user, metric_name), for delta syncs.
+
+    Workouts are tracked under the metric_name '@workouts' (latest start_time).
+    """
+    __tablename__ = 'health_sync_state'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    metric_name = db.Column(db.String(100), primary_key=True)
+    latest_date = db.Column(db.DateTime, nullable=True)
+    row_count = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc),
+                           onupdate=lambda: datetime.now(timezone.utc))
+
+
+class HealthIngestBuffer(db.Model):
+    """Raw ingest records of small pushes waiting to be flushed into health_metrics."""
+    __tablename__ = 'health_ingest_buffer'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # metric | workout
+    metric_name = db.Column(db.String(100), nullable=True)
+    metric_units = db.Column(db.String(50), nullable=True)
+    date = db.Column(db.DateTime, nullable=True)
+    point = db.Column(db.JSON, nullable=False)
+    received_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('idx_health_ingest_buffer_user', 'user_id', 'id'),
+    )
+
+
+class IngestRun(db.Model):
+    """Telemetry of one ingest run: sizes, row counters and per-phase durations."""
+    __tablename__ = 'ingest_runs'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    mode = db.Column(db.String(20), nullable=False)  # sync | stream | async | parallel | buffer | backfill | apple_xml
+    status = db.Column(db.String(20), nullable=False)
+    payload_bytes = db.Column(db.BigInteger, nullable=True)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    inserted = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+    skipped = db.Column(db.Integer, nullable=False, default=0)
+    workouts = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Integer, nullable=False, default=0)
+    total_ms = db.Column(db.Integer, nullable=False, default=0)
+    parse_ms = db.Column(db.Integer, nullable=False, default=0)
+    upsert_ms = db.Column(db.Integer, nullable=False, default=0)
+    events_ms = db.Column(db.Integer, nullable=False, default=0)
+    trophies_ms = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+    __table_args__ = (
+        db.Index('idx_ingest_runs_user_created', 'user_id', 'created_at'),
+    )
+
+
+class HealthArchiveMonth(db.Model):
+    """A user's month of health_metrics moved to a cold archive file (see health_archive)."""
+    __tablename__ = 'health_archive_months'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    month = db.Column(db.Date, primary_key=True)  # first day of the month
+    path = db.Column(db.String(500), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)
+    file_bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    archived_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
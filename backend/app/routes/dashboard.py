@@ -5,78 +5,79 @@ from sqlalchemy import text
 from ..extensions import db
 from ..models.health import HealthMetric, Workout
 from ..models.user import User
+from ..services.health_archive import LatestDay, read_archive
+from ..services.health_packed import packed_range_sum
+from ..services.health_rollups import read_rollups
+from ..services.ingest_buffer import buffered_range_sum
 from ..services.scoring import calculate_daily_score
 from ..services.metrics import (
     METRIC_CONFIG, METRIC_NAME_TO_KEY, METRIC_COLORS,
-    get_all_metric_configs,
+    get_all_metric_configs, day_utc_range, get_user_today, latest_metric_value,
 )
+from ..services.user_timezone import local_day, user_timezone
 from .auth_helpers import get_current_user_id
 
 dashboard_bp = Blueprint('dashboard', __name__)
 
 
-def _aggregate_sum(metric_name, since, user_id):
-    """SUM qty per day for a given metric."""
-    rows = db.session.execute(text("""
-        SELECT date::date AS day, SUM(CAST(data->>'qty' AS FLOAT)) AS total
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = :name AND date >= :since
-        GROUP BY day ORDER BY day
-    """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchall()
-    return rows
-
-
-def _aggregate_hr(metric_name, since, user_id):
-    """AVG/MIN/MAX per day for heart rate metrics."""
-    rows = db.session.execute(text("""
-        SELECT date::date AS day,
-               AVG(CAST(COALESCE(data->>'Avg', data->>'qty') AS FLOAT)) AS avg_val,
-               MIN(CAST(COALESCE(data->>'Min', data->>'qty') AS FLOAT)) AS min_val,
-               MAX(CAST(COALESCE(data->>'Max', data->>'qty') AS FLOAT)) AS max_val
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = :name AND date >= :since
-        GROUP BY day ORDER BY day
-    """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchall()
-    return rows
-
-
-def _aggregate_latest(metric_name, since, user_id):
-    """Latest value per day."""
-    rows = db.session.execute(text("""
-        SELECT DISTINCT ON (date::date) date::date AS day, data->>'qty' AS qty
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = :name AND date >= :since
-        ORDER BY date::date, date DESC
-    """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchall()
-    return rows
-
-
-def _aggregate_sleep(metric_name, since, user_id):
-    """Raw sleep entries."""
-    metrics = HealthMetric.query.filter(
-        HealthMetric.user_id == user_id,
-        HealthMetric.metric_name == metric_name,
-        HealthMetric.date >= since,
-    ).order_by(HealthMetric.date.asc()).all()
-    return metrics
+# Aggregations served from health_daily_rollups
+_ROLLUP_AGGS = ('sum', 'hr', 'latest')
+
+
+def _aggregate_metrics(aggs, since, user_id):
+    """Per-day rows for several metrics at once, {metric_name: rows}.
+
+    aggs maps metric names to their aggregation. All rollup-backed
+    metrics are read in one query and sleep entries in another, instead
+    of one round trip per metric. Rows per aggregation:
+    sum -> day/total, hr -> day/avg_val/min_val/max_val, latest -> day/qty,
+    sleep -> raw entries with date/data.
+    """
+    # Days are the user's local days from here on
+    since = local_day(since, user_timezone(user_id))
+    archived, hot_since = read_archive(user_id, aggs, since)
+    result = {name: archived.get(name, []) for name in aggs}
+
+    rollup_names = [name for name, agg in aggs.items() if agg in _ROLLUP_AGGS]
+    if rollup_names:
+        # Packed day rows are never archived: before the archive boundary
+        # their rollups fill the days the archive has nothing for
+        archived_days = {name: {row.day for row in archived.get(name, ())} for name in rollup_names}
+        for r in read_rollups(user_id, rollup_names, since):
+            if r.day < hot_since and r.day in archived_days[r.metric_name]:
+                continue
+            if aggs[r.metric_name] == 'latest':
+                result[r.metric_name].append(LatestDay(r.day, r.latest_value))
+            else:
+                result[r.metric_name].append(r)
+        if archived:
+            for name in rollup_names:
+                result[name].sort(key=lambda row: row.day)
+
+    sleep_names = [name for name, agg in aggs.items() if agg == 'sleep']
+    if sleep_names:
+        metrics = HealthMetric.query.filter(
+            HealthMetric.user_id == user_id,
+            HealthMetric.metric_name.in_(sleep_names),
+            HealthMetric.local_day >= hot_since,
+        ).order_by(HealthMetric.date.asc()).all()
+        for m in metrics:
+            result[m.metric_name].append(m)
+    return result
 
 
-def _get_metric_data_points(metric_name, agg, since, user_id):
-    """Get data points for any metric based on aggregation type."""
+def _data_points(agg, rows):
+    """Generic {date, value} chart points for one metric's aggregated rows."""
     if agg == 'sum':
-        rows = _aggregate_sum(metric_name, since, user_id)
         return [{'date': str(r.day), 'value': round(r.total, 2)} for r in rows if r.total]
     elif agg == 'hr':
-        rows = _aggregate_hr(metric_name, since, user_id)
         return [{'date': str(r.day), 'value': round(r.avg_val or 0, 1),
                  'min': round(r.min_val or 0, 1), 'max': round(r.max_val or 0, 1)} for r in rows]
     elif agg == 'latest':
-        rows = _aggregate_latest(metric_name, since, user_id)
         return [{'date': str(r.day), 'value': round(float(r.qty), 2) if r.qty else 0} for r in rows]
     elif agg == 'sleep':
-        metrics = _aggregate_sleep(metric_name, since, user_id)
         data_points = []
-        for m in metrics:
+        for m in rows:
             val = m.data.get('asleep') or m.data.get('totalSleep') or m.data.get('qty', 0)
             val = float(val) if val else 0
             if val > 24:
@@ -86,14 +87,18 @@ def _get_metric_data_points(metric_name, agg, since, user_id):
     return []
 
 
+def _get_metric_data_points(metric_name, agg, since, user_id):
+    """Get data points for any metric based on aggregation type."""
+    rows = _aggregate_metrics({metric_name: agg}, since, user_id)[metric_name]
+    return _data_points(agg, rows)
+
+
 def _sum_today(metric_name, target_date, user_id):
-    """SUM qty for a specific day."""
-    row = db.session.execute(text("""
-        SELECT SUM(CAST(data->>'qty' AS FLOAT)) AS total
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = :name AND date::date = :today
-    """), {'uid': user_id, 'name': metric_name, 'today': target_date}).fetchone()
-    return row.total if row and row.total else None
+    """SUM qty for a specific day, including points still in the ingest buffer."""
+    start, end = day_utc_range(target_date, user_timezone(user_id))
+    total = (buffered_range_sum(user_id, metric_name, start, end)
+             + (packed_range_sum(user_id, metric_name, start, end) or 0))
+    return total or None
 
 
 @dashboard_bp.route('/health', methods=['GET'])
@@ -105,14 +110,15 @@ def health_overview():
     since = datetime.now(timezone.utc) - timedelta(days=days)
 
     all_configs = get_all_metric_configs(user_id)
+    aggregated = _aggregate_metrics(
+        {cfg['name']: cfg.get('agg', 'sum') for cfg in all_configs.values()}, since, user_id)
     result = {}
 
     for key, cfg in all_configs.items():
-        metric_name = cfg['name']
         agg = cfg.get('agg', 'sum')
+        rows = aggregated[cfg['name']]
 
         if agg == 'sum':
-            rows = _aggregate_sum(metric_name, since, user_id)
             # Keep backward-compatible field names for known metrics
             if key == 'steps':
                 result[key] = [{'date': str(r.day), 'qty': round(r.total)} for r in rows if r.total]
@@ -125,7 +131,6 @@ def health_overview():
             else:
                 result[key] = [{'date': str(r.day), 'value': round(r.total, 2)} for r in rows if r.total]
         elif agg == 'hr':
-            rows = _aggregate_hr(metric_name, since, user_id)
             if key == 'restingHeartRate':
                 result[key] = [{'date': str(r.day), 'avg': round(r.avg_val or 0, 1)} for r in rows]
             elif key == 'heartRate':
@@ -135,7 +140,6 @@ def health_overview():
                 result[key] = [{'date': str(r.day), 'value': round(r.avg_val or 0, 1),
                                 'min': round(r.min_val or 0, 1), 'max': round(r.max_val or 0, 1)} for r in rows]
         elif agg == 'latest':
-            rows = _aggregate_latest(metric_name, since, user_id)
             if key == 'weight':
                 result[key] = [{'date': str(r.day), 'qty': float(r.qty) if r.qty else 0} for r in rows]
             elif key == 'vo2max':
@@ -143,8 +147,7 @@ def health_overview():
             else:
                 result[key] = [{'date': str(r.day), 'value': round(float(r.qty), 2) if r.qty else 0} for r in rows]
         elif agg == 'sleep':
-            metrics = _aggregate_sleep(metric_name, since, user_id)
-            result[key] = [{'date': m.date.isoformat(), **m.data} for m in metrics]
+            result[key] = [{'date': m.date.isoformat(), **m.data} for m in rows]
 
     # Workouts (special case, not a metric)
     workouts = Workout.query.filter(
@@ -237,11 +240,13 @@ def evolution_data():
     since = datetime.now(timezone.utc) - timedelta(days=days)
 
     all_configs = get_all_metric_configs(user_id)
+    aggregated = _aggregate_metrics(
+        {cfg['name']: cfg.get('agg', 'sum') for cfg in all_configs.values()}, since, user_id)
     result_metrics = {}
     available = []
 
     for key, cfg in all_configs.items():
-        data_points = _get_metric_data_points(cfg['name'], cfg.get('agg', 'sum'), since, user_id)
+        data_points = _data_points(cfg.get('agg', 'sum'), aggregated[cfg['name']])
 
         if data_points:
             result_metrics[key] = data_points
@@ -261,7 +266,7 @@ def daily_summary():
     """Summary for a given date: aggregated health metrics + gamification score."""
     user_id = get_current_user_id()
     target_date_str = request.args.get('date')
-    target_date = date.fromisoformat(target_date_str) if target_date_str else date.today()
+    target_date = date.fromisoformat(target_date_str) if target_date_str else get_user_today(user_id)
 
     steps_total = _sum_today('step_count', target_date, user_id)
     energy_total = _sum_today('active_energy', target_date, user_id)
@@ -270,34 +275,36 @@ def daily_summary():
     latest_sleep = HealthMetric.query.filter(
         HealthMetric.user_id == user_id,
         HealthMetric.metric_name == 'sleep_analysis',
-        HealthMetric.date >= datetime.combine(yesterday, datetime.min.time()),
+        HealthMetric.local_day >= yesterday,
     ).order_by(HealthMetric.date.desc()).first()
 
     latest_weight = HealthMetric.query.filter(
         HealthMetric.user_id == user_id,
         HealthMetric.metric_name == 'weight_body_mass',
     ).order_by(HealthMetric.date.desc()).first()
+    weight_data = latest_weight.data if latest_weight else None
+    if weight_data is None:
+        # Packed weight samples have no row of their own
+        weight_qty = latest_metric_value(user_id, 'weight_body_mass')
+        if weight_qty is not None:
+            weight_data = {'qty': weight_qty, 'units': 'kg'}
 
     rhr_row = db.session.execute(text("""
-        SELECT AVG(CAST(COALESCE(data->>'Avg', data->>'qty') AS FLOAT)) AS avg_val
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = 'resting_heart_rate' AND date::date = :today
-    """), {'uid': user_id, 'today': target_date}).fetchone()
+        SELECT avg_val FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = 'resting_heart_rate' AND day = :day
+    """), {'uid': user_id, 'day': target_date}).fetchone()
 
     mindful_total = _sum_today('mindful_minutes', target_date, user_id)
 
-    latest_vo2 = HealthMetric.query.filter(
-        HealthMetric.user_id == user_id,
-        HealthMetric.metric_name == 'vo2_max',
-    ).order_by(HealthMetric.date.desc()).first()
+    latest_vo2 = latest_metric_value(user_id, 'vo2_max')
 
     score = calculate_daily_score(user_id, target_date)
     user = User.query.get(user_id)
 
     # IMC calculation
     imc_data = None
-    if user and user.altura and latest_weight:
-        weight_val = float(latest_weight.data.get('qty', 0))
+    if user and user.altura and weight_data:
+        weight_val = float(weight_data.get('qty', 0))
         if weight_val > 0 and user.altura > 0:
             imc_val = round(weight_val / (user.altura ** 2), 1)
             if imc_val < 18.5:
@@ -328,19 +335,14 @@ def daily_summary():
             if val:
                 extra_metrics[key] = {'value': round(val, 2), 'label': cfg['label'], 'unit': cfg.get('unit', '')}
         elif agg == 'latest':
-            row = db.session.execute(text("""
-                SELECT data->>'qty' AS qty FROM health_metrics
-                WHERE user_id = :uid AND metric_name = :name
-                ORDER BY date DESC LIMIT 1
-            """), {'uid': user_id, 'name': metric_name}).fetchone()
-            if row and row.qty:
-                extra_metrics[key] = {'value': round(float(row.qty), 2), 'label': cfg['label'], 'unit': cfg.get('unit', '')}
+            value = latest_metric_value(user_id, metric_name)
+            if value:
+                extra_metrics[key] = {'value': round(float(value), 2), 'label': cfg['label'], 'unit': cfg.get('unit', '')}
         elif agg == 'hr':
             row = db.session.execute(text("""
-                SELECT AVG(CAST(COALESCE(data->>'Avg', data->>'qty') AS FLOAT)) AS avg_val
-                FROM health_metrics
-                WHERE user_id = :uid AND metric_name = :name AND date::date = :today
-            """), {'uid': user_id, 'name': metric_name, 'today': target_date}).fetchone()
+                SELECT avg_val FROM health_daily_rollups
+                WHERE user_id = :uid AND metric_name = :name AND day = :day
+            """), {'uid': user_id, 'name': metric_name, 'day': target_date}).fetchone()
             if row and row.avg_val:
                 extra_metrics[key] = {'value': round(row.avg_val, 1), 'label': cfg['label'], 'unit': cfg.get('unit', '')}
 
@@ -349,10 +351,10 @@ def daily_summary():
         'steps': {'qty': round(steps_total)} if steps_total else None,
         'activeEnergy': {'kcal': round(energy_total)} if energy_total else None,
         'sleep': latest_sleep.data if latest_sleep else None,
-        'weight': latest_weight.data if latest_weight else None,
+        'weight': weight_data,
         'restingHeartRate': {'avg': round(rhr_row.avg_val, 1)} if rhr_row and rhr_row.avg_val else None,
         'mindfulness': {'minutes': round(mindful_total, 1)} if mindful_total else None,
-        'vo2max': {'qty': round(float(latest_vo2.data.get('qty', 0)), 1)} if latest_vo2 else None,
+        'vo2max': {'qty': round(float(latest_vo2), 1)} if latest_vo2 is not None else None,
         'imc': imc_data,
         'extraMetrics': extra_metrics,
         'score': score,
@@ -49,7 +49,7 @@ def list_goals():
     """Return recursive tree of goals (root goals with nested children)."""
     try:
         user_id = get_current_user_id()
-        today = get_user_today()
+        today = get_user_today(user_id)
 
         # Fetch only root goals (no parent)
         roots = Goal.query.filter_by(
@@ -69,7 +69,7 @@ def list_goals():
 def daily_goals():
     """Return daily checkable goals that are currently active (by date range)."""
     user_id = get_current_user_id()
-    today = get_user_today()
+    today = get_user_today(user_id)
 
     daily = Goal.query.filter(
         Goal.user_id == user_id,
@@ -106,7 +106,7 @@ def available_metrics():
 def check_goal(goal_id):
     """Check a goal for today, creating a gamification event for XP."""
     user_id = get_current_user_id()
-    today = get_user_today()
+    today = get_user_today(user_id)
 
     goal = Goal.query.filter_by(id=goal_id, user_id=user_id).first_or_404()
 
@@ -168,7 +168,7 @@ def check_goal(goal_id):
 def uncheck_goal(goal_id):
     """Uncheck a goal for today, reversing the XP event."""
     user_id = get_current_user_id()
-    today = get_user_today()
+    today = get_user_today(user_id)
 
     check = GoalCheck.query.filter_by(goal_id=goal_id, date=today, user_id=user_id).first()
     if not check:
@@ -1,10 +1,25 @@
+import json
 from datetime import datetime, timedelta, timezone
-from flask import Blueprint, request, jsonify
+import ijson
+from flask import Blueprint, current_app, request, jsonify, url_for
 from flask_jwt_extended import jwt_required
 from ..extensions import db
-from ..models.health import HealthMetric, Workout
+from ..models.health import HealthMetric, Workout, IngestJob
 from ..models.user import User
-from ..services.health_ingester import process_health_export
+from ..services.health_ingester import (
+    iter_payload_records, process_health_export, process_health_export_parallel,
+    process_health_stream,
+)
+from ..services.ingest_decoding import (
+    CorruptPayload, PayloadTooLarge, UnsupportedEncoding, decode_body, read_all,
+)
+from ..services.ingest_idempotency import (
+    claim_ingest_key, complete_ingest_key, digest_body, release_ingest_key,
+)
+from ..services.health_sync_state import get_sync_state
+from ..services.ingest_buffer import buffer_due, buffer_health_records, flush_ingest_buffer
+from ..services.ingest_jobs import enqueue_ingest_job
+from ..services.ingest_telemetry import ingest_stats, ingest_timer
 from .auth_helpers import get_current_user_id
 
 health_bp = Blueprint('health', __name__)
@@ -40,23 +55,219 @@ def _resolve_ingest_user():
     return first_user.id if first_user else 1
 
 
+def _ingest_flag(arg, config_key):
+    """Boolean ingest option: ?arg=1/0 overrides the app config default."""
+    value = request.args.get(arg)
+    if value is None:
+        return current_app.config.get(config_key, False)
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _ingest_body():
+    """Request body decoded per Content-Encoding (gzip/zstd) and capped in size."""
+    return decode_body(
+        request.stream, request.headers.get('Content-Encoding'),
+        current_app.config['HEALTH_INGEST_MAX_DECODED_BYTES'],
+    )
+
+
+def _body_error(e):
+    if isinstance(e, PayloadTooLarge):
+        return jsonify({'error': str(e)}), 413
+    return jsonify({'error': str(e)}), 400
+
+
 @health_bp.route('/ingest', methods=['POST'])
 def ingest_health_data():
-    """Receives POST JSON from Health Auto Export iOS app."""
-    payload = request.get_json()
+    """Receives POST JSON from Health Auto Export iOS app.
+
+    With ?stream=1 (or HEALTH_INGEST_STREAMING) the body is parsed
+    incrementally and written in fixed-size batches instead of being
+    loaded whole.
+
+    With ?parallel=1 (or HEALTH_INGEST_PARALLEL) a buffered payload's
+    metrics are written by HEALTH_INGEST_WORKERS threads, one metric per
+    shard, each on its own pooled connection.
+
+    With ?buffer=1 (or HEALTH_INGEST_BUFFERED) the records are appended to
+    the user's ingest buffer and 202 is returned; the buffer is flushed in
+    one ingest pass once it reaches HEALTH_INGEST_BUFFER_MAX_POINTS records
+    or HEALTH_INGEST_BUFFER_MAX_AGE seconds.
+
+    With ?async=1 (or HEALTH_INGEST_ASYNC) the body is only spooled into
+    the ingest job queue and 202 is returned with the job id; progress is
+    available at /ingest/<job_id>.
+
+    Bodies may be sent with Content-Encoding gzip or zstd; they are
+    decompressed as they are read and rejected with 413 past
+    HEALTH_INGEST_MAX_DECODED_BYTES.
+
+    Requests are idempotent on the Idempotency-Key header, or on a digest
+    of the decoded body when it is absent: a repeat returns the stored
+    response (Idempotent-Replayed: true), or 409 while the first attempt
+    is still running.
+    """
+    try:
+        body = _ingest_body()
+    except UnsupportedEncoding as e:
+        return jsonify({'error': str(e)}), 415
+
+    user_id = _resolve_ingest_user()
+    key = request.headers.get('Idempotency-Key', '').strip()[:128]
+    if not key:
+        try:
+            key, body = digest_body(body)
+        except (PayloadTooLarge, CorruptPayload) as e:
+            return _body_error(e)
+
+    existing = claim_ingest_key(user_id, key)
+    if existing is not None:
+        if existing.status == 'in_progress':
+            response = jsonify({'error': 'An ingest with this Idempotency-Key is in progress'})
+            response.headers['Retry-After'] = '30'
+            return response, 409
+        response = jsonify(existing.response)
+        for name, value in (existing.response_headers or {}).items():
+            response.headers[name] = value
+        response.headers['Idempotent-Replayed'] = 'true'
+        response.headers['Idempotency-Key'] = key
+        return response, existing.response_status
+
+    try:
+        response, status = _run_ingest(body, user_id)
+    except BaseException:
+        release_ingest_key(user_id, key)
+        raise
+    if status >= 500:
+        release_ingest_key(user_id, key)
+    else:
+        complete_ingest_key(user_id, key, status, response.get_json(), response.headers)
+    response.headers['Idempotency-Key'] = key
+    return response, status
+
+
+def _run_ingest(body, user_id):
+    """Ingest a decoded body in the requested mode. Returns (response, status)."""
+    if _ingest_flag('async', 'HEALTH_INGEST_ASYNC'):
+        try:
+            job = enqueue_ingest_job(user_id, body)
+        except (PayloadTooLarge, CorruptPayload) as e:
+            db.session.rollback()
+            return _body_error(e)
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+        response = jsonify({'status': 'queued', 'jobId': job.id})
+        response.headers['Location'] = url_for('health.ingest_job_status', job_id=job.id)
+        return response, 202
+
+    if _ingest_flag('stream', 'HEALTH_INGEST_STREAMING'):
+        try:
+            result = process_health_stream(body, user_id=user_id)
+            return jsonify(result), 201
+        except (PayloadTooLarge, CorruptPayload) as e:
+            db.session.rollback()
+            return _body_error(e)
+        except ijson.JSONError as e:
+            db.session.rollback()
+            return jsonify({'error': f'Invalid JSON payload: {e}'}), 400
+        except Exception as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), 500
+
+    # Start the run's clock before the body is read and parsed
+    with ingest_timer():
+        return _ingest_json_body(body, user_id)
+
+
+def _ingest_json_body(body, user_id):
+    """Parse a decoded body in one piece and ingest it (buffered, parallel or sync)."""
+    try:
+        raw = read_all(body)
+        payload = json.loads(raw or b'null')
+    except (PayloadTooLarge, CorruptPayload) as e:
+        return _body_error(e)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid JSON payload: {e}'}), 400
     if not payload:
         return jsonify({'error': 'No JSON payload'}), 400
 
-    user_id = _resolve_ingest_user()
+    if _ingest_flag('buffer', 'HEALTH_INGEST_BUFFERED'):
+        return _buffer_ingest(payload, user_id)
 
     try:
-        result = process_health_export(payload, user_id=user_id)
+        if _ingest_flag('parallel', 'HEALTH_INGEST_PARALLEL'):
+            result = process_health_export_parallel(
+                payload, user_id, current_app._get_current_object(),
+                workers=current_app.config['HEALTH_INGEST_WORKERS'], payload_bytes=len(raw),
+            )
+        else:
+            result = process_health_export(payload, user_id=user_id, payload_bytes=len(raw))
         return jsonify(result), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 
+def _buffer_ingest(payload, user_id):
+    """Append a parsed payload to the user's buffer; flush it if a threshold is crossed."""
+    config = current_app.config
+    try:
+        buffered, rejected = buffer_health_records(iter_payload_records(payload), user_id)
+        result = None
+        if buffer_due(user_id, config['HEALTH_INGEST_BUFFER_MAX_POINTS'],
+                      config['HEALTH_INGEST_BUFFER_MAX_AGE']):
+            result = flush_ingest_buffer(user_id)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+    if result is not None:
+        result['buffered'] = buffered
+        result['flushed'] = True
+        if rejected.has_failures:
+            result['status'] = 'partial'
+            result['metricsRejected'] = result.get('metricsRejected', 0) + rejected.rejected_count
+            result['rejected'] = rejected.to_dict()
+        return jsonify(result), 201
+    response = {'status': 'buffered', 'buffered': buffered, 'flushed': False}
+    if rejected.has_failures:
+        response.update(status='partial', metricsRejected=rejected.rejected_count,
+                        rejected=rejected.to_dict())
+    return jsonify(response), 202
+
+
+@health_bp.route('/ingest/<int:job_id>', methods=['GET'])
+def ingest_job_status(job_id):
+    """Progress and result counters of an async ingest job."""
+    user_id = _resolve_ingest_user()
+    job = IngestJob.query.filter_by(id=job_id, user_id=user_id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict())
+
+
+@health_bp.route('/sync-state', methods=['GET'])
+def sync_state():
+    """Latest stored timestamp and row count per metric, plus the latest workout.
+
+    Lets an uploader send only samples newer than what is already stored.
+    Authenticates like /ingest.
+    """
+    user_id = _resolve_ingest_user()
+    return jsonify(get_sync_state(user_id))
+
+
+@health_bp.route('/ingest-stats', methods=['GET'])
+@jwt_required()
+def get_ingest_stats():
+    """p50/p95/p99 of ingest durations (total and per phase) and sizes over recent runs."""
+    user_id = get_current_user_id()
+    days = request.args.get('days', 7, type=int)
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    stats = ingest_stats(since, user_id)
+    return jsonify(stats[0] if stats else {'userId': user_id, 'runs': 0})
+
+
 @health_bp.route('/metrics', methods=['GET'])
 @jwt_required()
 def get_metrics():
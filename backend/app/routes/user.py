@@ -6,7 +6,9 @@ from sqlalchemy.orm.attributes import flag_modified
 from ..extensions import db
 from ..models.user import User
 from ..models.health import Workout
+from ..services.health_rollups import rebuild_daily_rollups, restamp_local_days
 from ..services.scoring import calculate_score_history
+from ..services.user_timezone import local_day, timezone_name, user_timezone, valid_timezone
 from .auth_helpers import get_current_user_id
 
 user_bp = Blueprint('user', __name__)
@@ -42,11 +44,19 @@ def update_preferences():
     user_id = get_current_user_id()
     user = User.query.get_or_404(user_id)
     data = request.get_json()
+    # IANA name such as 'America/Sao_Paulo'; decides which local day samples count for
+    if 'timezone' in data and not valid_timezone(data['timezone']):
+        return jsonify({'error': 'Fuso horário inválido'}), 400
     prefs = user.preferences or {}
+    old_tz = timezone_name(user_id)
     prefs.update(data)
     user.preferences = prefs
     flag_modified(user, 'preferences')
     db.session.commit()
+    if timezone_name(user_id) != old_tz:
+        # Stored days were stamped in the old timezone
+        restamp_local_days(user_id)
+        rebuild_daily_rollups(user_id=user_id)
     return jsonify(user.preferences)
 
 
@@ -56,18 +66,15 @@ def get_stats():
     """RPG character stats based on last 30 days of health data."""
     user_id = get_current_user_id()
     since = datetime.now(timezone.utc) - timedelta(days=30)
+    since_day = local_day(since, user_timezone(user_id))
 
     # --- Health Stats (0-100) ---
 
     # Vitalidade: avg steps/day (10000 steps = 100)
     steps_row = db.session.execute(text("""
-        SELECT AVG(daily_total) AS avg_steps FROM (
-            SELECT SUM(CAST(data->>'qty' AS FLOAT)) AS daily_total
-            FROM health_metrics
-            WHERE user_id = :uid AND metric_name = 'step_count' AND date >= :since
-            GROUP BY date::date
-        ) sub
-    """), {'uid': user_id, 'since': since}).fetchone()
+        SELECT AVG(total) AS avg_steps FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = 'step_count' AND day >= :since
+    """), {'uid': user_id, 'since': since_day}).fetchone()
     avg_steps = steps_row.avg_steps if steps_row and steps_row.avg_steps else 0
     vitalidade = min(100, round(avg_steps / 100))  # 10000 steps = 100
 
@@ -75,8 +82,8 @@ def get_stats():
     sleep_row = db.session.execute(text("""
         SELECT AVG(CAST(data->>'asleep' AS FLOAT)) AS avg_sleep
         FROM health_metrics
-        WHERE user_id = :uid AND metric_name = 'sleep_analysis' AND date >= :since
-    """), {'uid': user_id, 'since': since}).fetchone()
+        WHERE user_id = :uid AND metric_name = 'sleep_analysis' AND local_day >= :since
+    """), {'uid': user_id, 'since': since_day}).fetchone()
     avg_sleep_val = sleep_row.avg_sleep if sleep_row and sleep_row.avg_sleep else 0
     avg_sleep_hours = avg_sleep_val / 3600 if avg_sleep_val > 24 else avg_sleep_val
     resistencia = min(100, round(avg_sleep_hours / 8 * 100))
@@ -91,11 +98,10 @@ def get_stats():
 
     # Foco: mindfulness days + minutes (15 days of meditation = 100)
     mindful_row = db.session.execute(text("""
-        SELECT COUNT(DISTINCT date::date) AS days,
-               SUM(CAST(data->>'qty' AS FLOAT)) AS total_min
-        FROM health_metrics
-        WHERE user_id = :uid AND metric_name = 'mindful_minutes' AND date >= :since
-    """), {'uid': user_id, 'since': since}).fetchone()
+        SELECT COUNT(*) AS days, SUM(total) AS total_min
+        FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = 'mindful_minutes' AND day >= :since
+    """), {'uid': user_id, 'since': since_day}).fetchone()
     mindful_days = mindful_row.days if mindful_row and mindful_row.days else 0
     foco = min(100, round(mindful_days / 15 * 100))
 
@@ -0,0 +1,264 @@
+"""Importer for the Apple Health app's own export.xml dump.
+
+The file is often 1-4 GB, so it is read with iterparse and every
+top-level element is cleared once handled; memory stays flat regardless
+of file size. Records nested in a <Correlation> (blood pressure, food)
+are skipped: export.xml lists each of them at top level as well.
+Timestamps are converted to naive UTC here, so nothing downstream depends
+on the database session's timezone. Quantity records are mapped onto the metric_name
+vocabulary Health Auto Export uses (see METRIC_CONFIG) and loaded
+through the COPY loader, then overlapping devices are merged by source
+priority; workouts are inserted in batches.
+"""
+import os
+import re
+import time
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import date, timezone
+from ..extensions import db
+from ..models.health import Workout
+from .health_backfill import CopyMetricLoader, COPY_BATCH_SIZE
+from .health_sync_state import WORKOUTS_KEY, bump_sync_state
+from .source_merge import MERGE_METRICS, merge_stored_sources
+from .ingest_normalizer import NormalizedPoint, compile_date_parser
+from .ingest_telemetry import timed, track_ingest
+
+_QUANTITY_PREFIX = 'HKQuantityTypeIdentifier'
+_WORKOUT_PREFIX = 'HKWorkoutActivityType'
+
+# HealthKit identifiers whose Health Auto Export name isn't just the snake_case suffix
+HK_METRIC_NAMES = {
+    'HKQuantityTypeIdentifierStepCount': 'step_count',
+    'HKQuantityTypeIdentifierActiveEnergyBurned': 'active_energy',
+    'HKQuantityTypeIdentifierDistanceWalkingRunning': 'walking_running_distance',
+    'HKQuantityTypeIdentifierBodyMass': 'weight_body_mass',
+    'HKQuantityTypeIdentifierVO2Max': 'vo2_max',
+    'HKQuantityTypeIdentifierOxygenSaturation': 'blood_oxygen_saturation',
+    'HKQuantityTypeIdentifierHeartRateVariabilitySDNN': 'heart_rate_variability',
+    'HKCategoryTypeIdentifierMindfulSession': 'mindful_minutes',
+}
+
+# export.xml unit -> (unit stored, factor), so values match what the exporter sends
+UNIT_CONVERSIONS = {
+    'mi': ('km', 1.609344),
+    'm': ('km', 0.001),
+    'lb': ('kg', 0.45359237),
+    'kJ': ('kcal', 1 / 4.184),
+    'Cal': ('kcal', 1.0),
+    '%': ('%', 100.0),
+}
+
+# Records between progress lines
+PROGRESS_EVERY = 500000
+
+WORKOUT_BATCH_SIZE = 1000
+
+
+def _camel_to_snake(name):
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower()
+
+
+def hk_metric_name(hk_type):
+    """Map a HealthKit record type to a health_metrics.metric_name (None if not imported)."""
+    name = HK_METRIC_NAMES.get(hk_type)
+    if name:
+        return name
+    if hk_type.startswith(_QUANTITY_PREFIX):
+        return _camel_to_snake(hk_type[len(_QUANTITY_PREFIX):])
+    return None
+
+
+def _workout_name(activity_type):
+    """'HKWorkoutActivityTypeTraditionalStrengthTraining' -> 'Traditional Strength Training'."""
+    if activity_type.startswith(_WORKOUT_PREFIX):
+        activity_type = activity_type[len(_WORKOUT_PREFIX):]
+    return re.sub(r'(?<!^)(?=[A-Z])', ' ', activity_type) or 'Unknown Workout'
+
+
+def _duration_seconds(value, unit):
+    seconds = float(value)
+    if unit == 'min':
+        seconds *= 60
+    elif unit in ('h', 'hr'):
+        seconds *= 3600
+    return round(seconds)
+
+
+def _naive_utc(ts):
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+
+def _open_xml(path):
+    """Open export.xml directly or from inside the export.zip the Health app produces."""
+    if path.endswith('.zip'):
+        archive = zipfile.ZipFile(path)
+        member = next(n for n in archive.namelist() if n.endswith('/export.xml') or n == 'export.xml')
+        return archive.open(member)
+    return open(path, 'rb')
+
+
+class _WorkoutBatch:
+    """Collects new workouts and inserts them with executemany, skipping ones already stored."""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.stored = 0
+        self._rows = []
+        self._known = {
+            (name, start) for name, start in db.session.query(
+                Workout.name, Workout.start_time,
+            ).filter(Workout.user_id == user_id).all()
+        }
+
+    def add(self, name, start_time, end_time, duration, data):
+        key = (name, start_time)
+        if key in self._known:
+            return
+        self._known.add(key)
+        self._rows.append({
+            'user_id': self.user_id, 'name': name, 'start_time': start_time,
+            'end_time': end_time, 'duration': duration, 'data': data,
+            'event_created': False,
+        })
+        if len(self._rows) >= WORKOUT_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            with timed('upsert'):
+                db.session.execute(Workout.__table__.insert(), self._rows)
+                bump_sync_state(self.user_id, {WORKOUTS_KEY: (
+                    max(r['start_time'] for r in self._rows), len(self._rows),
+                )})
+                db.session.commit()
+            self.stored += len(self._rows)
+            self._rows = []
+
+
+def import_apple_health_xml(path, user_id, batch_size=COPY_BATCH_SIZE, create_events=True,
+                            log=print):
+    """Import an Apple Health export.xml (or export.zip). Returns counters."""
+    with track_ingest(user_id, 'apple_xml', os.path.getsize(path)) as run:
+        run.result = _import_xml(path, user_id, batch_size, create_events, log)
+    return run.result
+
+
+def _import_xml(path, user_id, batch_size, create_events, log):
+    loader = CopyMetricLoader(user_id, batch_size=batch_size)
+    workouts = _WorkoutBatch(user_id)
+    parse = None
+    mindful_by_date = {}
+    records_seen = 0
+    correlation_depth = 0
+    skipped_types = set()
+    merge_metrics = set()
+    errors = []
+    started = time.monotonic()
+
+    with _open_xml(path) as fp:
+        context = ET.iterparse(fp, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            tag = elem.tag
+            if event == 'start':
+                if tag == 'Correlation':
+                    correlation_depth += 1
+                continue
+            if tag == 'Correlation':
+                correlation_depth -= 1
+            elif tag == 'Record' and correlation_depth:
+                # Also listed at top level; counted there
+                continue
+            elif tag == 'Record':
+                records_seen += 1
+                attrs = elem.attrib
+                hk_type = attrs.get('type', '')
+                metric_name = hk_metric_name(hk_type)
+                if metric_name is None:
+                    skipped_types.add(hk_type)
+                else:
+                    try:
+                        start_str = attrs['startDate']
+                        if parse is None:
+                            parse = compile_date_parser(start_str)
+                        ts = _naive_utc(parse(start_str))
+                        if metric_name == 'mindful_minutes':
+                            qty = (_naive_utc(parse(attrs['endDate'])) - ts).total_seconds() / 60
+                            units = 'min'
+                            day = date.fromisoformat(start_str[:10])
+                            mindful_by_date[day] = mindful_by_date.get(day, 0) + qty
+                        else:
+                            units = attrs.get('unit', '')
+                            units, factor = UNIT_CONVERSIONS.get(units, (units, 1.0))
+                            qty = float(attrs['value']) * factor
+                        extra = {'source': attrs['sourceName']} if 'sourceName' in attrs else {}
+                        if metric_name in MERGE_METRICS and 'endDate' in attrs:
+                            extra['end'] = attrs['endDate']
+                            merge_metrics.add(metric_name)
+                        loader.add(metric_name, units,
+                                   NormalizedPoint(ts, qty, None, None, None, extra))
+                    except (KeyError, ValueError) as e:
+                        if len(errors) < 100:
+                            errors.append(f'{hk_type}: {e}')
+                if records_seen % PROGRESS_EVERY == 0:
+                    elapsed = max(time.monotonic() - started, 1e-6)
+                    log(f'  {records_seen:,} records in {elapsed:,.0f}s '
+                        f'({records_seen / elapsed:,.0f} records/s)')
+            elif tag == 'Workout':
+                attrs = elem.attrib
+                try:
+                    start_str = attrs['startDate']
+                    if parse is None:
+                        parse = compile_date_parser(start_str)
+                    start_time = _naive_utc(parse(start_str))
+                    end_time = _naive_utc(parse(attrs['endDate'])) if 'endDate' in attrs else None
+                    duration = _duration_seconds(attrs['duration'], attrs.get('durationUnit', 'min')) \
+                        if 'duration' in attrs else None
+                    data = {'duration': duration, 'source': attrs.get('sourceName')}
+                    if 'totalEnergyBurned' in attrs:
+                        data['activeEnergyBurned'] = {
+                            'qty': float(attrs['totalEnergyBurned']),
+                            'units': attrs.get('totalEnergyBurnedUnit', 'kcal'),
+                        }
+                    if 'totalDistance' in attrs:
+                        data['distance'] = {
+                            'qty': float(attrs['totalDistance']),
+                            'units': attrs.get('totalDistanceUnit', 'km'),
+                        }
+                    workouts.add(_workout_name(attrs.get('workoutActivityType', '')),
+                                 start_time, end_time, duration, data)
+                except (KeyError, ValueError) as e:
+                    if len(errors) < 100:
+                        errors.append(f'Workout: {e}')
+            else:
+                continue
+            # Handled a top-level element: drop everything parsed so far
+            root.clear()
+
+    loader.close()
+    workouts.flush()
+    # export.xml lists each device's samples separately; merge overlaps now
+    merged = merge_stored_sources(user_id, merge_metrics, log=log) if merge_metrics else 0
+
+    events_created = 0
+    if create_events:
+        from .auto_events import create_events_for_mindfulness, process_pending_workout_events
+        with timed('events'):
+            events_created += process_pending_workout_events(user_id)
+            events_created += create_events_for_mindfulness(user_id, mindful_by_date)
+            db.session.commit()
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    return {
+        'records': records_seen,
+        'metricsStored': loader.inserted + loader.updated,
+        'metricsInserted': loader.inserted,
+        'metricsUpdated': loader.updated,
+        'metricsMerged': merged + loader.merged,
+        'workoutsStored': workouts.stored,
+        'eventsCreated': events_created,
+        'skippedTypes': sorted(skipped_types),
+        'errors': errors or None,
+        'seconds': round(elapsed, 1),
+    }
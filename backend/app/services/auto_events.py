@@ -4,9 +4,14 @@ from ..models.gamification import Action, Event
 from ..models.health import Workout
 from ..models.user import User
 from .leveling import process_level_up
+from .ingest_telemetry import timed
 from .trophies import evaluate_trophies
 
 
+WORKOUT_ACTION = ('Exercicio Fisico', {'Saude': 10, 'Mente': 5})
+MINDFULNESS_ACTION = ('Meditar', {'Espirito': 8, 'Mente': 4})
+
+
 def _get_or_create_action(nome, areas, sinergia=True):
     """Get existing action by name or create it."""
     action = Action.query.filter_by(nome=nome).first()
@@ -17,14 +22,98 @@ def _get_or_create_action(nome, areas, sinergia=True):
     return action
 
 
+def _action_xp(action):
+    xp = sum(action.areas.values())
+    if action.sinergia and len(action.areas) >= 2:
+        xp += len(action.areas)
+    return xp
+
+
+def _apply_batch_xp(xp_by_user):
+    """Credit XP per user, then level up and evaluate trophies once each."""
+    for user_id, xp in xp_by_user.items():
+        user = User.query.get(user_id)
+        if not user:
+            continue
+        user.experience += xp
+        process_level_up(user)
+        with timed('trophies'):
+            evaluate_trophies(user)
+
+
+def create_events_for_workouts(workouts):
+    """Batch version of create_event_for_workout.
+
+    Resolves the action once, finds already linked events with a single
+    query and bulk-inserts the missing ones; XP, level-up and trophies are
+    applied once per user. Returns the number of events created.
+    """
+    workouts = [w for w in workouts if w.id is not None]
+    if not workouts:
+        return 0
+    action = _get_or_create_action(*WORKOUT_ACTION)
+    xp = _action_xp(action)
+
+    linked = {wid for (wid,) in db.session.query(Event.workout_id).filter(
+        Event.workout_id.in_([w.id for w in workouts])
+    )}
+    rows = []
+    xp_by_user = {}
+    for workout in workouts:
+        workout.event_created = True
+        if workout.id in linked:
+            continue
+        linked.add(workout.id)
+        duration_min = round(workout.duration / 60) if workout.duration else 0
+        rows.append({
+            'user_id': workout.user_id,
+            'action_id': action.id,
+            'workout_id': workout.id,
+            'descricao': f'{workout.name} ({duration_min} min)',
+            'data': workout.start_time.date() if workout.start_time else date.today(),
+        })
+        xp_by_user[workout.user_id] = xp_by_user.get(workout.user_id, 0) + xp
+
+    if rows:
+        db.session.execute(Event.__table__.insert(), rows)
+        _apply_batch_xp(xp_by_user)
+    return len(rows)
+
+
+def create_events_for_mindfulness(user_id, minutes_by_date):
+    """Batch version of create_event_for_mindfulness for {date: minutes}.
+
+    Days under one minute or that already have a Meditar event are skipped.
+    Returns the number of events created.
+    """
+    days = {d: m for d, m in minutes_by_date.items() if m >= 1}
+    if not days or not User.query.get(user_id):
+        return 0
+    action = _get_or_create_action(*MINDFULNESS_ACTION)
+
+    existing = {d for (d,) in db.session.query(Event.data).filter(
+        Event.user_id == user_id,
+        Event.action_id == action.id,
+        Event.data.in_(list(days)),
+    )}
+    rows = [{
+        'user_id': user_id,
+        'action_id': action.id,
+        'descricao': f'Meditação ({round(minutes)} min)',
+        'data': day,
+    } for day, minutes in sorted(days.items()) if day not in existing]
+
+    if rows:
+        db.session.execute(Event.__table__.insert(), rows)
+        _apply_batch_xp({user_id: _action_xp(action) * len(rows)})
+    return len(rows)
+
+
 def create_event_for_workout(workout, user):
     """Create a gamification event for a workout.
     Deduplicates by workout_id so multiple workouts per day each get their own event.
     """
-    action = _get_or_create_action(
-        'Exercicio Fisico',
-        {'Saude': 10, 'Mente': 5},
-    )
+    action = _get_or_create_action(*WORKOUT_ACTION)
 
     event_date = workout.start_time.date() if workout.start_time else date.today()
 
@@ -46,10 +135,7 @@ def create_event_for_workout(workout, user):
     db.session.add(event)
 
     # XP
-    xp_gained = sum(action.areas.values())
-    if action.sinergia and len(action.areas) >= 2:
-        xp_gained += len(action.areas)
-    user.experience += xp_gained
+    user.experience += _action_xp(action)
 
     process_level_up(user)
     evaluate_trophies(user)
@@ -67,10 +153,7 @@ def create_event_for_mindfulness(user_id, mindful_minutes, event_date=None):
     if not user:
         return None
 
-    action = _get_or_create_action(
-        'Meditar',
-        {'Espirito': 8, 'Mente': 4},
-    )
+    action = _get_or_create_action(*MINDFULNESS_ACTION)
 
     target_date = event_date or date.today()
 
@@ -93,10 +176,7 @@ def create_event_for_mindfulness(user_id, mindful_minutes, event_date=None):
     db.session.add(event)
 
     # XP
-    xp_gained = sum(action.areas.values())
-    if action.sinergia and len(action.areas) >= 2:
-        xp_gained += len(action.areas)
-    user.experience += xp_gained
+    user.experience += _action_xp(action)
 
     process_level_up(user)
     evaluate_trophies(user)
@@ -110,17 +190,8 @@ def process_pending_workout_events(user_id=None):
     if user_id:
         query = query.filter_by(user_id=user_id)
 
-    workouts = query.all()
-    created = 0
-
-    for workout in workouts:
-        user = User.query.get(workout.user_id)
-        if user:
-            event = create_event_for_workout(workout, user)
-            if event:
-                created += 1
-
-    if created > 0:
-        db.session.commit()
-
+    # Workouts of deleted users are left alone, as before
+    workouts = query.join(User, User.id == Workout.user_id).all()
+    created = create_events_for_workouts(workouts)
+    db.session.commit()
     return created
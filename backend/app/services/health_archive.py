@@ -0,0 +1,294 @@
+"""Cold archive of old health_metrics months in Arrow IPC files.
+
+Samples older than about a year are only read by the long-range
+dashboard charts (/api/dashboard/evolution, /api/dashboard/metric/<key>),
+yet they weigh on health_metrics and its indexes. archive_old_months
+moves each closed month of a user's rows, by local_day (their calendar
+day), into one zstd-compressed Arrow IPC file,
+<HEALTH_ARCHIVE_DIR>/user_<id>/<YYYY-MM>.arrow, records it in
+health_archive_months and deletes the rows from health_metrics. Rows
+without a local_day stay hot until it is backfilled.
+
+The dashboard aggregates call read_archive first: when the requested
+range starts before the user's archive boundary (the day after their
+last archived month) it returns the archived part already aggregated per
+local day,
+from memory-mapped files, together with the boundary to use as the hot
+query's lower bound. Rows re-ingested into an archived month stay hidden
+until the month is archived again, which merges them into its file.
+Packed metrics (health_metric_days) are not archived; the dashboard
+keeps reading their rollups before the boundary, on the days the
+archive holds nothing for the metric.
+
+Needs the pyarrow package.
+"""
+import json
+import os
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..extensions import db
+from ..models.health import HealthArchiveMonth
+from .health_rollups import refresh_daily_rollups
+from .health_sync_state import bump_sync_state
+
+# Default age after which whole months are archived (the app passes its config value)
+ARCHIVE_AFTER_DAYS = 365
+
+# Archive files kept open (memory-mapped) across requests
+ARCHIVE_CACHE_SIZE = 64
+
+# Per-day rows returned by read_archive, shaped like the dashboard's SQL rows
+SumDay = namedtuple('SumDay', 'day total')
+HrDay = namedtuple('HrDay', 'day avg_val min_val max_val')
+LatestDay = namedtuple('LatestDay', 'day qty')
+ArchivedSample = namedtuple('ArchivedSample', 'date data')
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+    except ImportError:
+        raise RuntimeError('the health archive needs the pyarrow package')
+    return pyarrow
+
+
+def _schema(pa):
+    return pa.schema([
+        ('metric_name', pa.dictionary(pa.int32(), pa.string())),
+        ('metric_units', pa.string()),
+        ('date', pa.timestamp('us')),
+        ('local_day', pa.date32()),
+        ('qty', pa.float64()),
+        ('avg_val', pa.float64()),
+        ('min_val', pa.float64()),
+        ('max_val', pa.float64()),
+        ('sample_count', pa.int32()),
+        ('data', pa.string()),
+    ])
+
+
+def _month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def _next_month(month):
+    return date(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+
+def _midnight(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def archive_path(root, user_id, month):
+    return os.path.join(root, f'user_{user_id}', f'{month:%Y-%m}.arrow')
+
+
+@lru_cache(maxsize=ARCHIVE_CACHE_SIZE)
+def _load(path, version):
+    """Read an archive file through a memory map. version busts the cache on rewrite."""
+    pa = _pyarrow()
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def _write(path, columns):
+    pa = _pyarrow()
+    table = pa.table(columns, schema=_schema(pa))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    options = pa.ipc.IpcWriteOptions(compression='zstd')
+    with pa.OSFile(tmp, 'wb') as sink, pa.ipc.new_file(sink, table.schema, options=options) as writer:
+        writer.write_table(table, max_chunksize=65536)
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def _write_month(path, rows):
+    """Write a month's file from its rows, merged into what the file already holds.
+
+    Returns (row_count, file_bytes).
+    """
+    points = {}
+    if os.path.exists(path):
+        # Month archived before: rows ingested since then replace archived ones
+        for old in _load(path, os.path.getmtime(path)).to_pylist():
+            # Files written before local_day existed: their month was a UTC one
+            old.setdefault('local_day', old['date'].date())
+            points[(old['metric_name'], old['date'])] = old
+    for r in rows:
+        points[(r.metric_name, r.date)] = {
+            'metric_name': r.metric_name, 'metric_units': r.metric_units, 'date': r.date,
+            'local_day': r.local_day, 'qty': r.qty,
+            'avg_val': r.avg_val, 'min_val': r.min_val, 'max_val': r.max_val,
+            'sample_count': r.sample_count, 'data': json.dumps(r.data),
+        }
+    ordered = [points[k] for k in sorted(points)]
+    names = _schema(_pyarrow()).names
+    return len(ordered), _write(path, {name: [p[name] for p in ordered] for name in names})
+
+
+def archive_month(root, user_id, month):
+    """Move one of a user's local months from health_metrics into its archive file.
+
+    Returns rows moved. The rows are deleted first (DELETE ... RETURNING),
+    so whatever the file is written from is exactly what left the table,
+    and the transaction only commits once the file is in place; a failed
+    write rolls the delete back. The date bounds, a day wider than the
+    month, only let Postgres skip the other monthly partitions.
+    """
+    lo, hi = month, _next_month(month)
+    params = {'uid': user_id, 'lo': lo, 'hi': hi,
+              'date_lo': _midnight(lo - timedelta(days=1)),
+              'date_hi': _midnight(hi + timedelta(days=1))}
+    rows = db.session.execute(text("""
+        DELETE FROM health_metrics
+        WHERE user_id = :uid AND local_day >= :lo AND local_day < :hi
+          AND date >= :date_lo AND date < :date_hi
+        RETURNING metric_name, metric_units, date, local_day, data,
+                  qty, avg_val, min_val, max_val, sample_count
+    """), params).fetchall()
+    if not rows:
+        db.session.rollback()
+        return 0
+
+    path = archive_path(root, user_id, month)
+    try:
+        row_count, file_bytes = _write_month(path, rows)
+    except Exception:
+        db.session.rollback()
+        raise
+
+    removed = {}
+    days = {}
+    for r in rows:
+        removed[r.metric_name] = removed.get(r.metric_name, 0) - 1
+        days.setdefault(r.metric_name, set()).add(r.local_day)
+    bump_sync_state(user_id, {name: (None, n) for name, n in removed.items()})
+    refresh_daily_rollups(user_id, days)
+    table = HealthArchiveMonth.__table__
+    stmt = pg_insert(table).values(user_id=user_id, month=month, path=path,
+                                   row_count=row_count, file_bytes=file_bytes,
+                                   archived_at=datetime.now(timezone.utc))
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'month'],
+        set_={'path': stmt.excluded.path, 'row_count': stmt.excluded.row_count,
+              'file_bytes': stmt.excluded.file_bytes, 'archived_at': stmt.excluded.archived_at},
+    ))
+    db.session.commit()
+    return len(rows)
+
+
+def archive_old_months(root, older_than_days=ARCHIVE_AFTER_DAYS, user_id=None, log=None):
+    """Archive every closed month that ended more than older_than_days ago. Returns rows moved.
+
+    Rows without a local_day (see `flask add-health-metric-local-day`) stay hot.
+    """
+    cutoff = _month_start((datetime.now(timezone.utc) - timedelta(days=older_than_days)).date())
+    if user_id is None:
+        user_ids = [r.id for r in db.session.execute(text('SELECT id FROM users'))]
+    else:
+        user_ids = [user_id]
+    moved = 0
+    for uid in user_ids:
+        months = [r.month.date() for r in db.session.execute(text("""
+            SELECT DISTINCT date_trunc('month', local_day) AS month FROM health_metrics
+            WHERE user_id = :uid AND local_day < :cutoff AND date < :date_cutoff ORDER BY month
+        """), {'uid': uid, 'cutoff': cutoff,
+               'date_cutoff': _midnight(cutoff + timedelta(days=1))})]
+        for month in months:
+            n = archive_month(root, uid, month)
+            moved += n
+            if log:
+                log(f'  user {uid} {month:%Y-%m}: {n:,} rows archived')
+    return moved
+
+
+def archive_boundary(user_id):
+    """First local day of a user's hot data (after the last archived month), or None."""
+    last = db.session.execute(text(
+        'SELECT MAX(month) FROM health_archive_months WHERE user_id = :uid'
+    ), {'uid': user_id}).scalar()
+    return _next_month(last) if last else None
+
+
+def _archive_paths(user_id, since):
+    return [r.path for r in db.session.execute(text("""
+        SELECT path FROM health_archive_months
+        WHERE user_id = :uid AND month >= :first ORDER BY month
+    """), {'uid': user_id, 'first': _month_start(since)})]
+
+
+def _archived_table(paths, metric_name, since, until):
+    pa = _pyarrow()
+    pc = pa.compute
+    tables = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        table = _load(path, os.path.getmtime(path))
+        mask = pc.and_(pc.equal(pc.cast(table['metric_name'], pa.string()), metric_name),
+                       pc.and_(pc.greater_equal(table['local_day'], pa.scalar(since, pa.date32())),
+                               pc.less(table['local_day'], pa.scalar(until, pa.date32()))))
+        tables.append(table.filter(mask))
+    if not tables:
+        return None
+    return pa.concat_tables(tables, promote_options='permissive').combine_chunks()
+
+
+def _daily(pa, table, agg):
+    pc = pa.compute
+    day = table['local_day']
+    if agg == 'sum':
+        grouped = pa.table({'day': day, 'qty': table['qty']}).group_by('day').aggregate(
+            [('qty', 'sum')]).sort_by('day').to_pylist()
+        return [SumDay(g['day'], g['qty_sum']) for g in grouped]
+    if agg == 'hr':
+        # Same weighting as health_retention.WEIGHTED_AVG_SQL
+        value = pc.coalesce(table['avg_val'], table['qty'])
+        weight = pc.cast(pc.coalesce(table['sample_count'], pa.scalar(1, pa.int32())), pa.float64())
+        grouped = pa.table({
+            'day': day,
+            'vw': pc.multiply(value, weight),
+            'w': pc.if_else(pc.is_valid(value), weight, pa.scalar(None, pa.float64())),
+            'lo': pc.coalesce(table['min_val'], table['qty']),
+            'hi': pc.coalesce(table['max_val'], table['qty']),
+        }).group_by('day').aggregate(
+            [('vw', 'sum'), ('w', 'sum'), ('lo', 'min'), ('hi', 'max')]).sort_by('day').to_pylist()
+        return [HrDay(g['day'], g['vw_sum'] / g['w_sum'] if g['w_sum'] else None,
+                      g['lo_min'], g['hi_max']) for g in grouped]
+    if agg == 'latest':
+        # Rows are in date order, so the last one seen per day wins
+        latest = {}
+        for day_, qty in zip(table['local_day'].to_pylist(), table['qty'].to_pylist()):
+            latest[day_] = qty
+        return [LatestDay(d, latest[d]) for d in sorted(latest)]
+    if agg == 'sleep':
+        return [ArchivedSample(ts, json.loads(data)) for ts, data in
+                sorted(zip(table['date'].to_pylist(), table['data'].to_pylist()))]
+    return []
+
+
+def read_archive(user_id, aggs, since_day):
+    """Archived per-day rows for the dashboard aggregates starting at local day since_day.
+
+    aggs maps metric names to their aggregation ('sum', 'hr', 'latest' or
+    'sleep'). Returns (rows, hot_since): rows maps each metric with
+    archived data in [since_day, archive boundary) to rows in the shape of
+    the matching dashboard query, and hot_since is the first local day for
+    the hot queries. Without an archive in range: ({}, since_day).
+    """
+    boundary = archive_boundary(user_id)
+    if boundary is None or since_day >= boundary:
+        return {}, since_day
+    paths = _archive_paths(user_id, since_day)
+    rows = {}
+    for metric_name, agg in aggs.items():
+        table = _archived_table(paths, metric_name, since_day, boundary)
+        if table is not None and table.num_rows:
+            rows[metric_name] = _daily(_pyarrow(), table, agg)
+    return rows, boundary
@@ -0,0 +1,211 @@
+"""Bulk historical backfill of health_metrics via PostgreSQL COPY.
+
+Multi-year exports are far too large for the per-request ingest path.
+CopyMetricLoader streams normalized points into an unlogged staging table
+with COPY and merges each batch into health_metrics with a single
+INSERT ... SELECT ... ON CONFLICT statement. It has the same interface as
+health_ingester.MetricWriter, so a backfill is the normal ingest loop
+(including the single auto-event pass at the end) with this writer
+plugged in. Metrics in HEALTH_PACKED_METRICS are handed to a
+MetricWriter instead, which writes them to their packed day rows.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import time
+from datetime import timezone
+from sqlalchemy import text
+from ..extensions import db
+from .ingest_fingerprints import invalidate_fingerprints
+from .ingest_normalizer import point_data, value_columns_sql
+from .ingest_report import IngestReport
+from .ingest_telemetry import timed
+from .health_packed import packed_metrics
+from .health_rollups import refresh_daily_rollups
+from .health_sync_state import bump_sync_state
+from .user_timezone import local_day, user_timezone
+
+STAGING_TABLE = 'health_metrics_staging'
+
+# Points per COPY + merge round
+COPY_BATCH_SIZE = 50000
+
+
+def ensure_staging_table():
+    """Create the unlogged staging table if needed.
+
+    date is TIMESTAMPTZ and always written with its UTC offset, and the
+    merge converts it with AT TIME ZONE 'UTC', so the stored naive UTC
+    timestamp doesn't depend on the session's timezone.
+    """
+    db.session.execute(text(f"""
+        CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+            seq BIGSERIAL,
+            user_id INTEGER NOT NULL,
+            metric_name VARCHAR(100) NOT NULL,
+            metric_units VARCHAR(50),
+            date TIMESTAMPTZ NOT NULL,
+            data JSON NOT NULL
+        )
+    """))
+
+
+class CopyMetricLoader:
+    """Metric writer that loads points with COPY and merges them set-based."""
+
+    def __init__(self, user_id, batch_size=COPY_BATCH_SIZE, on_flush=None):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.merged = 0
+        self._buf = io.StringIO()
+        self._csv = csv.writer(self._buf, quoting=csv.QUOTE_NONNUMERIC)
+        self._pending = 0
+        self._touched_days = {}
+        self._touched_local_days = {}
+        self.tz = user_timezone(user_id)
+        self.report = IngestReport()
+        self.packed = packed_metrics()
+        self._packed_writer = None
+        ensure_staging_table()
+
+    def add(self, metric_name, metric_units, point):
+        if metric_name in self.packed:
+            if self._packed_writer is None:
+                from .health_ingester import MetricWriter
+                self._packed_writer = MetricWriter(self.user_id, batch_size=self.batch_size)
+            self._packed_writer.add(metric_name, metric_units, point)
+            return
+        ts = point.ts_utc
+        # Naive timestamps are UTC, like everywhere else in ingest
+        utc = ts.astimezone(timezone.utc) if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+        self._csv.writerow([
+            self.user_id, metric_name, metric_units,
+            utc.isoformat(sep=' '), json.dumps(point_data(point)),
+        ])
+        self._touched_days.setdefault(metric_name, set()).add(utc.date())
+        self._touched_local_days.setdefault(metric_name, set()).add(local_day(ts, self.tz))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """COPY the buffered points into staging, merge them and commit."""
+        if not self._pending:
+            return
+        with timed('upsert'):
+            rows = self._load()
+        for metric_name, days in self._touched_days.items():
+            self.report.landed(metric_name, days)
+
+        self.inserted += sum(r.inserted for r in rows)
+        self.updated += sum(r.updated for r in rows)
+        self._buf = io.StringIO()
+        self._csv = csv.writer(self._buf, quoting=csv.QUOTE_NONNUMERIC)
+        self._pending = 0
+        self._touched_days = {}
+        self._touched_local_days = {}
+        if self.on_flush:
+            self.on_flush()
+
+    def _load(self):
+        """COPY the buffer into staging and merge it into health_metrics. Returns per-metric counts."""
+        self._buf.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(
+            f'COPY {STAGING_TABLE} (user_id, metric_name, metric_units, date, data) '
+            f'FROM STDIN WITH (FORMAT csv)',
+            self._buf,
+        )
+        cursor.close()
+
+        # Last staged copy of a point wins, like the per-request upsert
+        rows = db.session.execute(text(f"""
+            WITH merged AS (
+                INSERT INTO health_metrics (user_id, metric_name, metric_units, date, local_day,
+                                            data, qty, avg_val, min_val, max_val, created_at)
+                SELECT DISTINCT ON (metric_name, date AT TIME ZONE 'UTC')
+                       user_id, metric_name, metric_units, date AT TIME ZONE 'UTC',
+                       CAST(timezone(:tz, date) AS date), data,
+                       {value_columns_sql('data')}, NOW()
+                FROM {STAGING_TABLE}
+                WHERE user_id = :uid
+                ORDER BY metric_name, date AT TIME ZONE 'UTC', seq DESC
+                ON CONFLICT ON CONSTRAINT uq_health_metric_point DO UPDATE
+                    SET data = EXCLUDED.data, metric_units = EXCLUDED.metric_units,
+                        local_day = EXCLUDED.local_day,
+                        qty = EXCLUDED.qty, avg_val = EXCLUDED.avg_val,
+                        min_val = EXCLUDED.min_val, max_val = EXCLUDED.max_val,
+                        sample_count = NULL
+                RETURNING metric_name, date, (xmax = 0) AS inserted
+            )
+            SELECT metric_name, MAX(date) AS latest,
+                   COUNT(*) FILTER (WHERE inserted) AS inserted,
+                   COUNT(*) FILTER (WHERE NOT inserted) AS updated
+            FROM merged
+            GROUP BY metric_name
+        """), {'uid': self.user_id, 'tz': self.tz.key}).fetchall()
+        bump_sync_state(self.user_id, {r.metric_name: (r.latest, r.inserted) for r in rows})
+        db.session.execute(text(f'DELETE FROM {STAGING_TABLE} WHERE user_id = :uid'),
+                           {'uid': self.user_id})
+        for metric_name, days in self._touched_days.items():
+            invalidate_fingerprints(self.user_id, metric_name, days)
+        refresh_daily_rollups(self.user_id, self._touched_local_days, self.tz)
+        db.session.commit()
+        return rows
+
+    def close(self):
+        self.flush()
+        writer = self._packed_writer
+        if writer is not None:
+            writer.close()
+            self.inserted += writer.inserted
+            self.updated += writer.updated
+            self.skipped += writer.skipped
+            self.merged += writer.merged
+            self.report.merge(writer.report)
+            self._packed_writer = None
+
+
+def open_export(path):
+    """Open a Health Auto Export JSON file (optionally .gz) for streaming."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def backfill_health_file(path, user_id, batch_size=COPY_BATCH_SIZE, log=print):
+    """Load a Health Auto Export JSON file through the COPY loader. Returns the ingest result."""
+    from .health_ingester import process_health_records
+    from .ingest_stream import iter_stream_records
+    from .ingest_telemetry import track_ingest
+
+    started = time.monotonic()
+
+    def report(points):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        log(f'  {points:,} points in {elapsed:,.1f}s ({points / elapsed:,.0f} rows/s)')
+
+    with track_ingest(user_id, 'backfill', os.path.getsize(path)) as run, \
+            open_export(path) as fp:
+        result = process_health_records(
+            iter_stream_records(fp), user_id, progress=report,
+            writer=CopyMetricLoader(user_id, batch_size=batch_size),
+        )
+
+        # The COPY loader doesn't merge sources; do it over what was loaded
+        from .source_merge import MERGE_METRICS, merge_stored_sources
+        touched = set(result['metrics']) & MERGE_METRICS
+        if touched:
+            result['metricsMerged'] += merge_stored_sources(user_id, touched, log=log)
+        run.result = result
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    result['seconds'] = round(elapsed, 1)
+    result['rowsPerSecond'] = round(result['metricsStored'] / elapsed)
+    return result
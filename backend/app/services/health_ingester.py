@@ -1,169 +1,535 @@
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from datetime import date
+from sqlalchemy import literal_column, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from ..extensions import db
 from ..models.health import HealthMetric, Workout
 from ..models.user import User
+from .ingest_fingerprints import fingerprint_points, get_fingerprint, save_fingerprints
+from .ingest_normalizer import (
+    compile_date_parser, normalize_point, parse_date, point_data, value_columns,
+)
+from .ingest_report import IngestReport
+from .ingest_telemetry import stream_bytes, timed, track_ingest
+from .health_packed import packed_metrics, prune_packed_samples, upsert_packed_points
+from .health_rollups import refresh_daily_rollups
+from .health_sync_state import WORKOUTS_KEY, add_sync_delta, bump_sync_state
+from .source_merge import MERGE_METRICS, merge_sources, source_priority
+from .user_timezone import local_day, user_timezone
 
+# Rows per INSERT ... ON CONFLICT statement
+UPSERT_CHUNK_SIZE = 1000
 
-def parse_date(date_str):
-    """Parse date string from Health Auto Export: '2026-02-09 18:00:00 Z'"""
-    formats = [
-        '%Y-%m-%d %H:%M:%S %z',
-        '%Y-%m-%d %H:%M:%S %Z',
-        '%Y-%m-%d %H:%M:%S',
-        '%Y-%m-%dT%H:%M:%S%z',
-        '%Y-%m-%dT%H:%M:%SZ',
-        '%Y-%m-%d',
-    ]
-    cleaned = date_str.strip()
-    for fmt in formats:
-        try:
-            return datetime.strptime(cleaned, fmt)
-        except ValueError:
-            continue
-    # Fallback: replace ' Z' with '+00:00' for fromisoformat
-    try:
-        return datetime.fromisoformat(cleaned.replace(' Z', '+00:00'))
-    except Exception:
-        raise ValueError(f"Cannot parse date: {date_str}")
+# Metric points buffered before they are handed to the writer
+INGEST_BATCH_SIZE = 5000
 
+# Default thread pool size for process_health_export_parallel
+INGEST_WORKERS = 4
 
-def process_health_export(payload, user_id):
+
+def upsert_metric_points(user_id, points, tz=None):
+    """Bulk upsert health_metrics rows keyed by (user_id, metric_name, date).
+
+    points are (metric_name, metric_units, NormalizedPoint) tuples; local_day
+    is computed in tz (default: the user's timezone). Each
+    chunk is sent as one INSERT ... ON CONFLICT DO UPDATE; duplicate keys
+    inside a chunk are collapsed (last one wins) since Postgres can't touch
+    a row twice per statement. The user's sync-state cursors are bumped in
+    the same transaction. Returns (inserted, updated).
     """
-    Process a Health Auto Export JSON payload.
-    Stores each metric data point and workout as a separate row.
-    Uses upsert to avoid duplicates.
-    After storing, creates auto-events for workouts and mindfulness.
+    table = HealthMetric.__table__
+    tz = tz or user_timezone(user_id)
+    inserted = updated = 0
+    deltas = {}
+    for start in range(0, len(points), UPSERT_CHUNK_SIZE):
+        chunk = {}
+        for metric_name, metric_units, point in points[start:start + UPSERT_CHUNK_SIZE]:
+            chunk[(metric_name, point.ts_utc)] = {
+                'user_id': user_id,
+                'metric_name': metric_name,
+                'metric_units': metric_units,
+                'date': point.ts_utc,
+                'local_day': local_day(point.ts_utc, tz),
+                'data': point_data(point),
+                **value_columns(point),
+            }
+        stmt = pg_insert(table).values(list(chunk.values()))
+        stmt = stmt.on_conflict_do_update(
+            constraint='uq_health_metric_point',
+            set_={
+                'data': stmt.excluded.data,
+                'metric_units': stmt.excluded.metric_units,
+                'local_day': stmt.excluded.local_day,
+                'qty': stmt.excluded.qty,
+                'avg_val': stmt.excluded.avg_val,
+                'min_val': stmt.excluded.min_val,
+                'max_val': stmt.excluded.max_val,
+                # A raw sample landing on a retention rollup's timestamp replaces it
+                'sample_count': None,
+            },
+        ).returning(
+            table.c.metric_name, table.c.date,
+            literal_column('(xmax = 0)').label('inserted'),
+        )
+        for r in db.session.execute(stmt):
+            if r.inserted:
+                inserted += 1
+            else:
+                updated += 1
+            add_sync_delta(deltas, r.metric_name, r.date, r.inserted)
+    bump_sync_state(user_id, deltas)
+    return inserted, updated
+
+
+def prune_merged_rows(user_id, metric_name, dropped):
+    """Delete stored copies of the incoming samples a source merge dropped.
+
+    Rows written before the merge existed (or under another priority) would
+    otherwise keep double-counting next to the merged series. Only the
+    timestamps of the merged run are touched: stored samples the payload
+    didn't carry (delta syncs, partial windows) are left alone.
     """
-    data = payload.get('data', payload)
-    metrics_list = data.get('metrics', [])
-    workouts_list = data.get('workouts', [])
+    deleted = db.session.execute(text("""
+        DELETE FROM health_metrics
+        WHERE user_id = :uid AND metric_name = :name
+          AND date >= :start AND date <= :end
+          AND date = ANY(:dropped)
+    """), {'uid': user_id, 'name': metric_name, 'start': min(dropped), 'end': max(dropped),
+          'dropped': list(dropped)}).rowcount
+    if deleted:
+        bump_sync_state(user_id, {metric_name: (None, -deleted)})
+    return deleted
 
-    metrics_stored = 0
-    workouts_stored = 0
-    events_created = 0
-    errors = []
-    new_workout_ids = []
-    mindful_by_date = {}
 
-    for metric in metrics_list:
+class MetricWriter:
+    """Groups normalized points into metric-day runs and writes them in batches.
+
+    A run is the consecutive points of one (metric_name, day). When a run
+    of a cumulative metric closes, overlapping samples from several devices
+    are merged by source priority (see source_merge) and stored copies of
+    the samples the merge dropped are pruned. Then its content hash is compared with the stored fingerprint: an
+    unchanged day is skipped, otherwise its points are queued and upserted
+    once batch_size points are pending. Metrics in HEALTH_PACKED_METRICS
+    are written to their packed day rows instead (see health_packed).
+    A day that shows up again after
+    another one can't be hashed as a whole, so it is always written and its
+    fingerprint dropped.
+
+    Each batch is written inside a savepoint and committed on its own. If
+    the batch fails it is retried metric by metric, so only the failing
+    metric's points are lost; report records the days that landed and the
+    ones that failed.
+    """
+
+    def __init__(self, user_id, batch_size=INGEST_BATCH_SIZE, on_flush=None):
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self._run_key = None
+        self._run = []
+        self._closed_keys = set()
+        self._pending = []
+        self._fingerprints = {}
+        self._prunes = []
+        self.merged = 0
+        self.source_priority = source_priority(user_id)
+        self.packed = packed_metrics()
+        self.tz = user_timezone(user_id)
+        self.report = IngestReport()
+
+    def add(self, metric_name, metric_units, point):
+        key = (metric_name, point.ts_utc.date())
+        if key != self._run_key:
+            self._close_run()
+            self._run_key = key
+        self._run.append((metric_name, metric_units, point))
+
+    def _close_run(self):
+        run, key = self._run, self._run_key
+        if not run:
+            return
+        self._run = []
+        prune = None
+        if key[0] in MERGE_METRICS:
+            merged, changed = merge_sources(run, self.source_priority)
+            if changed:
+                self.merged += len(run) - len(merged)
+                kept = {p.ts_utc for _, _, p in merged}
+                dropped = sorted({p.ts_utc for _, _, p in run} - kept)
+                if dropped:
+                    prune = (key[0], dropped)
+                run = merged
+        if key in self._closed_keys:
+            self._fingerprints[key] = None
+            self._pending.extend(run)
+            if prune:
+                self._prunes.append(prune)
+        else:
+            self._closed_keys.add(key)
+            digest = fingerprint_points(run)
+            if get_fingerprint(self.user_id, *key) == digest:
+                self.skipped += len(run)
+                self.report.landed(key[0], [key[1]])
+            else:
+                self._fingerprints[key] = (digest, len(run))
+                self._pending.extend(run)
+                if prune:
+                    self._prunes.append(prune)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def _write(self, points, fingerprints, prunes):
+        """Upsert points, prune merged-away rows, refresh the touched days' rollups
+        and save fingerprints in one savepoint."""
+        packed = [p for p in points if p[0] in self.packed]
+        rows = [p for p in points if p[0] not in self.packed] if packed else points
+        with timed('upsert'), db.session.begin_nested():
+            inserted, updated = upsert_metric_points(self.user_id, rows, self.tz)
+            if packed:
+                packed_inserted, packed_updated = upsert_packed_points(self.user_id, packed)
+                inserted += packed_inserted
+                updated += packed_updated
+            for prune in prunes:
+                if prune[0] in self.packed:
+                    prune_packed_samples(self.user_id, *prune)
+                else:
+                    prune_merged_rows(self.user_id, *prune)
+            touched = {}
+            for metric_name, _, point in points:
+                touched.setdefault(metric_name, set()).add(local_day(point.ts_utc, self.tz))
+            for metric_name, dropped in prunes:
+                touched.setdefault(metric_name, set()).update(
+                    local_day(ts, self.tz) for ts in dropped)
+            refresh_daily_rollups(self.user_id, touched, self.tz)
+            save_fingerprints(self.user_id, fingerprints)
+        self.inserted += inserted
+        self.updated += updated
+        for metric_name, days in _days_by_metric(points).items():
+            self.report.landed(metric_name, days)
+
+    def flush(self):
+        """Write queued points and their fingerprints, then commit."""
+        if not self._pending and not self._fingerprints:
+            return
+        try:
+            self._write(self._pending, self._fingerprints, self._prunes)
+        except Exception:
+            # Isolate the bad rows: retry each metric in its own savepoint
+            for metric_name, days in _days_by_metric(self._pending).items():
+                points = [p for p in self._pending if p[0] == metric_name]
+                fingerprints = {k: v for k, v in self._fingerprints.items()
+                                if k[0] == metric_name}
+                prunes = [p for p in self._prunes if p[0] == metric_name]
+                try:
+                    self._write(points, fingerprints, prunes)
+                except Exception as e:
+                    self.report.failed(metric_name, days, str(e))
+        db.session.commit()
+        self._pending = []
+        self._fingerprints = {}
+        self._prunes = []
+        if self.on_flush:
+            self.on_flush()
+
+    def close(self):
+        """Close the open run and write everything still queued."""
+        self._close_run()
+        self.flush()
+
+
+def _days_by_metric(points):
+    days = {}
+    for metric_name, _, point in points:
+        days.setdefault(metric_name, set()).add(point.ts_utc.date())
+    return days
+
+
+def iter_payload_records(payload):
+    """Yield ingest records from an already parsed Health Auto Export payload.
+
+    Records are ('metric', metric_name, metric_units, point) and
+    ('workout', None, None, workout) tuples, the same shape produced by
+    ingest_stream.iter_stream_records.
+    """
+    data = payload.get('data', payload)
+    for metric in data.get('metrics', []):
         metric_name = metric.get('name', 'Unknown')
         metric_units = metric.get('units', '')
-        data_points = metric.get('data', [])
+        for point in metric.get('data', []):
+            yield ('metric', metric_name, metric_units, point)
+    for workout in data.get('workouts', []):
+        yield ('workout', None, None, workout)
+
+
+def process_health_export(payload, user_id, payload_bytes=None):
+    """Process a parsed Health Auto Export JSON payload."""
+    with track_ingest(user_id, 'sync', payload_bytes) as run:
+        run.result = process_health_records(iter_payload_records(payload), user_id)
+    return run.result
+
+
+def process_health_stream(stream, user_id, progress=None, mode='stream'):
+    """Process a Health Auto Export JSON body incrementally from a file-like stream."""
+    from .ingest_stream import iter_stream_records
+    with track_ingest(user_id, mode) as run:
+        try:
+            run.result = process_health_records(iter_stream_records(stream), user_id,
+                                                progress=progress)
+        finally:
+            run.payload_bytes = stream_bytes(stream)
+    return run.result
+
+
+def store_workout(user_id, workout):
+    """Insert or update one exported workout (matched on user, name and start time)."""
+    name = workout.get('name', 'Unknown Workout')
+    start_str = workout.get('start', workout.get('date', ''))
+    end_str = workout.get('end', '')
+    duration = workout.get('duration')
+
+    start_time = parse_date(start_str) if start_str else None
+    end_time = parse_date(end_str) if end_str else None
+    workout_data = {k: v for k, v in workout.items()
+                   if k not in ('name', 'start', 'end')}
+
+    existing = None
+    if start_time:
+        existing = Workout.query.filter_by(
+            user_id=user_id, name=name, start_time=start_time,
+        ).first()
+
+    if existing:
+        existing.data = workout_data
+        existing.duration = duration
+        existing.end_time = end_time
+        return existing
 
-        for point in data_points:
+    w = Workout(
+        user_id=user_id,
+        name=name,
+        start_time=start_time,
+        end_time=end_time,
+        duration=duration,
+        data=workout_data,
+        event_created=False,
+    )
+    db.session.add(w)
+    db.session.flush()
+    bump_sync_state(user_id, {WORKOUTS_KEY: (start_time, 1)})
+    return w
+
+
+class _IngestTally:
+    """Counters and side results collected while storing ingest records."""
+
+    def __init__(self):
+        self.metrics_stored = 0
+        self.workouts_stored = 0
+        self.workouts_failed = 0
+        self.errors = []
+        self.new_workout_ids = []
+        self.mindful_by_date = {}
+
+    def merge(self, other):
+        self.metrics_stored += other.metrics_stored
+        self.workouts_stored += other.workouts_stored
+        self.workouts_failed += other.workouts_failed
+        self.errors.extend(other.errors)
+        self.new_workout_ids.extend(other.new_workout_ids)
+        for day, minutes in other.mindful_by_date.items():
+            self.mindful_by_date[day] = self.mindful_by_date.get(day, 0) + minutes
+
+
+def _store_records(records, user_id, writer, tally):
+    """Normalize and store records through writer, counting into tally."""
+    date_parsers = {}
+    for kind, metric_name, metric_units, item in records:
+        if kind == 'metric':
             try:
-                date_str = point.get('date', '')
+                date_str = item.get('date')
                 if not date_str:
-                    continue
-                parsed_date = parse_date(date_str)
-                data_without_date = {k: v for k, v in point.items() if k != 'date'}
-
-                existing = HealthMetric.query.filter_by(
-                    user_id=user_id,
-                    metric_name=metric_name,
-                    date=parsed_date,
-                ).first()
-
-                if existing:
-                    existing.data = data_without_date
-                    existing.metric_units = metric_units
-                else:
-                    db.session.add(HealthMetric(
-                        user_id=user_id,
-                        metric_name=metric_name,
-                        metric_units=metric_units,
-                        date=parsed_date,
-                        data=data_without_date,
-                    ))
-                metrics_stored += 1
+                    raise ValueError('missing date')
+                parse = date_parsers.get(metric_name)
+                if parse is None:
+                    parse = date_parsers[metric_name] = compile_date_parser(date_str)
+                point = normalize_point(item, parse)
+            except Exception as e:
+                # Never reaches the writer, so it has no day to report as failed
+                writer.report.rejected(metric_name, str(e))
+                tally.errors.append(f"Metric {metric_name}: {str(e)}")
+                continue
+            try:
+                writer.add(metric_name, metric_units, point)
+                tally.metrics_stored += 1
 
                 # Track mindfulness minutes by date
                 if metric_name in ('mindful_minutes', 'apple_exercise_time') and \
                         metric_name == 'mindful_minutes':
-                    qty = data_without_date.get('qty', 0)
-                    if qty:
-                        day = parsed_date.date()
-                        mindful_by_date[day] = mindful_by_date.get(day, 0) + float(qty)
+                    if point.qty:
+                        # Day as the exporter saw it (local date prefix), not the UTC day
+                        day = date.fromisoformat(date_str.strip()[:10])
+                        tally.mindful_by_date[day] = tally.mindful_by_date.get(day, 0) + point.qty
 
             except Exception as e:
-                errors.append(f"Metric {metric_name}: {str(e)}")
+                tally.errors.append(f"Metric {metric_name}: {str(e)}")
+            continue
 
-    for workout in workouts_list:
         try:
-            name = workout.get('name', 'Unknown Workout')
-            start_str = workout.get('start', workout.get('date', ''))
-            end_str = workout.get('end', '')
-            duration = workout.get('duration')
-
-            start_time = parse_date(start_str) if start_str else None
-            end_time = parse_date(end_str) if end_str else None
-            workout_data = {k: v for k, v in workout.items()
-                           if k not in ('name', 'start', 'end')}
-
-            existing = None
-            if start_time:
-                existing = Workout.query.filter_by(
-                    user_id=user_id, name=name, start_time=start_time,
-                ).first()
-
-            if existing:
-                existing.data = workout_data
-                existing.duration = duration
-                existing.end_time = end_time
-                # If existing workout never created an event, include it
-                if not existing.event_created:
-                    new_workout_ids.append(existing.id)
-            else:
-                w = Workout(
-                    user_id=user_id,
-                    name=name,
-                    start_time=start_time,
-                    end_time=end_time,
-                    duration=duration,
-                    data=workout_data,
-                    event_created=False,
-                )
-                db.session.add(w)
-                db.session.flush()
-                new_workout_ids.append(w.id)
-            workouts_stored += 1
+            with db.session.begin_nested():
+                w = store_workout(user_id, item)
+            # New workouts, and existing ones that never created an event
+            if not w.event_created:
+                tally.new_workout_ids.append(w.id)
+            tally.workouts_stored += 1
         except Exception as e:
-            errors.append(f"Workout: {str(e)}")
+            tally.workouts_failed += 1
+            tally.errors.append(f"Workout: {str(e)}")
 
-    db.session.commit()
+
+def _create_auto_events(user_id, tally):
+    """Create auto-events for the run's workouts and mindfulness, one batch each."""
+    events_created = 0
+    errors = tally.errors
 
     # Auto-create events for new workouts
     try:
-        from .auto_events import create_event_for_workout
-        user = User.query.get(user_id)
-        if user and new_workout_ids:
-            for wid in new_workout_ids:
-                workout = Workout.query.get(wid)
-                if workout and not workout.event_created:
-                    event = create_event_for_workout(workout, user)
-                    if event:
-                        events_created += 1
+        from .auto_events import create_events_for_workouts
+        if tally.new_workout_ids and User.query.get(user_id):
+            workouts = Workout.query.filter(
+                Workout.id.in_(tally.new_workout_ids), Workout.event_created.is_(False),
+            ).all()
+            events_created += create_events_for_workouts(workouts)
             db.session.commit()
     except Exception as e:
+        db.session.rollback()
         errors.append(f"Auto-event workout: {str(e)}")
 
     # Auto-create events for mindfulness
     try:
-        from .auto_events import create_event_for_mindfulness
-        for day, minutes in mindful_by_date.items():
-            if minutes >= 1:
-                event = create_event_for_mindfulness(user_id, minutes, day)
-                if event:
-                    events_created += 1
-        if mindful_by_date:
+        from .auto_events import create_events_for_mindfulness
+        if tally.mindful_by_date:
+            events_created += create_events_for_mindfulness(user_id, tally.mindful_by_date)
             db.session.commit()
     except Exception as e:
+        db.session.rollback()
         errors.append(f"Auto-event mindfulness: {str(e)}")
 
+    return events_created
+
+
+def _finish_ingest(user_id, tally, writers):
+    """Create auto-events in one batch each and build the ingest result."""
+    with timed('events'):
+        events_created = _create_auto_events(user_id, tally)
+    errors = tally.errors
+
+    report = IngestReport()
+    for writer in writers:
+        report.merge(writer.report)
+    partial = report.has_failures or tally.workouts_failed
     return {
-        'status': 'ok',
-        'metricsStored': metrics_stored,
-        'workoutsStored': workouts_stored,
+        'status': 'partial' if partial else 'ok',
+        'metricsStored': tally.metrics_stored,
+        'metricsInserted': sum(w.inserted for w in writers),
+        'metricsUpdated': sum(w.updated for w in writers),
+        'metricsSkipped': sum(w.skipped for w in writers),
+        'metricsMerged': sum(w.merged for w in writers),
+        'metricsRejected': report.rejected_count,
+        'workoutsStored': tally.workouts_stored,
+        'workoutsFailed': tally.workouts_failed,
         'eventsCreated': events_created,
+        'metrics': report.to_dict(),
         'errors': errors if errors else None,
     }
+
+
+def process_health_records(records, user_id, batch_size=INGEST_BATCH_SIZE, progress=None,
+                           writer=None):
+    """
+    Store ingest records (see iter_payload_records).
+    Stores each metric data point and workout as a separate row.
+    Metric points go through MetricWriter: metric-days identical to what
+    was stored last time are skipped, the rest are bulk upserted on
+    (user_id, metric_name, date) in batches of batch_size, so memory stays
+    bounded for streamed payloads. Another writer with the same interface
+    (add/close, the inserted/updated/skipped counters and report) can be
+    passed in, e.g. the COPY loader used by backfills.
+    Batches and workouts are committed as they go, so a failure only loses
+    its own chunk; the result's 'metrics' lists landed and failed day
+    ranges per metric and status is 'partial' if anything failed.
+    progress(points_seen) is called after every written batch.
+    After storing, creates auto-events for workouts and mindfulness in one
+    batch each.
+    """
+    tally = _IngestTally()
+
+    def report_progress():
+        if progress:
+            progress(tally.metrics_stored + tally.workouts_stored)
+
+    if writer is None:
+        writer = MetricWriter(user_id, batch_size=batch_size)
+    writer.on_flush = report_progress
+
+    _store_records(records, user_id, writer, tally)
+    writer.close()
+    db.session.commit()
+
+    return _finish_ingest(user_id, tally, [writer])
+
+
+def process_health_export_parallel(payload, user_id, app, workers=INGEST_WORKERS,
+                                   payload_bytes=None):
+    """Like process_health_export, but metrics are written by a thread pool.
+
+    Metrics never share a (user_id, metric_name, date) key, so the payload
+    is sharded by metric_name and each shard runs in its own app context,
+    i.e. its own session and pooled connection. Workouts and auto-events
+    are handled afterwards in the caller's session, and the shard counters
+    are merged into the usual result.
+    """
+    with track_ingest(user_id, 'parallel', payload_bytes) as run:
+        run.result = _ingest_parallel(payload, user_id, app, workers)
+    return run.result
+
+
+def _ingest_parallel(payload, user_id, app, workers):
+    data = payload.get('data', payload)
+    shards = {}
+    for metric in data.get('metrics', []):
+        shards.setdefault(metric.get('name', 'Unknown'), []).append(metric)
+    # Biggest shards first so one large metric doesn't start last
+    ordered = sorted(shards.values(), key=lambda ms: -sum(len(m.get('data', [])) for m in ms))
+
+    def run_shard(metrics):
+        with app.app_context():
+            tally = _IngestTally()
+            writer = MetricWriter(user_id)
+            records = (
+                ('metric', m.get('name', 'Unknown'), m.get('units', ''), point)
+                for m in metrics for point in m.get('data', [])
+            )
+            _store_records(records, user_id, writer, tally)
+            writer.close()
+            db.session.commit()
+            return tally, writer
+
+    tally = _IngestTally()
+    writers = []
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Each shard gets a copy of this context so its phase timings reach the run
+        futures = [pool.submit(copy_context().run, run_shard, metrics) for metrics in ordered]
+        for future in futures:
+            shard_tally, writer = future.result()
+            tally.merge(shard_tally)
+            writers.append(writer)
+
+    workouts = (('workout', None, None, w) for w in data.get('workouts', []))
+    _store_records(workouts, user_id, None, tally)
+    db.session.commit()
+
+    return _finish_ingest(user_id, tally, writers)
@@ -0,0 +1,296 @@
+"""Array-packed day rows for dense metrics (health_metric_days).
+
+A heart_rate or blood_oxygen_saturation series has thousands of samples a day, and in
+health_metrics each one is a row with its own JSON blob, tuple header and
+index entries. Metrics listed in HEALTH_PACKED_METRICS are instead written
+as one health_metric_days row per (user, metric, UTC day) holding parallel
+arrays sorted by offset: seconds since midnight, qty, Avg, Min and Max.
+
+MetricWriter sends packed metrics' points to upsert_packed_points, which
+merges them into the day's arrays (a sample at an existing offset replaces
+it) under a row lock, and deletes health_metrics rows at the same
+timestamps so a resend of days stored before the metric was packed isn't
+counted twice. Only the values are kept: a packed sample has no 'data'
+extras such as the source. The COPY loader hands packed metrics to a
+MetricWriter, so backfills and export.xml imports land in the same place.
+
+A packed metric can still have rows in health_metrics: written before it
+was packed, or as retention rollups. The daily rollups are computed from both through
+STORED_SAMPLES_SQL, and today's sums add packed_range_sum. `flask pack-health-metrics` moves a metric's raw rows
+over.
+
+Source-merged metrics (source_merge.MERGE_METRICS) are never packed, even
+when listed: MetricWriter merges sources within one run, export.xml lists
+each device's records as separate runs, and a packed sample has no source
+left for merge_stored_sources to rank, so Watch and iPhone samples would
+add up.
+"""
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..extensions import db
+from ..models.health import HealthMetricDay
+from .health_sync_state import add_sync_delta, bump_sync_state
+from .ingest_normalizer import NormalizedPoint
+from .source_merge import MERGE_METRICS
+from .user_timezone import LOCAL_DAY_SQL, local_day, user_timezone
+
+# health_metrics rows moved per user, metric and window by pack_metric
+PACK_WINDOW = timedelta(days=7)
+
+
+def packed_metrics():
+    """Metric names stored in health_metric_days (HEALTH_PACKED_METRICS minus MERGE_METRICS)."""
+    return frozenset(current_app.config.get('HEALTH_PACKED_METRICS') or ()) - MERGE_METRICS
+
+
+def _utc(ts):
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo else ts
+
+
+def _midnight(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _locked_days(user_id, keys):
+    """{(metric_name, day): {offset: (qty, avg, min, max)}} for stored days, locked for update."""
+    rows = db.session.execute(text("""
+        SELECT metric_name, day, offsets, qty, avg, min, max FROM health_metric_days
+        WHERE user_id = :uid AND metric_name = ANY(:names) AND day = ANY(:days)
+        FOR UPDATE
+    """), {'uid': user_id, 'names': list({k[0] for k in keys}),
+           'days': list({k[1] for k in keys})}).fetchall()
+    return {
+        (r.metric_name, r.day): dict(zip(r.offsets, zip(r.qty, r.avg, r.min, r.max)))
+        for r in rows if (r.metric_name, r.day) in keys
+    }
+
+
+def _write_days(user_id, days, units):
+    """Upsert whole days from {(metric_name, day): {offset: values}}."""
+    rows = []
+    for (metric_name, day), samples in days.items():
+        offsets = sorted(samples)
+        values = [samples[o] for o in offsets]
+        rows.append({
+            'user_id': user_id, 'metric_name': metric_name, 'day': day,
+            'metric_units': units.get(metric_name),
+            'offsets': offsets,
+            'qty': [v[0] for v in values],
+            'avg': [v[1] for v in values],
+            'min': [v[2] for v in values],
+            'max': [v[3] for v in values],
+            'updated_at': datetime.now(timezone.utc),
+        })
+    if not rows:
+        return
+    stmt = pg_insert(HealthMetricDay.__table__).values(rows)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'metric_name', 'day'],
+        set_={col: stmt.excluded[col] for col in
+              ('metric_units', 'offsets', 'qty', 'avg', 'min', 'max', 'updated_at')},
+    ))
+
+
+def upsert_packed_points(user_id, points):
+    """Merge (metric_name, metric_units, NormalizedPoint) tuples into their day rows.
+
+    health_metrics rows at the same timestamps are replaced by the packed
+    samples. Bumps the user's sync-state like upsert_metric_points. Returns
+    (inserted, updated) sample counts.
+    """
+    incoming = {}
+    units = {}
+    for metric_name, metric_units, point in points:
+        ts = _utc(point.ts_utc)
+        offset = int((ts - _midnight(ts.date())).total_seconds())
+        incoming.setdefault((metric_name, ts.date()), {})[offset] = (
+            point.qty, point.avg, point.min, point.max)
+        units[metric_name] = metric_units
+    if not incoming:
+        return 0, 0
+
+    stored = _locked_days(user_id, set(incoming))
+    inserted = updated = 0
+    deltas = {}
+    for key, samples in incoming.items():
+        day_samples = stored.setdefault(key, {})
+        for offset in samples:
+            is_new = offset not in day_samples
+            if is_new:
+                inserted += 1
+            else:
+                updated += 1
+            add_sync_delta(deltas, key[0], _midnight(key[1]) + timedelta(seconds=offset), is_new)
+        day_samples.update(samples)
+    _write_days(user_id, {k: stored[k] for k in incoming}, units)
+    stamps = [_midnight(day) + timedelta(seconds=offset)
+              for (_, day), samples in incoming.items() for offset in samples]
+    for r in db.session.execute(text("""
+        DELETE FROM health_metrics
+        WHERE user_id = :uid AND metric_name = ANY(:names)
+          AND date >= :first AND date <= :last AND date = ANY(:stamps)
+        RETURNING metric_name
+    """), {'uid': user_id, 'names': list(units), 'first': min(stamps), 'last': max(stamps),
+           'stamps': stamps}):
+        # The sample moved into the packed row rather than being new
+        latest, count = deltas[r.metric_name]
+        deltas[r.metric_name] = (latest, count - 1)
+    bump_sync_state(user_id, deltas)
+    return inserted, updated
+
+
+def prune_packed_samples(user_id, metric_name, dropped):
+    """Packed counterpart of health_ingester.prune_merged_rows."""
+    offsets = {}
+    for ts in dropped:
+        ts = _utc(ts)
+        offsets.setdefault((metric_name, ts.date()), set()).add(
+            int((ts - _midnight(ts.date())).total_seconds()))
+    stored = _locked_days(user_id, set(offsets))
+    changed = {}
+    removed = 0
+    for key, samples in stored.items():
+        gone = offsets[key] & samples.keys()
+        for offset in gone:
+            del samples[offset]
+        if gone:
+            changed[key] = samples
+            removed += len(gone)
+    if changed:
+        units = {r.metric_name: r.metric_units for r in db.session.execute(text(
+            'SELECT metric_name, metric_units FROM health_metric_days '
+            'WHERE user_id = :uid AND metric_name = :name AND day = ANY(:days)'
+        ), {'uid': user_id, 'name': metric_name, 'days': [k[1] for k in changed]})}
+        _write_days(user_id, changed, units)
+        bump_sync_state(user_id, {metric_name: (None, -removed)})
+    return removed
+
+
+def move_packed_days(from_id, to_id):
+    """Give from_id's packed day rows to to_id. Returns the number of day rows moved.
+
+    A day both users have is merged into to_id's row; at an offset both
+    hold, to_id's sample is kept.
+    """
+    shared = db.session.execute(text("""
+        SELECT s.metric_name, s.day, s.metric_units FROM health_metric_days s
+        JOIN health_metric_days d
+          ON d.user_id = :to_id AND d.metric_name = s.metric_name AND d.day = s.day
+        WHERE s.user_id = :from_id
+    """), {'from_id': from_id, 'to_id': to_id}).fetchall()
+    if shared:
+        keys = {(r.metric_name, r.day) for r in shared}
+        source = _locked_days(from_id, keys)
+        target = _locked_days(to_id, keys)
+        _write_days(to_id, {k: {**source.get(k, {}), **target[k]} for k in target},
+                    {r.metric_name: r.metric_units for r in shared})
+        db.session.execute(text("""
+            DELETE FROM health_metric_days
+            WHERE user_id = :from_id AND (metric_name, day) IN (
+                SELECT metric_name, day FROM health_metric_days WHERE user_id = :to_id)
+        """), {'from_id': from_id, 'to_id': to_id})
+    moved = db.session.execute(text(
+        'UPDATE health_metric_days SET user_id = :to_id WHERE user_id = :from_id'
+    ), {'from_id': from_id, 'to_id': to_id}).rowcount
+    return moved + len(shared)
+
+
+# One row per packed sample of a user's metric in [:since, :until). The day
+# bound only narrows the rows unnested; a day of slack covers a tz-aware :since.
+# {local_day} is an optional extra column
+_PACKED_SAMPLES_SQL = """
+    SELECT d.day + make_interval(secs => s.off) AS date, {local_day}
+           s.qty, s.avg_val, s.min_val, s.max_val, CAST(NULL AS INTEGER) AS sample_count
+    FROM health_metric_days d,
+         unnest(d.offsets, d.qty, d.avg, d.min, d.max) AS s(off, qty, avg_val, min_val, max_val)
+    WHERE d.user_id = :uid AND d.metric_name = :name
+      AND d.day >= CAST(:since AS date) - 1 AND d.day < :until
+      AND d.day + make_interval(secs => s.off) >= :since
+      AND d.day + make_interval(secs => s.off) < :until
+"""
+
+# :until for ranges that are open at the end
+OPEN_UNTIL = datetime(9999, 1, 1)
+
+# health_metrics rows plus packed samples of one user's metric in
+# [:since, :until), for aggregates: (date, local_day, qty, avg_val, min_val,
+# max_val, sample_count), local_day in the :tz zone. Packed samples weigh 1
+# in WEIGHTED_AVG_SQL, like raw rows.
+STORED_SAMPLES_SQL = f"""(
+    SELECT date, COALESCE(local_day, {LOCAL_DAY_SQL.format(column='date')}) AS local_day,
+           qty, avg_val, min_val, max_val, sample_count
+    FROM health_metrics
+    WHERE user_id = :uid AND metric_name = :name AND date >= :since AND date < :until
+    UNION ALL
+    {_PACKED_SAMPLES_SQL.format(local_day=LOCAL_DAY_SQL.format(
+        column='d.day + make_interval(secs => s.off)') + ' AS local_day,')}
+)"""
+
+
+def packed_range_sum(user_id, metric_name, since, until):
+    """SUM(qty) of a user's packed samples in [since, until), or None."""
+    sql = _PACKED_SAMPLES_SQL.format(local_day='')
+    return db.session.execute(text(f'SELECT SUM(qty) FROM ({sql}) s'), {
+        'uid': user_id, 'name': metric_name, 'since': _utc(since), 'until': _utc(until),
+    }).scalar()
+
+
+def pack_metric(user_id, metric_name, log=None):
+    """Move a user's raw health_metrics rows of metric_name into packed day rows.
+
+    Retention rollups (sample_count set) stay in health_metrics, where the
+    readers still weight them. Returns rows moved.
+    """
+    first = db.session.execute(text("""
+        SELECT MIN(date) FROM health_metrics
+        WHERE user_id = :uid AND metric_name = :name AND sample_count IS NULL
+    """), {'uid': user_id, 'name': metric_name}).scalar()
+    if first is None:
+        return 0
+    moved = 0
+    tz = user_timezone(user_id)
+    start = _midnight(first.date())
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    while start <= now:
+        params = {'uid': user_id, 'name': metric_name, 'start': start, 'end': start + PACK_WINDOW}
+        rows = db.session.execute(text("""
+            DELETE FROM health_metrics
+            WHERE user_id = :uid AND metric_name = :name AND sample_count IS NULL
+              AND date >= :start AND date < :end
+            RETURNING metric_units, date, qty, avg_val, min_val, max_val
+        """), params).fetchall()
+        if rows:
+            # The samples move, so health_sync_state's count stays as it is
+            upsert_packed_points(user_id, [
+                (metric_name, r.metric_units,
+                 NormalizedPoint(r.date, r.qty, r.avg_val, r.min_val, r.max_val, {}))
+                for r in rows
+            ])
+            bump_sync_state(user_id, {metric_name: (None, -len(rows))})
+            from .health_rollups import refresh_daily_rollups
+            refresh_daily_rollups(user_id, {metric_name: {local_day(r.date, tz) for r in rows}}, tz)
+        db.session.commit()
+        moved += len(rows)
+        if log and rows:
+            log(f'  {metric_name} {start:%Y-%m-%d}: {len(rows):,} rows packed')
+        start += PACK_WINDOW
+    return moved
+
+
+def pack_health_metrics(metric_names, user_id=None, log=None):
+    """pack_metric for every user (or one user) and each of metric_names. Returns rows moved."""
+    if user_id is None:
+        user_ids = [r.id for r in db.session.execute(text('SELECT id FROM users'))]
+    else:
+        user_ids = [user_id]
+    skipped = [name for name in metric_names if name in MERGE_METRICS]
+    if skipped and log:
+        log(f"Not packing source-merged metrics: {', '.join(skipped)}")
+    metric_names = [name for name in metric_names if name not in MERGE_METRICS]
+    moved = 0
+    for uid in user_ids:
+        for metric_name in metric_names:
+            moved += pack_metric(uid, metric_name, log)
+    return moved
@@ -0,0 +1,283 @@
+"""Monthly range partitioning of health_metrics on date.
+
+health_metrics is partitioned BY RANGE (date) into one table per calendar
+month (health_metrics_y2026m03) plus a DEFAULT partition that catches rows
+outside every month created so far, so an ingest never fails for lack of
+a partition. Queries bounded by date (date >= :since) only touch the
+months they cover, and retention drops whole months instead of deleting
+rows.
+
+`flask partition-health-metrics` converts an existing plain table: the
+partitioned table is built as health_metrics_partitioned (reusing the id
+sequence) and filled in id batches while the plain table stays live.
+Then, with writers locked out, it catches up with what changed during the
+copy and both tables are renamed in one transaction: the plain one
+becomes health_metrics_legacy. `flask ensure-health-partitions`
+pre-creates the coming months and should run from cron; a month whose
+rows already landed in the DEFAULT partition has them moved into the new
+partition as it is attached. `flask drop-health-partitions --before YYYY-MM` is retention.
+"""
+from datetime import date
+from sqlalchemy import text
+from ..extensions import db
+
+PARENT_TABLE = 'health_metrics'
+LEGACY_TABLE = 'health_metrics_legacy'
+BUILD_TABLE = 'health_metrics_partitioned'
+DEFAULT_PARTITION = 'health_metrics_default'
+
+# Months created ahead of the current one by ensure_partitions
+PARTITION_MONTHS_AHEAD = 3
+
+# Rows copied per transaction when converting the legacy table
+MIGRATE_BATCH_SIZE = 50000
+
+_COLUMNS = ('id, user_id, metric_name, metric_units, date, local_day, data, '
+            'qty, avg_val, min_val, max_val, sample_count, created_at')
+
+# Columns an upsert can change, compared when catching up before the swap
+_MUTABLE = ('metric_units', 'local_day', 'data', 'qty', 'avg_val', 'min_val', 'max_val',
+            'sample_count')
+
+# Parent-level constraints and indexes, renamed along with the tables
+_CONSTRAINTS = ('health_metrics_pkey', 'uq_health_metric_point')
+_INDEXES = ('idx_health_metrics_name_date', 'idx_health_metrics_user',
+            'idx_health_metrics_user_name_date', 'idx_health_metrics_user_name_local_day')
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def next_month(month):
+    return date(month.year + (month.month == 12), month.month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f'{PARENT_TABLE}_y{month.year:04d}m{month.month:02d}'
+
+
+def is_partitioned(conn, table=PARENT_TABLE):
+    return conn.execute(text("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :name AND pg_table_is_visible(c.oid)
+    """), {'name': table}).fetchone() is not None
+
+
+def month_partitions(conn, parent=PARENT_TABLE):
+    """{month: partition name} for the monthly partitions that exist."""
+    rows = conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :name
+    """), {'name': parent}).fetchall()
+    months = {}
+    for (name,) in rows:
+        suffix = name[len(PARENT_TABLE) + 1:]
+        if len(suffix) == 8 and suffix[0] == 'y' and suffix[5] == 'm':
+            months[date(int(suffix[1:5]), int(suffix[6:8]), 1)] = name
+    return months
+
+
+def create_month_partition(conn, month, parent=PARENT_TABLE):
+    """Create and attach the partition for one month.
+
+    Rows for that month already sitting in the DEFAULT partition are moved
+    into it first; Postgres refuses to attach a range the DEFAULT
+    partition still holds rows for. The parent is locked against writes
+    for the move and the attach, so no row for the month can land in
+    DEFAULT in between.
+    """
+    name = partition_name(month)
+    bounds = {'lo': month, 'hi': next_month(month)}
+    conn.execute(text(f'LOCK TABLE {parent} IN SHARE ROW EXCLUSIVE MODE'))
+    conn.execute(text(
+        f'CREATE TABLE IF NOT EXISTS {name} '
+        f'(LIKE {parent} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)'
+    ))
+    conn.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE date >= :lo AND date < :hi
+            RETURNING {_COLUMNS}
+        )
+        INSERT INTO {name} ({_COLUMNS}) SELECT {_COLUMNS} FROM moved
+    """), bounds)
+    conn.execute(text(
+        f"ALTER TABLE {parent} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{bounds['lo']}') TO ('{bounds['hi']}')"
+    ))
+    return name
+
+
+def ensure_partitions(conn, first=None, months_ahead=PARTITION_MONTHS_AHEAD,
+                      parent=PARENT_TABLE):
+    """Create missing monthly partitions from first (default: this month) through
+    months_ahead months from now. Returns the names created."""
+    existing = month_partitions(conn, parent)
+    month = month_start(first or date.today())
+    last = month_start(date.today())
+    for _ in range(months_ahead):
+        last = next_month(last)
+    created = []
+    while month <= last:
+        if month not in existing:
+            created.append(create_month_partition(conn, month, parent))
+            conn.commit()
+        month = next_month(month)
+    return created
+
+
+def drop_partitions_before(conn, cutoff):
+    """Detach and drop every monthly partition that ends on or before cutoff's month.
+
+    Returns the months dropped. Fingerprints for those days are forgotten
+    so a later re-ingest writes them again; the caller rebuilds sync-state.
+    """
+    cutoff = month_start(cutoff)
+    dropped = []
+    for month, name in sorted(month_partitions(conn).items()):
+        if month >= cutoff:
+            continue
+        conn.execute(text(f'ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}'))
+        conn.execute(text(f'DROP TABLE {name}'))
+        conn.commit()
+        dropped.append(month)
+    if dropped:
+        conn.execute(text('DELETE FROM health_metric_fingerprints WHERE day < :cutoff'),
+                     {'cutoff': cutoff})
+        conn.commit()
+    return dropped
+
+
+def _create_parent(conn):
+    """Create the partitioned table (as BUILD_TABLE) and its DEFAULT partition.
+
+    The primary key has to include the partition key, hence (id, date);
+    uq_health_metric_point already does. Constraint and index names get a
+    _build suffix until the swap.
+    """
+    conn.execute(text(f"""
+        CREATE TABLE {BUILD_TABLE} (
+            id INTEGER NOT NULL DEFAULT nextval('health_metrics_id_seq'),
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            metric_name VARCHAR(100) NOT NULL,
+            metric_units VARCHAR(50),
+            date TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            local_day DATE,
+            data JSON NOT NULL,
+            qty FLOAT,
+            avg_val FLOAT,
+            min_val FLOAT,
+            max_val FLOAT,
+            sample_count INTEGER,
+            created_at TIMESTAMP WITHOUT TIME ZONE,
+            CONSTRAINT health_metrics_pkey_build PRIMARY KEY (id, date),
+            CONSTRAINT uq_health_metric_point_build UNIQUE (user_id, metric_name, date)
+        ) PARTITION BY RANGE (date)
+    """))
+    conn.execute(text(
+        f'CREATE INDEX idx_health_metrics_name_date_build ON {BUILD_TABLE} (metric_name, date)'
+    ))
+    conn.execute(text(
+        f'CREATE INDEX idx_health_metrics_user_name_date_build ON {BUILD_TABLE} '
+        f'(user_id, metric_name, date) INCLUDE (qty, avg_val, min_val, max_val, sample_count)'
+    ))
+    conn.execute(text(
+        f'CREATE INDEX idx_health_metrics_user_name_local_day_build ON {BUILD_TABLE} '
+        f'(user_id, metric_name, local_day)'
+    ))
+    conn.execute(text(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {BUILD_TABLE} DEFAULT'))
+
+
+def _catch_up(conn):
+    """Apply what changed in the plain table during the copy. Returns (inserted, updated, deleted).
+
+    The caller holds a lock that keeps writers out of the plain table.
+    """
+    same_row = 'o.id = b.id AND o.date = b.date'
+    deleted = conn.execute(text(f"""
+        DELETE FROM {BUILD_TABLE} b
+        WHERE NOT EXISTS (SELECT 1 FROM {PARENT_TABLE} o WHERE {same_row})
+    """)).rowcount
+    # JSON has no equality operator, so data is compared as text
+    old = ', '.join(f'o.{c}::text' if c == 'data' else f'o.{c}' for c in _MUTABLE)
+    new = ', '.join(f'b.{c}::text' if c == 'data' else f'b.{c}' for c in _MUTABLE)
+    updated = conn.execute(text(f"""
+        UPDATE {BUILD_TABLE} b SET {', '.join(f'{c} = o.{c}' for c in _MUTABLE)}
+        FROM {PARENT_TABLE} o
+        WHERE {same_row} AND ROW({old}) IS DISTINCT FROM ROW({new})
+    """)).rowcount
+    inserted = conn.execute(text(f"""
+        INSERT INTO {BUILD_TABLE} ({_COLUMNS})
+        SELECT {_COLUMNS} FROM {PARENT_TABLE} o
+        WHERE NOT EXISTS (SELECT 1 FROM {BUILD_TABLE} b WHERE {same_row})
+    """)).rowcount
+    return inserted, updated, deleted
+
+
+def _swap(conn):
+    """Rename the plain table to LEGACY_TABLE and the built one into its place."""
+    conn.execute(text(f'ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}'))
+    conn.execute(text(f'ALTER TABLE {BUILD_TABLE} RENAME TO {PARENT_TABLE}'))
+    for constraint in _CONSTRAINTS:
+        conn.execute(text(f'ALTER TABLE {LEGACY_TABLE} RENAME CONSTRAINT {constraint} '
+                          f'TO {constraint}_legacy'))
+        conn.execute(text(f'ALTER TABLE {PARENT_TABLE} RENAME CONSTRAINT {constraint}_build '
+                          f'TO {constraint}'))
+    for index in _INDEXES:
+        conn.execute(text(f'ALTER INDEX IF EXISTS {index} RENAME TO {index}_legacy'))
+        conn.execute(text(f'ALTER INDEX IF EXISTS {index}_build RENAME TO {index}'))
+    conn.execute(text(f'ALTER SEQUENCE health_metrics_id_seq OWNED BY {PARENT_TABLE}.id'))
+
+
+def partition_health_metrics(batch_size=MIGRATE_BATCH_SIZE, log=print):
+    """Convert a plain health_metrics into the monthly partitioned layout.
+
+    Readers and writers keep using the plain table while BUILD_TABLE is
+    filled. Writers are then blocked (readers are not) while the changes
+    made during the copy are applied, and the tables are swapped in the
+    same transaction. Safe to re-run: the copy resumes after the highest
+    id already present in BUILD_TABLE. Returns rows copied.
+    """
+    with db.engine.connect() as conn:
+        if is_partitioned(conn):
+            ensure_partitions(conn)
+            return 0
+
+        build = conn.execute(text('SELECT to_regclass(:name)'), {'name': BUILD_TABLE}).scalar()
+        if build is None:
+            _create_parent(conn)
+            conn.commit()
+            log(f'Created {BUILD_TABLE}; {PARENT_TABLE} stays in use until the copy is done.')
+
+        bounds = conn.execute(text(
+            f'SELECT MIN(date) AS first, MAX(id) AS last_id FROM {PARENT_TABLE}'
+        )).fetchone()
+        created = ensure_partitions(conn, bounds.first, parent=BUILD_TABLE)
+        log(f'  {len(created)} monthly partitions created')
+
+        after = conn.execute(text(
+            f'SELECT COALESCE(MAX(id), 0) FROM {BUILD_TABLE} WHERE id <= :last'
+        ), {'last': bounds.last_id or 0}).scalar()
+        copied = 0
+        while bounds.last_id and after < bounds.last_id:
+            copied += conn.execute(text(f"""
+                INSERT INTO {BUILD_TABLE} ({_COLUMNS})
+                SELECT {_COLUMNS} FROM {PARENT_TABLE}
+                WHERE id > :after AND id <= :upto
+                ON CONFLICT ON CONSTRAINT uq_health_metric_point_build DO NOTHING
+            """), {'after': after, 'upto': after + batch_size}).rowcount
+            conn.commit()
+            after += batch_size
+            log(f'  {copied:,} rows copied')
+
+        # EXCLUSIVE still lets the dashboard read the plain table
+        conn.execute(text(f'LOCK TABLE {PARENT_TABLE} IN EXCLUSIVE MODE'))
+        inserted, updated, deleted = _catch_up(conn)
+        _swap(conn)
+        conn.commit()
+        log(f'  caught up: {inserted:,} inserted, {updated:,} updated, {deleted:,} deleted; '
+            f'old table kept as {LEGACY_TABLE}')
+        return copied + inserted
@@ -0,0 +1,154 @@
+"""Retention: compact old raw samples into per-hour (or per-minute) rollups.
+
+heart_rate arrives as a sample every few seconds to minutes, but past the
+first weeks it is only ever charted as daily Avg/Min/Max. compact_metric
+replaces the raw rows of each bucket older than the retention window
+with a single health_metrics row at the bucket start holding the
+bucket's Avg/Min/Max (avg_val/min_val/max_val) and the number of samples
+behind it (sample_count; NULL on raw rows).
+
+The 'hr' aggregates weight each row's average by COALESCE(sample_count, 1)
+and take MIN/MAX over min_val/max_val, so daily values are the same
+before and after compaction. Those aggregates group by local_day, so
+buckets are the user's local hours (or minutes) and compaction windows
+start at local midnight: in a +05:30 or +09:30 zone a UTC hour would
+straddle two local days and its rollup would move samples into the
+wrong one. A bucket that gained raw rows since it was compacted is
+re-compacted together with its rollup.
+
+Compaction is meant for 'hr'-style metrics: a rollup row has no qty.
+"""
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from ..extensions import db
+from ..models.health import HealthMetric
+from .health_sync_state import bump_sync_state
+from .user_timezone import day_utc_range, local_day, timezone_name, user_timezone
+
+# Defaults for the retention job (the app passes its config values)
+RETENTION_RAW_DAYS = 30
+RETENTION_METRICS = ('heart_rate',)
+RETENTION_BUCKET = 'hour'
+
+BUCKETS = ('minute', 'hour')
+
+# Raw rows are compacted this many days at a time, one transaction each
+COMPACT_WINDOW = timedelta(days=7)
+
+# UTC start of the local :bucket (date_trunc unit) holding a row, in the :tz zone
+BUCKET_START_SQL = (
+    "timezone('UTC', timezone(:tz, date_trunc(:bucket, timezone(:tz, timezone('UTC', date)))))"
+)
+
+# Weighted average of a set of rows that may include rollups
+WEIGHTED_AVG_SQL = (
+    'SUM(COALESCE(avg_val, qty) * COALESCE(sample_count, 1)) '
+    '/ NULLIF(SUM(CASE WHEN COALESCE(avg_val, qty) IS NOT NULL '
+    'THEN COALESCE(sample_count, 1) END), 0)'
+)
+
+
+def compact_metric(user_id, metric_name, cutoff, bucket=RETENTION_BUCKET):
+    """Compact a user's raw metric_name rows dated before cutoff. Returns rows removed."""
+    if bucket not in BUCKETS:
+        raise ValueError(f'bucket must be one of {BUCKETS}')
+    first = db.session.execute(text("""
+        SELECT MIN(date) FROM health_metrics
+        WHERE user_id = :uid AND metric_name = :name AND date < :cutoff
+          AND sample_count IS NULL
+    """), {'uid': user_id, 'name': metric_name, 'cutoff': cutoff}).scalar()
+    if first is None:
+        return 0
+
+    tz = user_timezone(user_id)
+    tz_name = timezone_name(user_id)
+    # Windows run between local midnights, which are bucket boundaries
+    cutoff = _local_midnight(local_day(cutoff, tz), tz)
+    removed = 0
+    day = local_day(first, tz)
+    start = _local_midnight(day, tz)
+    while start < cutoff:
+        day += COMPACT_WINDOW
+        end = min(_local_midnight(day, tz), cutoff)
+        removed += _compact_window(user_id, metric_name, start, end, bucket, tz, tz_name)
+        db.session.commit()
+        start = end
+    return removed
+
+
+def _local_midnight(day, tz):
+    """Naive UTC timestamp of the start of local day in tz."""
+    return day_utc_range(day, tz)[0].replace(tzinfo=None)
+
+
+def _compact_window(user_id, metric_name, start, end, bucket, tz, tz_name):
+    params = {'uid': user_id, 'name': metric_name, 'start': start, 'end': end,
+              'bucket': bucket, 'tz': tz_name}
+    # Only buckets that still hold raw rows. Windows start at local
+    # midnight, so buckets never straddle them
+    rollups = db.session.execute(text(f"""
+        SELECT {BUCKET_START_SQL} AS bucket_start,
+               MAX(metric_units) AS metric_units,
+               {WEIGHTED_AVG_SQL} AS avg_val,
+               MIN(COALESCE(min_val, qty)) AS min_val,
+               MAX(COALESCE(max_val, qty)) AS max_val,
+               SUM(CASE WHEN COALESCE(avg_val, qty) IS NOT NULL
+                        THEN COALESCE(sample_count, 1) END) AS samples,
+               COUNT(*) AS row_count
+        FROM health_metrics
+        WHERE user_id = :uid AND metric_name = :name AND date >= :start AND date < :end
+        GROUP BY bucket_start
+        HAVING bool_or(sample_count IS NULL)
+    """), params).fetchall()
+    if not rollups:
+        return 0
+
+    buckets = [r.bucket_start for r in rollups]
+    db.session.execute(text(f"""
+        DELETE FROM health_metrics
+        WHERE user_id = :uid AND metric_name = :name AND date >= :start AND date < :end
+          AND {BUCKET_START_SQL} = ANY(:buckets)
+    """), dict(params, buckets=buckets))
+
+    rows = [{
+        'user_id': user_id,
+        'metric_name': metric_name,
+        'metric_units': r.metric_units,
+        'date': r.bucket_start,
+        'local_day': local_day(r.bucket_start, tz),
+        'data': {'Avg': r.avg_val, 'Min': r.min_val, 'Max': r.max_val,
+                 'count': r.samples, 'rollup': bucket},
+        'avg_val': r.avg_val,
+        'min_val': r.min_val,
+        'max_val': r.max_val,
+        'sample_count': r.samples,
+        'created_at': datetime.now(timezone.utc),
+    } for r in rollups if r.samples]
+    if rows:
+        db.session.execute(HealthMetric.__table__.insert(), rows)
+
+    removed = sum(r.row_count for r in rollups) - len(rows)
+    bump_sync_state(user_id, {metric_name: (None, -removed)})
+    # Daily values stay the same except the latest qty, which a rollup doesn't keep
+    from .health_rollups import refresh_daily_rollups
+    refresh_daily_rollups(user_id, {metric_name: {local_day(b, tz) for b in buckets}}, tz)
+    return removed
+
+
+def apply_retention(raw_days=RETENTION_RAW_DAYS, metric_names=RETENTION_METRICS,
+                    bucket=RETENTION_BUCKET, user_id=None, log=None):
+    """Compact every user's (or one user's) metrics older than raw_days. Returns rows removed."""
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=raw_days)
+    # compact_metric rounds it down to the user's local midnight
+    if user_id is None:
+        user_ids = [r.id for r in db.session.execute(text('SELECT id FROM users'))]
+    else:
+        user_ids = [user_id]
+    removed = 0
+    for uid in user_ids:
+        for metric_name in metric_names:
+            n = compact_metric(uid, metric_name, cutoff, bucket)
+            removed += n
+            if log and n:
+                log(f'  user {uid} {metric_name}: {n:,} rows compacted away')
+    return removed
@@ -0,0 +1,185 @@
+"""Per-day rollups of every metric, maintained at ingest (health_daily_rollups).
+
+The dashboard charts (/api/dashboard/health, /evolution, /metric/<key>)
+only ever show one value per metric and day, yet used to re-aggregate the
+raw samples of the whole range on every load. health_daily_rollups keeps
+one row per (user, metric_name, local day) with the day's sum, weighted
+average, min, max and latest value, so a 365-day chart reads 365 rows.
+Days are calendar days in the user's timezone (see user_timezone).
+
+Rows are recomputed from the stored samples (health_metrics plus packed
+day rows) for just the days a write touched: MetricWriter and the COPY
+loader after each batch, retention compaction, the archive, pack_metric.
+Recomputing instead of applying deltas keeps updates, source-merge prunes
+and deletes exact. `flask rebuild-health-rollups` backfills them.
+"""
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from ..extensions import db
+from .health_packed import STORED_SAMPLES_SQL
+from .health_retention import WEIGHTED_AVG_SQL
+from .user_timezone import LOCAL_DAY_SQL, day_utc_range, local_day, timezone_name, user_timezone
+
+# Days recomputed per statement by rebuild_daily_rollups
+REBUILD_WINDOW = timedelta(days=90)
+
+# health_metrics ids restamped per transaction by restamp_local_days
+RESTAMP_BATCH = 50000
+
+# End day for ranges that are open at the end
+_OPEN_END = date(9999, 1, 1)
+
+
+def _utc_start(day, tz):
+    """Naive UTC timestamp of day's local midnight in tz."""
+    return day_utc_range(day, tz)[0].replace(tzinfo=None)
+
+
+def _day_runs(days):
+    """Split a set of days into (first, last) runs of consecutive days."""
+    runs = []
+    for day in sorted(days):
+        if runs and day - runs[-1][1] == timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return runs
+
+
+def recompute_rollups(user_id, metric_name, first_day, end_day, tz):
+    """Replace a user's metric_name rollups for the local days in [first_day, end_day)."""
+    params = {'uid': user_id, 'name': metric_name, 'first': first_day, 'end': end_day,
+              'since': _utc_start(first_day, tz), 'until': _utc_start(end_day, tz),
+              'tz': tz.key}
+    db.session.execute(text("""
+        DELETE FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = :name AND day >= :first AND day < :end
+    """), params)
+    db.session.execute(text(f"""
+        INSERT INTO health_daily_rollups (user_id, metric_name, day, total, sample_count,
+                                          avg_val, min_val, max_val, latest_value, latest_ts,
+                                          updated_at)
+        SELECT :uid, :name, local_day,
+               SUM(qty),
+               SUM(CASE WHEN COALESCE(avg_val, qty) IS NOT NULL
+                        THEN COALESCE(sample_count, 1) END),
+               {WEIGHTED_AVG_SQL},
+               MIN(COALESCE(min_val, qty)),
+               MAX(COALESCE(max_val, qty)),
+               (array_agg(qty ORDER BY date DESC))[1],
+               MAX(date),
+               NOW()
+        FROM {STORED_SAMPLES_SQL} hm
+        WHERE local_day >= :first AND local_day < :end
+        GROUP BY local_day
+    """), params)
+
+
+def refresh_daily_rollups(user_id, touched, tz=None):
+    """Recompute the rollups of {metric_name: local days} after a write, in the caller's
+    transaction. tz defaults to the user's timezone."""
+    tz = tz or user_timezone(user_id)
+    for metric_name, days in touched.items():
+        for first, last in _day_runs(days):
+            recompute_rollups(user_id, metric_name, first, last + timedelta(days=1), tz)
+
+
+def restamp_local_days(user_id, batch_size=RESTAMP_BATCH):
+    """Recompute local_day of a user's health_metrics rows in their current timezone.
+
+    Commits every batch_size ids. Returns rows whose local_day changed;
+    the caller rebuilds the user's rollups.
+    """
+    bounds = db.session.execute(text(
+        'SELECT MIN(id) AS first, MAX(id) AS last FROM health_metrics WHERE user_id = :uid'
+    ), {'uid': user_id}).fetchone()
+    if bounds.first is None:
+        return 0
+    tz = timezone_name(user_id)
+    stamp = LOCAL_DAY_SQL.format(column='date')
+    after, updated = bounds.first - 1, 0
+    while after < bounds.last:
+        updated += db.session.execute(text(f"""
+            UPDATE health_metrics SET local_day = {stamp}
+            WHERE user_id = :uid AND id > :after AND id <= :upto
+              AND local_day IS DISTINCT FROM {stamp}
+        """), {'uid': user_id, 'tz': tz, 'after': after, 'upto': after + batch_size}).rowcount
+        db.session.commit()
+        after += batch_size
+    return updated
+
+
+def rebuild_daily_rollups(user_id=None, log=None):
+    """Recompute every rollup of every user (or one user). Returns rollup rows written."""
+    where = '' if user_id is None else 'WHERE user_id = :uid'
+    params = {} if user_id is None else {'uid': user_id}
+    series = db.session.execute(text(f"""
+        SELECT user_id, metric_name, MIN(first) AS first FROM (
+            SELECT user_id, metric_name, MIN(date) AS first FROM health_metrics {where}
+            GROUP BY user_id, metric_name
+            UNION ALL
+            SELECT user_id, metric_name, MIN(day) FROM health_metric_days {where}
+            GROUP BY user_id, metric_name
+        ) stored
+        GROUP BY user_id, metric_name ORDER BY user_id, metric_name
+    """), params).fetchall()
+    # Start from scratch so series with no samples left lose their rollups
+    db.session.execute(text(f'DELETE FROM health_daily_rollups {where}'), params)
+    db.session.commit()
+
+    written = 0
+    timezones = {}
+    for s in series:
+        if s.user_id not in timezones:
+            timezones[s.user_id] = user_timezone(s.user_id)
+        tz = timezones[s.user_id]
+        today = datetime.now(tz).date()
+        start = local_day(s.first, tz)
+        while start <= today:
+            recompute_rollups(s.user_id, s.metric_name, start, start + REBUILD_WINDOW, tz)
+            db.session.commit()
+            start += REBUILD_WINDOW
+        # Samples dated in the future still get their days
+        recompute_rollups(s.user_id, s.metric_name, start, _OPEN_END, tz)
+        db.session.commit()
+        count = db.session.execute(text("""
+            SELECT COUNT(*) FROM health_daily_rollups WHERE user_id = :uid AND metric_name = :name
+        """), {'uid': s.user_id, 'name': s.metric_name}).scalar()
+        written += count
+        if log:
+            log(f'  user {s.user_id} {s.metric_name}: {count:,} days')
+    return written
+
+
+def forget_rollups_before(cutoff):
+    """Recompute rollups after the health_metrics months before cutoff were dropped.
+
+    Local days before cutoff lose their rollups, except days that still
+    have packed samples (or, for the day straddling cutoff's UTC midnight,
+    later rows), which are recomputed from those.
+    """
+    touched = {}
+    for r in db.session.execute(text("""
+        SELECT user_id, metric_name, day FROM health_metric_days WHERE day < :cutoff
+        UNION
+        SELECT user_id, metric_name, day FROM health_daily_rollups
+        WHERE day >= CAST(:cutoff AS date) - 1 AND day <= :cutoff
+    """), {'cutoff': cutoff}):
+        # A UTC day of packed samples spreads over the local days around it
+        days = touched.setdefault(r.user_id, {}).setdefault(r.metric_name, set())
+        days.update({r.day - timedelta(days=1), r.day, r.day + timedelta(days=1)})
+    db.session.execute(text('DELETE FROM health_daily_rollups WHERE day < :cutoff'),
+                       {'cutoff': cutoff})
+    for uid, days in touched.items():
+        refresh_daily_rollups(uid, days)
+
+
+def read_rollups(user_id, metric_names, since_day):
+    """A user's rollup rows of metric_names from the local day since_day on, by metric and day."""
+    return db.session.execute(text("""
+        SELECT metric_name, day, total, sample_count, avg_val, min_val, max_val,
+               latest_value, latest_ts
+        FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = ANY(:names) AND day >= :since
+        ORDER BY metric_name, day
+    """), {'uid': user_id, 'names': list(metric_names), 'since': since_day}).fetchall()
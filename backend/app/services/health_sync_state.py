@@ -0,0 +1,89 @@
+"""Per-metric sync cursors served by GET /api/health/sync-state.
+
+Uploaders ask what the server already holds and send only newer samples.
+health_sync_state keeps the latest timestamp and row count per
+(user, metric_name) so that answer is a primary-key read instead of a
+MAX(date)/COUNT(*) scan over health_metrics. The write paths bump it in
+the same transaction as the rows they insert; anything that deletes or
+moves rows should call rebuild_sync_state.
+"""
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..extensions import db
+from ..models.health import HealthSyncState
+
+# metric_name under which workouts are tracked
+WORKOUTS_KEY = '@workouts'
+
+
+def bump_sync_state(user_id, deltas):
+    """Apply {metric_name: (latest_date, rows_inserted)} to the user's cursors."""
+    rows = [
+        {'user_id': user_id, 'metric_name': name, 'latest_date': latest, 'row_count': count}
+        for name, (latest, count) in deltas.items()
+    ]
+    if not rows:
+        return
+    table = HealthSyncState.__table__
+    stmt = pg_insert(table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['user_id', 'metric_name'],
+        set_={
+            'latest_date': func.greatest(table.c.latest_date, stmt.excluded.latest_date),
+            'row_count': table.c.row_count + stmt.excluded.row_count,
+            'updated_at': stmt.excluded.updated_at,
+        },
+    )
+    db.session.execute(stmt)
+
+
+def add_sync_delta(deltas, metric_name, ts, inserted):
+    """Fold one written row into a bump_sync_state deltas dict."""
+    latest, count = deltas.get(metric_name, (None, 0))
+    if latest is None or (ts is not None and ts > latest):
+        latest = ts
+    deltas[metric_name] = (latest, count + (1 if inserted else 0))
+
+
+def rebuild_sync_state(user_id=None):
+    """Recompute cursors from health_metrics, health_metric_days and workouts
+    (all users if user_id is None)."""
+    where = '' if user_id is None else 'WHERE user_id = :uid'
+    params = {} if user_id is None else {'uid': user_id}
+    db.session.execute(text(f'DELETE FROM health_sync_state {where}'), params)
+    db.session.execute(text(f"""
+        INSERT INTO health_sync_state (user_id, metric_name, latest_date, row_count, updated_at)
+        SELECT user_id, metric_name, MAX(latest), SUM(n), NOW()
+        FROM (
+            SELECT user_id, metric_name, MAX(date) AS latest, COUNT(*) AS n
+            FROM health_metrics {where}
+            GROUP BY user_id, metric_name
+            UNION ALL
+            SELECT user_id, metric_name,
+                   MAX(day + make_interval(secs => offsets[cardinality(offsets)])),
+                   SUM(cardinality(offsets))
+            FROM health_metric_days {where}
+            GROUP BY user_id, metric_name
+        ) stored
+        GROUP BY user_id, metric_name
+    """), params)
+    db.session.execute(text(f"""
+        INSERT INTO health_sync_state (user_id, metric_name, latest_date, row_count, updated_at)
+        SELECT user_id, '{WORKOUTS_KEY}', MAX(start_time), COUNT(*), NOW()
+        FROM workouts {where}
+        GROUP BY user_id
+    """), params)
+
+
+def get_sync_state(user_id):
+    """Cursors for one user, shaped for the API."""
+    rows = HealthSyncState.query.filter_by(user_id=user_id).all()
+    metrics = {}
+    workouts = {'latestStart': None, 'count': 0}
+    for row in rows:
+        latest = row.latest_date.isoformat() if row.latest_date else None
+        if row.metric_name == WORKOUTS_KEY:
+            workouts = {'latestStart': latest, 'count': row.row_count}
+        else:
+            metrics[row.metric_name] = {'latestDate': latest, 'count': row.row_count}
+    return {'metrics': metrics, 'workouts': workouts}
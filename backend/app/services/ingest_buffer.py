@@ -0,0 +1,205 @@
+"""Write-coalescing buffer for frequent small ingest pushes.
+
+When the exporter syncs every few minutes, each push otherwise pays a
+full ingest: upserts, commits, the auto-event pass and trophy
+evaluation. In buffered mode a push is appended to health_ingest_buffer
+as raw records and the user's buffer is flushed through the normal
+ingest path once it holds enough points or its oldest record is old
+enough, so all of that runs once per flush.
+
+Flushes are serialised per user with an advisory lock held on a
+dedicated connection (ingest commits in chunks, so a transaction-scoped
+lock would not last). Records are replayed in arrival order and deleted
+after the flush; stale buffers with no new pushes are flushed by
+`flask ingest-worker` or `flask flush-ingest-buffer`.
+
+Today's readers union in buffered points via BUFFERED_METRICS_SQL.
+Buffered iPhone and Watch samples of MERGE_METRICS haven't been through
+the source merge yet, so buffered_range_sum merges them with the stored
+rows of their day before summing.
+"""
+from sqlalchemy import text
+from ..extensions import db
+from ..models.health import HealthIngestBuffer
+from .ingest_normalizer import compile_date_parser, point_from_data, value_columns_sql
+from .ingest_report import IngestReport
+from .source_merge import MERGE_METRICS, merge_sources, source_priority
+
+# Defaults for the flush thresholds (the app passes its config values)
+BUFFER_MAX_POINTS = 20000
+BUFFER_MAX_AGE_SECONDS = 900
+
+# Advisory lock namespace for per-user buffer flushes
+_LOCK_NAMESPACE = 5101
+
+# health_metrics plus not-yet-flushed points, for "today" queries. The
+# newest buffered copy of a point wins, and points already stored are
+# taken from health_metrics.
+BUFFERED_METRICS_SQL = f"""(
+    SELECT user_id, metric_name, date, data, qty, avg_val, min_val, max_val FROM health_metrics
+    UNION ALL (
+        SELECT DISTINCT ON (b.user_id, b.metric_name, b.date)
+               b.user_id, b.metric_name, b.date, b.point AS data, {value_columns_sql('b.point')}
+        FROM health_ingest_buffer b
+        WHERE b.kind = 'metric' AND NOT EXISTS (
+            SELECT 1 FROM health_metrics m
+            WHERE m.user_id = b.user_id AND m.metric_name = b.metric_name AND m.date = b.date
+        )
+        ORDER BY b.user_id, b.metric_name, b.date, b.id DESC
+    )
+)"""
+
+
+def buffered_range_sum(user_id, metric_name, start, end):
+    """SUM(qty) of a user's metric in [start, end), counting not-yet-flushed points.
+
+    For MERGE_METRICS with buffered points in range, the stored and
+    buffered samples of each UTC day are run through merge_sources first,
+    as the flush would, so overlapping devices aren't counted twice.
+    """
+    params = {'uid': user_id, 'name': metric_name, 'start': start, 'end': end}
+    if metric_name in MERGE_METRICS and db.session.execute(text("""
+        SELECT 1 FROM health_ingest_buffer
+        WHERE user_id = :uid AND kind = 'metric' AND metric_name = :name
+          AND date >= :start AND date < :end
+        LIMIT 1
+    """), params).fetchone():
+        days = {}
+        for row in db.session.execute(text(f"""
+            SELECT date, data FROM {BUFFERED_METRICS_SQL} hm
+            WHERE user_id = :uid AND metric_name = :name AND date >= :start AND date < :end
+        """), params):
+            data = dict(row.data or {})
+            # Stored rows a merge already adjusted are re-merged from their original value
+            raw = data.pop('rawQty', None)
+            if raw is not None:
+                data['qty'] = raw
+            days.setdefault(row.date.date(), []).append(
+                (metric_name, None, point_from_data(row.date, data)))
+        priority = source_priority(user_id)
+        total = 0
+        for run in days.values():
+            total += sum(p.qty or 0 for _, _, p in merge_sources(run, priority)[0])
+        return total
+    row = db.session.execute(text(f"""
+        SELECT SUM(qty) AS total FROM {BUFFERED_METRICS_SQL} hm
+        WHERE user_id = :uid AND metric_name = :name AND date >= :start AND date < :end
+    """), params).fetchone()
+    return row.total or 0
+
+
+def buffer_health_records(records, user_id):
+    """Append ingest records to the user's buffer.
+
+    Returns (records buffered, IngestReport of the points rejected for a
+    missing or unparseable date), like the sync path reports them.
+    """
+    table = HealthIngestBuffer.__table__
+    parsers = {}
+    rows = []
+    rejected = IngestReport()
+    for kind, metric_name, metric_units, item in records:
+        if kind == 'metric':
+            try:
+                date_str = item.get('date')
+                if not date_str:
+                    raise ValueError('missing date')
+                parse = parsers.get(metric_name)
+                if parse is None:
+                    parse = parsers[metric_name] = compile_date_parser(date_str)
+                ts = parse(date_str)
+            except ValueError as e:
+                rejected.rejected(metric_name, str(e))
+                continue
+            rows.append({'user_id': user_id, 'kind': 'metric', 'metric_name': metric_name,
+                         'metric_units': metric_units, 'date': ts, 'point': item})
+        else:
+            rows.append({'user_id': user_id, 'kind': 'workout', 'metric_name': None,
+                         'metric_units': None, 'date': None, 'point': item})
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+    return len(rows), rejected
+
+
+def buffer_stats(user_id):
+    """(records buffered, age in seconds of the oldest one) for a user."""
+    row = db.session.execute(text("""
+        SELECT COUNT(*) AS n,
+               EXTRACT(EPOCH FROM (NOW() - MIN(received_at)::timestamptz)) AS age
+        FROM health_ingest_buffer WHERE user_id = :uid
+    """), {'uid': user_id}).fetchone()
+    return row.n, float(row.age or 0)
+
+
+def buffer_due(user_id, max_points=BUFFER_MAX_POINTS, max_age=BUFFER_MAX_AGE_SECONDS):
+    count, age = buffer_stats(user_id)
+    return count > 0 and (count >= max_points or age >= max_age)
+
+
+def _iter_buffer(user_id, last_id, page=5000):
+    """Yield buffered records up to last_id as ingest record tuples, in arrival order."""
+    after = 0
+    while True:
+        rows = db.session.execute(text("""
+            SELECT id, kind, metric_name, metric_units, point FROM health_ingest_buffer
+            WHERE user_id = :uid AND id > :after AND id <= :last
+            ORDER BY id LIMIT :page
+        """), {'uid': user_id, 'after': after, 'last': last_id, 'page': page}).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield (row.kind, row.metric_name, row.metric_units, row.point)
+        after = rows[-1].id
+
+
+def flush_ingest_buffer(user_id):
+    """Ingest everything buffered for a user in one pass.
+
+    Returns the ingest result, or None if the buffer was empty or another
+    flush for the user is running.
+    """
+    from .health_ingester import process_health_records
+    from .ingest_telemetry import track_ingest
+
+    with db.engine.connect() as lock_conn:
+        locked = lock_conn.execute(text('SELECT pg_try_advisory_lock(:ns, :uid)'),
+                                   {'ns': _LOCK_NAMESPACE, 'uid': user_id}).scalar()
+        lock_conn.commit()
+        if not locked:
+            return None
+        try:
+            last_id = db.session.execute(text(
+                'SELECT MAX(id) FROM health_ingest_buffer WHERE user_id = :uid'
+            ), {'uid': user_id}).scalar()
+            if last_id is None:
+                db.session.rollback()
+                return None
+            with track_ingest(user_id, 'buffer') as run:
+                run.result = process_health_records(_iter_buffer(user_id, last_id), user_id)
+            result = run.result
+            db.session.execute(text(
+                'DELETE FROM health_ingest_buffer WHERE user_id = :uid AND id <= :last'
+            ), {'uid': user_id, 'last': last_id})
+            db.session.commit()
+            return result
+        finally:
+            lock_conn.execute(text('SELECT pg_advisory_unlock(:ns, :uid)'),
+                              {'ns': _LOCK_NAMESPACE, 'uid': user_id})
+            lock_conn.commit()
+
+
+def flush_due_buffers(max_points=BUFFER_MAX_POINTS, max_age=BUFFER_MAX_AGE_SECONDS):
+    """Flush every user's buffer that crossed a threshold. Returns users flushed."""
+    user_ids = [r.user_id for r in db.session.execute(text("""
+        SELECT user_id FROM health_ingest_buffer
+        GROUP BY user_id
+        HAVING COUNT(*) >= :max_points
+            OR MIN(received_at)::timestamptz <= NOW() - make_interval(secs => :max_age)
+    """), {'max_points': max_points, 'max_age': max_age})]
+    db.session.rollback()
+    flushed = 0
+    for user_id in user_ids:
+        if flush_ingest_buffer(user_id) is not None:
+            flushed += 1
+    return flushed
@@ -0,0 +1,128 @@
+"""Content-Encoding support for /api/health/ingest bodies.
+
+Health Auto Export payloads repeat the same keys on every sample and
+compress 10-20x, so clients may send them gzip or zstd encoded. The body
+is decompressed incrementally as the parser reads it, and the decompressed
+size is capped so a small zip bomb can't expand without bound.
+"""
+import zlib
+
+# Decompressed bytes requested from the decoder per read() when no size is given
+_READ_SIZE = 64 * 1024
+
+
+class UnsupportedEncoding(ValueError):
+    """Content-Encoding the server cannot decode (answered with 415)."""
+
+
+class PayloadTooLarge(ValueError):
+    """Decoded body exceeded the configured cap (answered with 413)."""
+
+
+class CorruptPayload(ValueError):
+    """Compressed body could not be decoded (answered with 400)."""
+
+
+class _GzipReader:
+    """Incremental gzip (or zlib) decoder over a binary stream."""
+
+    def __init__(self, raw):
+        self._raw = raw
+        # 32 + MAX_WBITS: accept both gzip and zlib headers
+        self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self._eof = False
+
+    def read(self, size=-1):
+        if size == 0:
+            # ijson probes read(0) for bytes vs str; max_length=0 would mean unlimited
+            return b''
+        if size is None or size < 0:
+            size = _READ_SIZE
+        while not self._eof:
+            # Leftover input first; max_length bounds what one call can expand to
+            data = self._decoder.unconsumed_tail
+            if not data:
+                data = self._raw.read(_READ_SIZE)
+                if not data:
+                    self._eof = True
+                    try:
+                        return self._decoder.flush()
+                    except zlib.error as e:
+                        raise CorruptPayload(f'Invalid gzip body: {e}')
+            try:
+                out = self._decoder.decompress(data, size)
+            except zlib.error as e:
+                raise CorruptPayload(f'Invalid gzip body: {e}')
+            if self._decoder.eof:
+                self._eof = True
+            if out:
+                return out
+        return b''
+
+
+class _ZstdReader:
+    def __init__(self, raw):
+        try:
+            import zstandard
+        except ImportError:
+            raise UnsupportedEncoding('zstd bodies need the zstandard package')
+        self._reader = zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+        self._error = zstandard.ZstdError
+
+    def read(self, size=-1):
+        if size == 0:
+            return b''
+        if size is None or size < 0:
+            size = _READ_SIZE
+        try:
+            return self._reader.read(size)
+        except self._error as e:
+            raise CorruptPayload(f'Invalid zstd body: {e}')
+
+
+class _CappedReader:
+    """Raise PayloadTooLarge once more than max_bytes have been read through it."""
+
+    def __init__(self, inner, max_bytes):
+        self._inner = inner
+        self._remaining = max_bytes
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._inner.read(size)
+        self._remaining -= len(data)
+        self.bytes_read += len(data)
+        if self._remaining < 0:
+            raise PayloadTooLarge(f'Decoded body exceeds {self.max_bytes} bytes')
+        return data
+
+
+_DECODERS = {
+    'gzip': _GzipReader,
+    'x-gzip': _GzipReader,
+    'zstd': _ZstdReader,
+}
+
+
+def read_all(reader):
+    """Read a (possibly decoding) file-like object to the end."""
+    parts = []
+    while True:
+        data = reader.read(_READ_SIZE)
+        if not data:
+            return b''.join(parts)
+        parts.append(data)
+
+
+def decode_body(stream, content_encoding, max_bytes):
+    """Wrap a request body stream so reads return decoded bytes, capped at max_bytes."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding in ('', 'identity'):
+        reader = stream
+    else:
+        decoder = _DECODERS.get(encoding)
+        if decoder is None:
+            raise UnsupportedEncoding(f'Unsupported Content-Encoding: {content_encoding}')
+        reader = decoder(stream)
+    return _CappedReader(reader, max_bytes)
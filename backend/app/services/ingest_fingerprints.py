@@ -0,0 +1,77 @@
+"""Content fingerprints of stored metric-days.
+
+Health Auto Export resends overlapping windows (e.g. the last 7 days on
+every sync). The ingester hashes the points it receives for each
+(user, metric_name, day) and compares them with the fingerprint stored the
+last time that day was written; equal hashes mean the day is unchanged and
+its points are skipped without touching health_metrics.
+
+Anything that writes health_metrics outside the ingester must call
+invalidate_fingerprints for the days it touched.
+"""
+import hashlib
+import json
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from ..extensions import db
+from ..models.health import HealthMetricFingerprint
+
+
+def fingerprint_points(points):
+    """Order-independent digest of (metric_name, metric_units, NormalizedPoint) tuples."""
+    lines = sorted(
+        f'{p.ts_utc.isoformat()}|{units}|{p.qty!r}|{p.avg!r}|{p.min!r}|{p.max!r}|'
+        f'{json.dumps(p.extra, sort_keys=True, default=str)}'
+        for _, units, p in points
+    )
+    h = hashlib.blake2b(digest_size=16)
+    for line in lines:
+        h.update(line.encode('utf-8'))
+        h.update(b'\n')
+    return h.hexdigest()
+
+
+def get_fingerprint(user_id, metric_name, day):
+    """Stored digest for one metric-day, or None."""
+    row = db.session.execute(text("""
+        SELECT digest FROM health_metric_fingerprints
+        WHERE user_id = :uid AND metric_name = :name AND day = :day
+    """), {'uid': user_id, 'name': metric_name, 'day': day}).fetchone()
+    return row.digest if row else None
+
+
+def save_fingerprints(user_id, fingerprints):
+    """Store {(metric_name, day): (digest, point_count) or None}; None drops the fingerprint."""
+    table = HealthMetricFingerprint.__table__
+    rows = []
+    for (metric_name, day), value in fingerprints.items():
+        if value is None:
+            invalidate_fingerprints(user_id, metric_name, [day])
+            continue
+        digest, count = value
+        rows.append({'user_id': user_id, 'metric_name': metric_name, 'day': day,
+                     'digest': digest, 'point_count': count})
+    if rows:
+        stmt = pg_insert(table).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'metric_name', 'day'],
+            set_={
+                'digest': stmt.excluded.digest,
+                'point_count': stmt.excluded.point_count,
+                'updated_at': stmt.excluded.updated_at,
+            },
+        )
+        db.session.execute(stmt)
+
+
+def invalidate_fingerprints(user_id, metric_name=None, days=None):
+    """Forget fingerprints so the next ingest of those days is written again."""
+    sql = 'DELETE FROM health_metric_fingerprints WHERE user_id = :uid'
+    params = {'uid': user_id}
+    if metric_name is not None:
+        sql += ' AND metric_name = :name'
+        params['name'] = metric_name
+    if days is not None:
+        sql += ' AND day = ANY(:days)'
+        params['days'] = list(days)
+    db.session.execute(text(sql), params)
@@ -0,0 +1,106 @@
+"""Idempotency keys for /api/health/ingest.
+
+The exporter retries on timeout, often while the first attempt is still
+running. Each request claims its key (the Idempotency-Key header, or a
+digest of the decoded body) before touching health_metrics: the first
+claim proceeds, a repeat of a finished request gets the stored response
+(body, status and REPLAYED_HEADERS) back and a repeat of a running one
+gets 409.
+
+Claims and outcomes are written on their own connection so a concurrent
+retry sees them immediately, independent of the ingest's transaction.
+"""
+import hashlib
+import tempfile
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from ..extensions import db
+from ..models.health import IngestIdempotencyKey
+
+# Stored outcomes are replayed for this long, then the key may be reused
+IDEMPOTENCY_TTL = timedelta(hours=24)
+
+# An in-progress claim older than this is assumed to belong to a dead worker
+IDEMPOTENCY_STALE_AFTER = timedelta(minutes=15)
+
+# Bodies hashed for a derived key are kept in memory up to this size
+SPOOL_MAX_MEMORY = 8 * 1024 * 1024
+
+# Response headers stored with the outcome and restored on replay
+REPLAYED_HEADERS = ('Location',)
+
+_READ_SIZE = 64 * 1024
+
+
+def digest_body(body):
+    """Hash a decoded body while spooling it. Returns (key, rewound file)."""
+    h = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    while True:
+        block = body.read(_READ_SIZE)
+        if not block:
+            break
+        h.update(block)
+        spool.write(block)
+    spool.seek(0)
+    return f'sha256:{h.hexdigest()}', spool
+
+
+def claim_ingest_key(user_id, key):
+    """Claim a key for this request.
+
+    Returns None if the caller now owns the key and should run the ingest,
+    otherwise the existing row (status, response_status, response,
+    response_headers).
+    Expired outcomes and stale claims are taken over.
+    """
+    now = datetime.now(timezone.utc)
+    with db.engine.begin() as conn:
+        claimed = conn.execute(text("""
+            INSERT INTO ingest_idempotency_keys (user_id, key, status, created_at)
+            VALUES (:uid, :key, 'in_progress', :now)
+            ON CONFLICT (user_id, key) DO UPDATE
+                SET status = 'in_progress', created_at = :now,
+                    response_status = NULL, response = NULL, response_headers = NULL,
+                    completed_at = NULL
+                WHERE ingest_idempotency_keys.created_at < :expired_before
+                   OR (ingest_idempotency_keys.status = 'in_progress'
+                       AND ingest_idempotency_keys.created_at < :stale_before)
+            RETURNING key
+        """), {
+            'uid': user_id, 'key': key, 'now': now,
+            'expired_before': now - IDEMPOTENCY_TTL,
+            'stale_before': now - IDEMPOTENCY_STALE_AFTER,
+        }).fetchone()
+        if claimed:
+            return None
+        return conn.execute(text("""
+            SELECT status, response_status, response, response_headers
+            FROM ingest_idempotency_keys
+            WHERE user_id = :uid AND key = :key
+        """), {'uid': user_id, 'key': key}).fetchone()
+
+
+def complete_ingest_key(user_id, key, response_status, response, headers=None):
+    """Store the outcome replayed to later requests with the same key.
+
+    headers is the response's header mapping; only REPLAYED_HEADERS are kept.
+    """
+    kept = {name: headers[name] for name in REPLAYED_HEADERS if headers and name in headers}
+    table = IngestIdempotencyKey.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.update().where(
+            table.c.user_id == user_id, table.c.key == key,
+        ).values(
+            status='done', response_status=response_status, response=response,
+            response_headers=kept or None,
+            completed_at=datetime.now(timezone.utc),
+        ))
+
+
+def release_ingest_key(user_id, key):
+    """Drop a claim whose request failed, so a retry runs again."""
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            'DELETE FROM ingest_idempotency_keys WHERE user_id = :uid AND key = :key'
+        ), {'uid': user_id, 'key': key})
@@ -0,0 +1,163 @@
+"""Asynchronous health ingest: durable job queue drained by `flask ingest-worker`.
+
+The request handler only spools the raw body into ingest_job_chunks and
+returns 202. Workers claim jobs with SELECT ... FOR UPDATE SKIP LOCKED, so
+several of them can run side by side without picking the same job, and
+feed the spooled body through the streaming parser.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+import ijson
+from sqlalchemy import text
+from ..extensions import db
+from ..models.health import IngestJob, IngestJobChunk
+
+# Size of each spooled body piece
+JOB_CHUNK_BYTES = 1024 * 1024
+
+# A running job with no progress for this long is assumed to be orphaned
+JOB_STALE_AFTER = timedelta(minutes=10)
+
+MAX_JOB_ATTEMPTS = 3
+
+
+def _utcnow():
+    return datetime.now(timezone.utc)
+
+
+def enqueue_ingest_job(user_id, stream):
+    """Spool a request body into a new pending job and return the job."""
+    job = IngestJob(user_id=user_id, status='pending')
+    db.session.add(job)
+    db.session.flush()
+
+    chunks = IngestJobChunk.__table__
+    seq = 0
+    total = 0
+    while True:
+        block = stream.read(JOB_CHUNK_BYTES)
+        if not block:
+            break
+        db.session.execute(chunks.insert().values(job_id=job.id, seq=seq, data=block))
+        seq += 1
+        total += len(block)
+
+    job.payload_bytes = total
+    db.session.commit()
+    return job
+
+
+class JobPayloadReader:
+    """Read-only file-like view over a job's spooled chunks, one chunk in memory at a time."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self._seq = 0
+        self._buf = b''
+        self._eof = False
+        self.bytes_read = 0
+
+    def _next_chunk(self):
+        row = db.session.execute(text(
+            'SELECT data FROM ingest_job_chunks WHERE job_id = :jid AND seq = :seq'
+        ), {'jid': self.job_id, 'seq': self._seq}).fetchone()
+        if row is None:
+            self._eof = True
+            return b''
+        self._seq += 1
+        return bytes(row.data)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            self._buf += self._next_chunk()
+        if size < 0:
+            out, self._buf = self._buf, b''
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        self.bytes_read += len(out)
+        return out
+
+
+def claim_next_job():
+    """Lock and mark the oldest runnable job as running. Returns None if the queue is empty."""
+    stale_before = _utcnow() - JOB_STALE_AFTER
+    job = IngestJob.query.filter(
+        (IngestJob.status == 'pending') |
+        ((IngestJob.status == 'running') & (IngestJob.updated_at < stale_before))
+    ).order_by(IngestJob.id).with_for_update(skip_locked=True).first()
+
+    if not job:
+        db.session.rollback()
+        return None
+
+    now = _utcnow()
+    job.status = 'running'
+    job.attempts += 1
+    job.started_at = now
+    job.updated_at = now
+    db.session.commit()
+    return job
+
+
+def _report_progress(job_id, points):
+    """Record progress on a separate connection so the job's data transaction is untouched."""
+    with db.engine.begin() as conn:
+        conn.execute(text(
+            'UPDATE ingest_jobs SET points_processed = :n, updated_at = :now WHERE id = :jid'
+        ), {'n': points, 'now': _utcnow(), 'jid': job_id})
+
+
+def run_ingest_job(job):
+    """Process one claimed job and store its outcome."""
+    from .health_ingester import process_health_stream
+
+    job_id = job.id
+    user_id = job.user_id
+    try:
+        result = process_health_stream(
+            JobPayloadReader(job_id), user_id,
+            progress=lambda points: _report_progress(job_id, points), mode='async',
+        )
+    except Exception as e:
+        db.session.rollback()
+        job = IngestJob.query.get(job_id)
+        # Malformed bodies won't parse on a retry either
+        retry = not isinstance(e, ijson.JSONError) and job.attempts < MAX_JOB_ATTEMPTS
+        job.status = 'pending' if retry else 'failed'
+        job.error = str(e)
+        job.updated_at = _utcnow()
+        if job.status == 'failed':
+            job.finished_at = job.updated_at
+        db.session.commit()
+        return job
+
+    job = IngestJob.query.get(job_id)
+    job.status = 'done'
+    job.result = result
+    job.error = None
+    job.points_processed = result['metricsStored'] + result['workoutsStored']
+    job.updated_at = job.finished_at = _utcnow()
+    IngestJobChunk.query.filter_by(job_id=job_id).delete()
+    db.session.commit()
+    return job
+
+
+def run_ingest_worker(poll_interval=2.0, once=False, on_idle=None):
+    """Drain the job queue; with once=True, return when it is empty.
+
+    on_idle() is called whenever the queue is found empty.
+    """
+    processed = 0
+    while True:
+        job = claim_next_job()
+        if job is None:
+            if on_idle:
+                on_idle()
+            if once:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        job = run_ingest_job(job)
+        processed += 1
+        print(f'Ingest job {job.id}: {job.status} '
+              f'({job.points_processed} points, attempt {job.attempts})')
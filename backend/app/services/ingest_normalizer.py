@@ -0,0 +1,171 @@
+"""Ingest normalization: raw Health Auto Export points -> typed tuples.
+
+parse_date tries up to six strptime formats per call, which made it the
+top Python hotspot on large payloads. Here the format is chosen once per
+metric series (compile_date_parser) and the layout the exporter actually
+sends, 'YYYY-MM-DD HH:MM:SS ±ZZZZ', is split at fixed positions with
+the offset looked up in a small cache instead of going through strptime.
+Points then travel to the writer as NormalizedPoint tuples.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S %z',
+    '%Y-%m-%d %H:%M:%S %Z',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S%z',
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%d',
+]
+
+# ts_utc is timezone-aware UTC when the source carried an offset, and is
+# left naive (as sent) otherwise, matching what parse_date stored.
+NormalizedPoint = namedtuple('NormalizedPoint', 'ts_utc qty avg min max extra')
+
+# Point keys lifted into NormalizedPoint fields
+_VALUE_KEYS = {'qty': 'qty', 'Avg': 'avg', 'Min': 'min', 'Max': 'max'}
+
+
+def parse_date(date_str):
+    """Parse date string from Health Auto Export: '2026-02-09 18:00:00 Z'"""
+    cleaned = date_str.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(cleaned, fmt)
+        except ValueError:
+            continue
+    # Fallback: replace ' Z' with '+00:00' for fromisoformat
+    try:
+        return datetime.fromisoformat(cleaned.replace(' Z', '+00:00'))
+    except Exception:
+        raise ValueError(f"Cannot parse date: {date_str}")
+
+
+# ' -0300' -> timedelta to add to the local wall time to get UTC
+_OFFSETS = {' Z': timedelta(0)}
+
+
+def _offset_to_utc(suffix):
+    delta = _OFFSETS.get(suffix)
+    if delta is None:
+        if len(suffix) != 6 or suffix[0] != ' ' or suffix[1] not in '+-' \
+                or not suffix[2:].isdigit():
+            raise ValueError(f"Bad UTC offset: {suffix!r}")
+        delta = timedelta(hours=int(suffix[2:4]), minutes=int(suffix[4:6]))
+        if suffix[1] == '+':
+            delta = -delta
+        _OFFSETS[suffix] = delta
+    return delta
+
+
+def parse_exporter_ts(s):
+    """Fixed-layout parser for 'YYYY-MM-DD HH:MM:SS ±ZZZZ' (and '... Z'). Returns aware UTC."""
+    if len(s) not in (21, 25) or s[10] != ' ':
+        raise ValueError(f"Not an exporter timestamp: {s}")
+    delta = _offset_to_utc(s[19:])
+    return datetime.fromisoformat(s[:19]).replace(tzinfo=timezone.utc) + delta
+
+
+def _with_fallback(parse):
+    def parse_or_fallback(s):
+        try:
+            return parse(s)
+        except ValueError:
+            return parse_date(s)
+    return parse_or_fallback
+
+
+def _strptime_parser(fmt):
+    def parse(s):
+        return datetime.strptime(s.strip(), fmt)
+    return parse
+
+
+def compile_date_parser(sample):
+    """Pick a timestamp parser for a metric series from one sample date string.
+
+    Later points that don't fit the chosen layout still fall back to
+    parse_date, so a mixed series is slower but never wrong.
+    """
+    try:
+        parse_exporter_ts(sample)
+        return _with_fallback(parse_exporter_ts)
+    except ValueError:
+        pass
+    cleaned = sample.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            datetime.strptime(cleaned, fmt)
+        except ValueError:
+            continue
+        return _with_fallback(_strptime_parser(fmt))
+    return parse_date
+
+
+def _to_utc(ts):
+    if ts.tzinfo is None or ts.tzinfo is timezone.utc:
+        return ts
+    return ts.astimezone(timezone.utc)
+
+
+def _num(value):
+    return None if value is None else float(value)
+
+
+def normalize_point(point, parse):
+    """Turn one raw point into a NormalizedPoint, or None if it has no date."""
+    date_str = point.get('date')
+    if not date_str:
+        return None
+    values = {'qty': None, 'avg': None, 'min': None, 'max': None}
+    extra = {}
+    for key, value in point.items():
+        field = _VALUE_KEYS.get(key)
+        if field:
+            values[field] = _num(value)
+        elif key != 'date':
+            extra[key] = value
+    return NormalizedPoint(_to_utc(parse(date_str)), values['qty'], values['avg'],
+                           values['min'], values['max'], extra)
+
+
+def point_from_data(ts, data):
+    """NormalizedPoint for a stored health_metrics row (inverse of point_data)."""
+    values = {'qty': None, 'avg': None, 'min': None, 'max': None}
+    extra = {}
+    for key, value in (data or {}).items():
+        field = _VALUE_KEYS.get(key)
+        if field:
+            values[field] = _num(value)
+        else:
+            extra[key] = value
+    return NormalizedPoint(ts, values['qty'], values['avg'], values['min'], values['max'], extra)
+
+
+def value_columns(point):
+    """health_metrics' typed value columns for a NormalizedPoint."""
+    return {'qty': point.qty, 'avg_val': point.avg, 'min_val': point.min, 'max_val': point.max}
+
+
+def value_columns_sql(column):
+    """SQL select list computing the typed value columns from a JSON point column.
+
+    Non-numeric values become NULL instead of failing the statement.
+    """
+    return ', '.join(
+        f"CASE WHEN json_typeof({column}->'{key}') = 'number' "
+        f"THEN ({column}->>'{key}')::float END AS {name}"
+        for key, name in (('qty', 'qty'), ('Avg', 'avg_val'), ('Min', 'min_val'), ('Max', 'max_val'))
+    )
+
+
+def point_data(point):
+    """Rebuild the health_metrics.data JSON for a NormalizedPoint."""
+    data = {}
+    for key, field in _VALUE_KEYS.items():
+        value = getattr(point, field)
+        if value is not None:
+            data[key] = value
+    data.update(point.extra)
+    return data
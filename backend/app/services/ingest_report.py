@@ -0,0 +1,71 @@
+"""Per-metric account of which days an ingest wrote and which it lost.
+
+Ingest commits in chunks, so a failing chunk no longer rolls back the
+whole payload. The response lists, per metric, the day ranges that landed
+and the ones that failed, so a client only has to resend the latter.
+Days are the UTC dates of the points' timestamps. Points rejected before
+they had a timestamp (missing or unparseable date) have no day, so they
+are only counted.
+"""
+from datetime import timedelta
+
+
+def _ranges(days):
+    """Collapse a set of dates into [{'from', 'to'}] runs of consecutive days."""
+    ranges = []
+    for day in sorted(days):
+        if ranges and day - ranges[-1][1] <= timedelta(days=1):
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return [{'from': start.isoformat(), 'to': end.isoformat()} for start, end in ranges]
+
+
+class IngestReport:
+    def __init__(self):
+        self._landed = {}
+        self._failed = {}
+        self._errors = {}
+        self._rejected = {}
+
+    def landed(self, metric_name, days):
+        self._landed.setdefault(metric_name, set()).update(days)
+
+    def failed(self, metric_name, days, error):
+        self._failed.setdefault(metric_name, set()).update(days)
+        self._errors.setdefault(metric_name, error)
+
+    def rejected(self, metric_name, error, count=1):
+        self._rejected[metric_name] = self._rejected.get(metric_name, 0) + count
+        self._errors.setdefault(metric_name, error)
+
+    def merge(self, other):
+        for metric_name, days in other._landed.items():
+            self.landed(metric_name, days)
+        for metric_name, days in other._failed.items():
+            self.failed(metric_name, days, other._errors.get(metric_name))
+        for metric_name, count in other._rejected.items():
+            self.rejected(metric_name, other._errors.get(metric_name), count)
+
+    @property
+    def has_failures(self):
+        return bool(self._failed or self._rejected)
+
+    @property
+    def rejected_count(self):
+        return sum(self._rejected.values())
+
+    def to_dict(self):
+        """{metric_name: {'landed': [...], 'failed': [...], 'rejected': int, 'error': str|None}}"""
+        result = {}
+        for metric_name in sorted(set(self._landed) | set(self._failed) | set(self._rejected)):
+            failed = self._failed.get(metric_name, set())
+            # A day split over two chunks only counts as landed if neither failed
+            landed = self._landed.get(metric_name, set()) - failed
+            result[metric_name] = {
+                'landed': _ranges(landed),
+                'failed': _ranges(failed),
+                'rejected': self._rejected.get(metric_name, 0),
+                'error': self._errors.get(metric_name),
+            }
+        return result
@@ -0,0 +1,85 @@
+"""Incremental parsing of Health Auto Export JSON bodies.
+
+Walks data.metrics[*].data[*] and data.workouts[*] with ijson so a
+multi-hundred-MB backfill never has to be materialized as one dict tree.
+Only the point (or workout) currently being read is kept in memory.
+"""
+import ijson
+from ijson.common import ObjectBuilder
+
+_POINT = 'metrics.item.data.item'
+_WORKOUT = 'workouts.item'
+
+# Points held for a metric whose units haven't been seen before they are
+# emitted with units ''
+PENDING_LIMIT = 1000
+
+
+def iter_stream_records(stream):
+    """Yield ingest records from a file-like JSON body.
+
+    Records have the same shape as health_ingester.iter_payload_records:
+    ('metric', metric_name, metric_units, point) and
+    ('workout', None, None, workout). Both wrapped ({"data": {...}}) and
+    bare ({"metrics": [...]}) payloads are accepted.
+
+    Points are emitted as soon as the metric's name and units are known.
+    Once the name is known, points are held for missing units only until
+    PENDING_LIMIT of them pile up or the data array ends; from then on the
+    metric's units are ''. Only a name that comes after the data array
+    holds the points until the metric object closes.
+    """
+    builder = None
+    builder_prefix = None
+    metric_name = None
+    metric_units = ''
+    units_seen = False
+    pending = []
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix.startswith('data.'):
+            prefix = prefix[5:]
+        elif prefix == 'data':
+            continue
+
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event == 'end_map':
+                item = builder.value
+                builder = None
+                if builder_prefix == _WORKOUT:
+                    yield ('workout', None, None, item)
+                elif metric_name is not None and units_seen:
+                    yield ('metric', metric_name, metric_units, item)
+                else:
+                    pending.append(item)
+                    if metric_name is not None and len(pending) >= PENDING_LIMIT:
+                        units_seen = True
+                        for held in pending:
+                            yield ('metric', metric_name, metric_units, held)
+                        pending = []
+            continue
+
+        if event == 'start_map' and prefix in (_POINT, _WORKOUT):
+            builder = ObjectBuilder()
+            builder_prefix = prefix
+            builder.event(event, value)
+        elif prefix == 'metrics.item':
+            if event == 'start_map':
+                metric_name, metric_units, units_seen = None, '', False
+                pending = []
+            elif event == 'end_map':
+                for item in pending:
+                    yield ('metric', metric_name or 'Unknown', metric_units, item)
+                pending = []
+        elif prefix == 'metrics.item.data' and event == 'end_array':
+            if metric_name is not None:
+                units_seen = True
+                for item in pending:
+                    yield ('metric', metric_name, metric_units, item)
+                pending = []
+        elif prefix == 'metrics.item.name':
+            metric_name = value
+        elif prefix == 'metrics.item.units':
+            metric_units = value
+            units_seen = True
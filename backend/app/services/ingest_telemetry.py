@@ -0,0 +1,197 @@
+"""Ingest telemetry: per-run counters and phase timings in ingest_runs.
+
+Each ingest entry point runs inside track_ingest(), which stores one
+row per run, failed runs included. Code deep in the pipeline (the
+writers' upserts, the auto-event pass, trophy evaluation) times itself
+with timed(phase), which finds the active timer through a context
+variable and is a no-op outside a run. Parse time is whatever the run
+spent outside the timed phases: reading, decoding and normalizing the
+payload. A caller that parses before handing over (the buffered JSON
+route) opens ingest_timer() first so the run's clock starts there.
+
+ingest_stats() summarises recent runs per user for /api/health/ingest-stats
+and `flask ingest-stats`.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from ..extensions import db
+from ..models.health import IngestRun
+
+PHASES = ('upsert', 'events', 'trophies')
+
+_current = ContextVar('ingest_timer', default=None)
+
+
+class IngestTimer:
+    """Wall time of a run plus seconds accumulated per phase.
+
+    Phases may be timed from several threads (parallel ingest), in which
+    case their seconds add up across workers.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.finished = None
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] += seconds
+
+    @property
+    def total(self):
+        return (self.finished or time.monotonic()) - self.started
+
+
+@contextmanager
+def ingest_timer():
+    """Time an ingest run; yields the IngestTimer. Nested calls share the outer timer."""
+    outer = _current.get()
+    if outer is not None:
+        yield outer
+        return
+    timer = IngestTimer()
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        timer.finished = time.monotonic()
+        _current.reset(token)
+
+
+@contextmanager
+def timed(phase):
+    """Add the enclosed block's duration to the active run's phase."""
+    timer = _current.get()
+    if timer is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.monotonic() - started)
+
+
+def stream_bytes(stream):
+    """Bytes consumed from a body stream, if it can tell."""
+    read = getattr(stream, 'bytes_read', None)
+    if read is not None:
+        return read
+    try:
+        return stream.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def _ms(seconds):
+    return int(round(seconds * 1000))
+
+
+def record_ingest_run(user_id, mode, result, timer, payload_bytes=None):
+    """Store one ingest_runs row for a finished run. Telemetry never fails the ingest."""
+    phases = timer.phases
+    # Trophy evaluation runs inside the auto-event pass
+    events = max(phases['events'] - phases['trophies'], 0.0)
+    parse = max(timer.total - phases['upsert'] - phases['events'], 0.0)
+    run = {
+        'user_id': user_id,
+        'mode': mode,
+        'status': result.get('status', 'ok'),
+        'payload_bytes': payload_bytes,
+        'points': result.get('metricsStored', 0),
+        'inserted': result.get('metricsInserted', 0),
+        'updated': result.get('metricsUpdated', 0),
+        'skipped': result.get('metricsSkipped', 0),
+        'workouts': result.get('workoutsStored', 0),
+        'errors': len(result.get('errors') or []),
+        'total_ms': _ms(timer.total),
+        'parse_ms': _ms(parse),
+        'upsert_ms': _ms(phases['upsert']),
+        'events_ms': _ms(events),
+        'trophies_ms': _ms(phases['trophies']),
+    }
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(IngestRun.__table__.insert(), run)
+    except SQLAlchemyError:
+        pass
+
+
+class _Run:
+    def __init__(self, payload_bytes):
+        self.result = None
+        self.payload_bytes = payload_bytes
+
+
+@contextmanager
+def track_ingest(user_id, mode, payload_bytes=None):
+    """Time an ingest run and record it on exit.
+
+    Set run.result to the ingest result (and run.payload_bytes if it is
+    only known afterwards). A run that raises is recorded as failed.
+    """
+    run = _Run(payload_bytes)
+    with ingest_timer() as timer:
+        try:
+            yield run
+        except Exception as e:
+            record_ingest_run(user_id, mode, {'status': 'failed', 'errors': [str(e)]},
+                              timer, run.payload_bytes)
+            raise
+    record_ingest_run(user_id, mode, run.result or {}, timer, run.payload_bytes)
+
+
+# Columns summarised by ingest_stats
+_STAT_COLUMNS = ('total_ms', 'parse_ms', 'upsert_ms', 'events_ms', 'trophies_ms',
+                 'points', 'payload_bytes')
+
+
+def ingest_stats(since, user_id=None):
+    """p50/p95/p99 of durations and sizes per user over runs since a timestamp."""
+    percentiles = ',\n'.join(
+        f'percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY {col}) AS {col}'
+        for col in _STAT_COLUMNS
+    )
+    where = 'created_at >= :since' + ('' if user_id is None else ' AND user_id = :uid')
+    rows = db.session.execute(text(f"""
+        SELECT user_id, COUNT(*) AS runs,
+               SUM(errors) AS errors,
+               COUNT(*) FILTER (WHERE status <> 'ok') AS partial_runs,
+               SUM(points) AS points_total,
+               SUM(inserted) AS inserted, SUM(updated) AS updated, SUM(skipped) AS skipped,
+               {percentiles}
+        FROM ingest_runs
+        WHERE {where}
+        GROUP BY user_id
+        ORDER BY SUM(total_ms) DESC
+    """), {'since': since, 'uid': user_id}).fetchall()
+
+    def pct(values):
+        if values is None:
+            return None
+        p50, p95, p99 = values
+        return {'p50': p50, 'p95': p95, 'p99': p99}
+
+    return [{
+        'userId': r.user_id,
+        'runs': r.runs,
+        'partialRuns': r.partial_runs,
+        'errors': r.errors,
+        'points': r.points_total,
+        'inserted': r.inserted,
+        'updated': r.updated,
+        'skipped': r.skipped,
+        'totalMs': pct(r.total_ms),
+        'parseMs': pct(r.parse_ms),
+        'upsertMs': pct(r.upsert_ms),
+        'eventsMs': pct(r.events_ms),
+        'trophiesMs': pct(r.trophies_ms),
+        'pointsPerRun': pct(r.points),
+        'payloadBytes': pct(r.payload_bytes),
+    } for r in rows]
@@ -1,14 +1,15 @@
 """Shared metrics service - centralizes metric calculation for goals and dashboard.
 
-Fixes timezone bug: uses UTC-3 (Brazil) instead of date.today() which uses Docker UTC.
+Fixes timezone bug: "today" is the user's local date (see user_timezone) instead of
+date.today() which uses Docker UTC.
 Fixes query bug: uses UTC range instead of date::date = :d which misses records.
 Supports dynamic discovery of all Apple Watch metrics (not just hardcoded 9).
 """
-from datetime import datetime, date, timedelta, timezone
+from datetime import timedelta
 from sqlalchemy import text
 from ..extensions import db
-
-BRT = timezone(timedelta(hours=-3))
+from .health_packed import packed_range_sum
+from .user_timezone import day_utc_range, get_user_today, user_timezone
 
 METRIC_CONFIG = {
     'steps':            {'name': 'step_count',              'agg': 'sum',    'unit': 'passos',    'label': 'Passos'},
@@ -71,28 +72,42 @@ def get_all_metric_configs(user_id):
     """Return config for ALL metrics the user has data for.
 
     Starts with the 9 known metrics in METRIC_CONFIG, then discovers
-    any additional metrics stored in health_metrics that aren't in the config.
+    any additional metrics the user has daily rollups for that aren't in
+    the config.
     """
-    from ..models.health import HealthMetric
-
     all_configs = dict(METRIC_CONFIG)
 
-    rows = db.session.query(
-        HealthMetric.metric_name,
-        HealthMetric.metric_units,
-    ).filter_by(user_id=user_id).distinct().all()
+    # Unknown metric names come from the rollups, which hold one row per
+    # metric and day, and each one's latest sample (to detect the agg type)
+    # from an index lookup, all in one round trip. Packed metrics have no
+    # 'data'; whether their latest day carries Avg values tells hr from sum
+    rows = db.session.execute(text("""
+        SELECT n.metric_name, COALESCE(s.metric_units, p.metric_units) AS metric_units,
+               s.data, p.has_avg
+        FROM (
+            SELECT DISTINCT metric_name FROM health_daily_rollups
+            WHERE user_id = :uid AND NOT (metric_name = ANY(:known))
+        ) n
+        LEFT JOIN LATERAL (
+            SELECT metric_units, data FROM health_metrics
+            WHERE user_id = :uid AND metric_name = n.metric_name
+            ORDER BY date DESC LIMIT 1
+        ) s ON true
+        LEFT JOIN LATERAL (
+            SELECT metric_units, array_position(avg, NULL) IS NULL AS has_avg
+            FROM health_metric_days
+            WHERE user_id = :uid AND metric_name = n.metric_name
+            ORDER BY day DESC LIMIT 1
+        ) p ON true
+        ORDER BY n.metric_name
+    """), {'uid': user_id, 'known': list(METRIC_NAME_TO_KEY)}).fetchall()
 
     discovery_idx = 0
-    for metric_name, metric_units in rows:
-        if metric_name in METRIC_NAME_TO_KEY:
-            continue
-
-        # Get a sample to detect agg type
-        sample = HealthMetric.query.filter_by(
-            user_id=user_id, metric_name=metric_name
-        ).order_by(HealthMetric.date.desc()).first()
-
-        agg = detect_agg_type(sample.data if sample else None)
+    for metric_name, metric_units, data, has_avg in rows:
+        if data is None and has_avg is not None:
+            agg = 'hr' if has_avg else 'sum'
+        else:
+            agg = detect_agg_type(data)
         key = _snake_to_camel(metric_name)
 
         color = _DISCOVERY_COLORS[discovery_idx % len(_DISCOVERY_COLORS)]
@@ -110,21 +125,20 @@ def get_all_metric_configs(user_id):
     return all_configs
 
 
-def get_user_today():
-    """Return today's date in Brazil timezone (UTC-3)."""
-    return datetime.now(BRT).date()
-
-
-def _day_utc_range(d):
-    """Return (start, end) UTC timestamps for a given local date in BRT."""
-    start_local = datetime(d.year, d.month, d.day, tzinfo=BRT)
-    end_local = start_local + timedelta(days=1)
-    return start_local.astimezone(timezone.utc), end_local.astimezone(timezone.utc)
+def latest_metric_value(user_id, metric_name):
+    """Most recent qty of a metric, from raw rows and packed samples alike, or None."""
+    row = db.session.execute(text("""
+        SELECT latest_value FROM health_daily_rollups
+        WHERE user_id = :uid AND metric_name = :name AND latest_value IS NOT NULL
+        ORDER BY day DESC LIMIT 1
+    """), {'uid': user_id, 'name': metric_name}).fetchone()
+    return row.latest_value if row else None
 
 
 def get_metric_value(user_id, metric_key, period_type, ref_date=None):
     """Calculate current value for a metric-based goal."""
-    today = ref_date or get_user_today()
+    tz = user_timezone(user_id)
+    today = ref_date or get_user_today(user_id)
 
     cfg = METRIC_CONFIG.get(metric_key)
     if not cfg:
@@ -141,51 +155,43 @@ def get_metric_value(user_id, metric_key, period_type, ref_date=None):
         since = today.replace(day=1)
     else:
         since = today.replace(month=1, day=1)
+    params = {'uid': user_id, 'name': metric_name, 'since': since}
 
     if agg == 'sum':
         if period_type == 'daily':
-            utc_start, utc_end = _day_utc_range(today)
-            row = db.session.execute(text("""
-                SELECT SUM(CAST(data->>'qty' AS FLOAT)) AS total
-                FROM health_metrics
-                WHERE user_id = :uid AND metric_name = :name
-                  AND date >= :start AND date < :end
-            """), {'uid': user_id, 'name': metric_name,
-                   'start': utc_start, 'end': utc_end}).fetchone()
-            return round(row.total, 1) if row and row.total else 0
+            # Today's total also counts points still in the ingest buffer
+            from .ingest_buffer import buffered_range_sum
+            utc_start, utc_end = day_utc_range(today, tz)
+            total = (buffered_range_sum(user_id, metric_name, utc_start, utc_end)
+                     + (packed_range_sum(user_id, metric_name, utc_start, utc_end) or 0))
+            return round(total, 1) if total else 0
         else:
+            # Daily totals per local day come from the rollups
             row = db.session.execute(text("""
-                SELECT AVG(daily_total) AS avg_val FROM (
-                    SELECT date::date AS day, SUM(CAST(data->>'qty' AS FLOAT)) AS daily_total
-                    FROM health_metrics
-                    WHERE user_id = :uid AND metric_name = :name AND date::date >= :since
-                    GROUP BY day
-                ) sub
-            """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchone()
+                SELECT AVG(total) AS avg_val FROM health_daily_rollups
+                WHERE user_id = :uid AND metric_name = :name AND day >= :since
+            """), params).fetchone()
             return round(row.avg_val, 1) if row and row.avg_val else 0
 
     elif agg == 'latest':
-        row = db.session.execute(text("""
-            SELECT data->>'qty' AS qty FROM health_metrics
-            WHERE user_id = :uid AND metric_name = :name
-            ORDER BY date DESC LIMIT 1
-        """), {'uid': user_id, 'name': metric_name}).fetchone()
-        return round(float(row.qty), 1) if row and row.qty else None
+        value = latest_metric_value(user_id, metric_name)
+        return round(float(value), 1) if value else None
 
     elif agg == 'hr':
+        # Each day's average weighted by the samples behind it
         row = db.session.execute(text("""
-            SELECT AVG(CAST(COALESCE(data->>'Avg', data->>'qty') AS FLOAT)) AS avg_val
-            FROM health_metrics
-            WHERE user_id = :uid AND metric_name = :name AND date::date >= :since
-        """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchone()
+            SELECT SUM(avg_val * sample_count) / NULLIF(SUM(sample_count), 0) AS avg_val
+            FROM health_daily_rollups
+            WHERE user_id = :uid AND metric_name = :name AND day >= :since
+        """), params).fetchone()
         return round(row.avg_val, 1) if row and row.avg_val else None
 
     elif agg == 'sleep':
         row = db.session.execute(text("""
             SELECT AVG(CAST(COALESCE(data->>'asleep', data->>'totalSleep', data->>'qty') AS FLOAT)) AS avg_val
             FROM health_metrics
-            WHERE user_id = :uid AND metric_name = :name AND date::date >= :since
-        """), {'uid': user_id, 'name': metric_name, 'since': since}).fetchone()
+            WHERE user_id = :uid AND metric_name = :name AND local_day >= :since
+        """), params).fetchone()
         val = row.avg_val if row and row.avg_val else None
         if val and val > 24:
             val = val / 3600
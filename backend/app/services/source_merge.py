@@ -0,0 +1,200 @@
+"""Source-priority merge of overlapping samples from several devices.
+
+Cumulative metrics such as step_count and active_energy are recorded by
+both the iPhone and the Watch over overlapping intervals, so summing every
+stored sample double-counts. Before a metric-day is written, its samples
+are ranked by source (user preference 'sourcePriority', else
+HEALTH_SOURCE_PRIORITY) and laid out on a timeline: a sample keeps only
+the share of its quantity whose interval is not already covered by a
+higher-priority source, and is dropped when fully covered. Adjusted
+samples keep the original value in 'rawQty'.
+
+A sample's interval runs from its date to its 'end' when the exporter
+sends one, else DEFAULT_SAMPLE_SECONDS.
+
+The ingest MetricWriter merges each metric-day as it arrives. Bulk loads
+(COPY backfill, export.xml import) list each device's samples separately,
+so they call merge_stored_sources afterwards to merge what was stored.
+"""
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+from sqlalchemy import text
+from ..extensions import db
+from .ingest_normalizer import parse_date, parse_exporter_ts, point_from_data
+
+# Cumulative metrics whose device overlaps are merged
+MERGE_METRICS = frozenset({
+    'step_count',
+    'active_energy',
+    'basal_energy_burned',
+    'walking_running_distance',
+    'flights_climbed',
+    'apple_exercise_time',
+})
+
+DEFAULT_SOURCE_PRIORITY = ['Apple Watch', 'iPhone']
+
+# Assumed length of a sample that has no 'end'
+DEFAULT_SAMPLE_SECONDS = 60
+
+# Stored rows are re-merged this many days at a time
+REMERGE_WINDOW = timedelta(days=30)
+
+
+def source_priority(user_id):
+    """Ordered source name fragments for a user, highest priority first."""
+    from ..models.user import User
+    user = User.query.get(user_id)
+    priority = (user.preferences or {}).get('sourcePriority') if user else None
+    return priority or current_app.config.get('HEALTH_SOURCE_PRIORITY') or DEFAULT_SOURCE_PRIORITY
+
+
+def _rank(source, priority):
+    if source:
+        lowered = source.lower()
+        for i, fragment in enumerate(priority):
+            if fragment.lower() in lowered:
+                return i
+    return len(priority)
+
+
+def _interval(point):
+    start = point.ts_utc
+    end = None
+    end_str = point.extra.get('end')
+    if isinstance(end_str, str):
+        try:
+            end = parse_exporter_ts(end_str)
+        except ValueError:
+            try:
+                end = parse_date(end_str)
+            except ValueError:
+                end = None
+        if end is not None:
+            if start.tzinfo is None:
+                end = end.astimezone(timezone.utc).replace(tzinfo=None) if end.tzinfo else end
+            elif end.tzinfo is None:
+                end = end.replace(tzinfo=timezone.utc)
+    if end is None or end <= start:
+        end = start + timedelta(seconds=DEFAULT_SAMPLE_SECONDS)
+    return start, end
+
+
+class _Timeline:
+    """Sorted, disjoint covered intervals."""
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+
+    def uncovered_seconds(self, start, end):
+        covered = 0.0
+        i = max(bisect_left(self._starts, start) - 1, 0)
+        while i < len(self._starts) and self._starts[i] < end:
+            lo = max(start, self._starts[i])
+            hi = min(end, self._ends[i])
+            if hi > lo:
+                covered += (hi - lo).total_seconds()
+            i += 1
+        return (end - start).total_seconds() - covered
+
+    def cover(self, start, end):
+        i = bisect_left(self._starts, start)
+        # Absorb the previous interval if it touches this one
+        if i > 0 and self._ends[i - 1] >= start:
+            i -= 1
+            start = self._starts[i]
+            end = max(end, self._ends[i])
+        j = i
+        while j < len(self._starts) and self._starts[j] <= end:
+            end = max(end, self._ends[j])
+            j += 1
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+
+def merge_sources(run, priority):
+    """Merge one metric-day of (metric_name, metric_units, NormalizedPoint).
+
+    Returns (points, merged); merged is False (and run is returned as is)
+    when the samples come from fewer than two sources.
+    """
+    if len({p.extra.get('source') for _, _, p in run}) < 2:
+        return run, False
+
+    ranked = sorted(run, key=lambda r: (_rank(r[2].extra.get('source'), priority), r[2].ts_utc))
+    timeline = _Timeline()
+    kept = {}
+    for metric_name, metric_units, point in ranked:
+        start, end = _interval(point)
+        total = (end - start).total_seconds()
+        share = timeline.uncovered_seconds(start, end) / total
+        timeline.cover(start, end)
+        if share <= 1e-9:
+            continue
+        if share < 1 and point.qty is not None:
+            point = point._replace(qty=point.qty * share,
+                                   extra=dict(point.extra, rawQty=point.qty))
+        existing = kept.get(point.ts_utc)
+        if existing:
+            # Same start as a higher-priority sample: fold the remainder into it
+            _, _, higher = existing
+            if higher.qty is not None and point.qty is not None:
+                kept[point.ts_utc] = (metric_name, metric_units,
+                                      higher._replace(qty=higher.qty + point.qty))
+            continue
+        kept[point.ts_utc] = (metric_name, metric_units, point)
+    return [kept[ts] for ts in sorted(kept)], True
+
+
+def merge_stored_sources(user_id, metric_names=None, log=None):
+    """Re-run the source merge over rows already in health_metrics.
+
+    Rows are read back in date order, a window of whole days at a time,
+    with their original 'rawQty'. Days that still need merging are fed
+    through MetricWriter, so the result matches what ingest would have
+    stored. Returns the number of points removed.
+    """
+    from .health_ingester import MetricWriter
+    from .ingest_fingerprints import invalidate_fingerprints
+
+    priority = source_priority(user_id)
+    merged = 0
+    for metric_name in sorted(metric_names or MERGE_METRICS):
+        bounds = db.session.execute(text("""
+            SELECT MIN(date) AS first, MAX(date) AS last FROM health_metrics
+            WHERE user_id = :uid AND metric_name = :name
+        """), {'uid': user_id, 'name': metric_name}).fetchone()
+        if not bounds or bounds.first is None:
+            continue
+        invalidate_fingerprints(user_id, metric_name)
+        writer = MetricWriter(user_id)
+        start = datetime.combine(bounds.first.date(), datetime.min.time())
+        while start <= bounds.last:
+            rows = db.session.execute(text("""
+                SELECT date, metric_units, data FROM health_metrics
+                WHERE user_id = :uid AND metric_name = :name
+                  AND date >= :start AND date < :end
+                ORDER BY date
+            """), {'uid': user_id, 'name': metric_name,
+                   'start': start, 'end': start + REMERGE_WINDOW}).fetchall()
+            days = {}
+            for row in rows:
+                data = dict(row.data or {})
+                raw = data.pop('rawQty', None)
+                if raw is not None:
+                    data['qty'] = raw
+                days.setdefault(row.date.date(), []).append(
+                    (metric_name, row.metric_units, point_from_data(row.date, data)))
+            for run in days.values():
+                if merge_sources(run, priority)[1]:
+                    for point in run:
+                        writer.add(*point)
+            # Close the window's last day before its rows are written and committed
+            writer.close()
+            start += REMERGE_WINDOW
+        merged += writer.merged
+        if log:
+            log(f'  {metric_name}: {writer.merged} overlapping samples merged away')
+    return merged
@@ -0,0 +1,70 @@
+"""Per-user timezone: which local day a sample or "today" belongs to.
+
+Each user's IANA timezone is stored in User.preferences['timezone']. Users
+who never set one get DEFAULT_TIMEZONE (the app's config value, Brazil by
+default). Ingest stamps every health_metrics row with its local_day in the
+user's timezone, and the daily aggregates group and filter on that column
+instead of converting each row's timestamp at query time.
+
+PATCH /api/user/preferences restamps the user's stored local_day values
+and rebuilds their daily rollups when the timezone changes;
+`flask add-health-metric-local-day --user-id N` does the same offline.
+"""
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from flask import current_app
+
+# Timezone of users without a preference (the app passes its config value)
+DEFAULT_TIMEZONE = 'America/Sao_Paulo'
+
+# SQL expression: local date of a naive UTC timestamp column in the :tz zone
+LOCAL_DAY_SQL = "CAST(timezone(:tz, timezone('UTC', {column})) AS date)"
+
+
+def valid_timezone(name):
+    """True if name is an IANA timezone this server knows."""
+    if not isinstance(name, str) or not name:
+        return False
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        return False
+    return True
+
+
+def timezone_name(user_id):
+    """The user's timezone name, falling back to DEFAULT_TIMEZONE."""
+    from ..models.user import User
+    user = User.query.get(user_id)
+    name = (user.preferences or {}).get('timezone') if user else None
+    if valid_timezone(name):
+        return name
+    return current_app.config.get('DEFAULT_TIMEZONE') or DEFAULT_TIMEZONE
+
+
+def user_timezone(user_id):
+    """ZoneInfo for the user's timezone."""
+    return ZoneInfo(timezone_name(user_id))
+
+
+def local_day(ts, tz):
+    """Local date in tz of a timestamp (naive timestamps are UTC)."""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(tz).date()
+
+
+def day_utc_range(d, tz):
+    """Return (start, end) UTC timestamps for a given local date in tz."""
+    start_local = datetime(d.year, d.month, d.day, tzinfo=tz)
+    end_local = datetime.combine(d + timedelta(days=1), datetime.min.time(), tzinfo=tz)
+    return start_local.astimezone(timezone.utc), end_local.astimezone(timezone.utc)
+
+
+def get_user_today(user_id=None):
+    """Return today's date in the user's timezone (DEFAULT_TIMEZONE without a user)."""
+    if user_id is None:
+        tz = ZoneInfo(current_app.config.get('DEFAULT_TIMEZONE') or DEFAULT_TIMEZONE)
+    else:
+        tz = user_timezone(user_id)
+    return datetime.now(tz).date()